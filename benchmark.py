@@ -0,0 +1,633 @@
+"""Micro-benchmarks for the converters.
+
+Usage: python benchmark.py [name ...]   (no names runs every benchmark)
+"""
+import importlib.util
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO, StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+ARTIFACT_SETTINGS = {
+    'base_font_size': 12.0,
+    'code_font_size': 11.0,
+    'page_size': 'A4',
+    'page_margin': 1.5,
+    'paragraph_spacing': 8,
+    'code_padding_vertical': 15,
+    'code_padding_horizontal': 12,
+    'code_margin_top': 15,
+    'code_margin_bottom': 15,
+    'code_bg_color': '#f5f5f5',
+    'keyword_color': '#00BFFF',
+    'string_color': '#ff8c00',
+    'comment_color': '#006400',
+    'number_color': '#FF00FF',
+    'function_color': '#795e26',
+    'enable_wrap': True,
+    'toc': 'none',
+}
+
+SMALL_DOCUMENT = '''# Weekly Report
+
+A short summary paragraph with **bold** text.
+
+```sql
+SELECT id, name FROM users WHERE active = 1;
+```
+'''
+
+
+def load_app(filename):
+    """Import one of the converter scripts as a module"""
+    name = filename.replace('-', '_').rsplit('.', 1)[0]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timed(func, repeat=20):
+    """Return the mean wall time of func() in milliseconds"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def report(label, ms):
+    print(f'  {label:<40} {ms:10.2f} ms')
+
+
+def peak_memory(func):
+    """Return the peak traced allocation of func() in megabytes"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def bench_profile_cache():
+    """Per-request saving of the cached pisa conversion profile on a small document"""
+    import css_cache
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    settings = ARTIFACT_SETTINGS
+
+    def uncached():
+        html = artifact.app.jinja_env.from_string(artifact.HTML_TEMPLATE).render(
+            css=artifact.generate_css(settings),
+            content=artifact.process_markdown(SMALL_DOCUMENT)
+        )
+        css_cache.parsed_stylesheets.clear()
+        pisa.CreatePDF(html.encode('utf-8'), dest=BytesIO(), encoding='utf-8', path='')
+
+    def cached():
+        profile = artifact.get_render_profile(settings)
+        html = profile['head'] + artifact.process_markdown(SMALL_DOCUMENT) + profile['tail']
+        pisa.CreatePDF(
+            html.encode('utf-8'), dest=BytesIO(), encoding='utf-8', path='',
+            default_css=profile['default_css']
+        )
+
+    before = timed(uncached)
+    after = timed(cached)
+    report('uncached profile', before)
+    report('cached profile', after)
+    report('saving per request', before - after)
+
+
+def bench_streaming():
+    """Peak memory of whole-document versus block-streamed markdown conversion"""
+    artifact = load_app('claude-artifact2pdf.py')
+    profile = artifact.get_render_profile(ARTIFACT_SETTINGS)
+    log_dump = ''.join(
+        f'## Run {i}\n\nStep {i} finished in {i % 97} ms.\n\n```sql\nSELECT * FROM runs WHERE id = {i};\n```\n\n'
+        for i in range(10000)
+    )
+    print(f'  input size: {len(log_dump) / (1024 * 1024):.1f} MB')
+
+    def whole():
+        html = profile['head'] + artifact.process_markdown(log_dump) + profile['tail']
+        html.encode('utf-8')
+
+    def streamed():
+        artifact.write_html_document(profile, artifact.process_markdown_stream(StringIO(log_dump))).close()
+
+    print(f'  {"whole document peak":<40} {peak_memory(whole):10.1f} MB')
+    print(f'  {"streamed peak":<40} {peak_memory(streamed):10.1f} MB')
+
+    # Groups are only cut outside fences: inline ```code``` opens none, and a
+    # ```` fence is not closed by the ``` lines inside it
+    expected = [
+        'Intro.\n\n',
+        '```x``` is inline code.\n\n',
+        'Next paragraph.\n\n',
+        '````markdown\n```sql\nSELECT 1;\n```\n\nStill inside.\n````\n\n',
+        'After the fence.\n\n',
+        '```python\nprint(1)\n\nprint(2)\n```\n\n',
+        'Tail.\n',
+    ]
+    groups = list(artifact.iter_markdown_blocks(StringIO(''.join(expected)), max_chars=1))
+    if groups != expected:
+        raise AssertionError(f'block groups cut inside a fence: {groups!r}')
+    print(f'  {"fence-aware grouping":<40} {"ok":>10}')
+
+
+def legacy_remove_emojis(content):
+    """remove_emojis as it was before the translate table"""
+    emoji_pattern = re.compile(
+        "["
+        "\U0001F600-\U0001F64F"
+        "\U0001F300-\U0001F5FF"
+        "\U0001F680-\U0001F6FF"
+        "\U0001F1E0-\U0001F1FF"
+        "\U00002702-\U000027B0"
+        "\U000024C2-\U0001F251"
+        "\U0001F900-\U0001F9FF"
+        "\U00002600-\U000026FF"
+        "\U00002700-\U000027BF"
+        "\U0001FA00-\U0001FA6F"
+        "\U0001FA70-\U0001FAFF"
+        "\U00002B50"
+        "\U0000FE0F"
+        "]+",
+        flags=re.UNICODE
+    )
+    return emoji_pattern.sub('', content)
+
+
+def legacy_clean_special_chars(code):
+    """clean_special_chars as it was before the translate table"""
+    for old, new in [('├──', '|--'), ('└──', '`--'), ('├─', '|-'), ('└─', '`-'),
+                     ('│', '|'), ('─', '-'), ('├', '|'), ('└', '`')]:
+        code = code.replace(old, new)
+    return code
+
+
+def bench_unicode_cleaning():
+    """Emoji stripping and box-drawing mapping on 10 MB inputs"""
+    latex = load_app('claude-md2latex2pdf.py')
+    inputs = {
+        'ascii': 'Plain ASCII prose with SELECT statements and numbers 42.\n',
+        'sparse emoji': 'Plain ASCII prose with SELECT statements and numbers 42.\n' * 50 + 'Done \u2705\n',
+        'dense emoji + trees': 'Status \U0001F680 ok \u2713 |\n\u251c\u2500\u2500 src \u2502 main.py\n',
+        'accented prose': 'Le caf\u00e9 cr\u00e8me na\u00eff, \u00e0 la fa\u00e7ade; Stra\u00dfe \u00fcber \u00c4rger.\n',
+    }
+    for label, unit in inputs.items():
+        text = unit * (10 * 1024 * 1024 // len(unit))
+        report(f'{label}: legacy', timed(lambda: legacy_clean_special_chars(legacy_remove_emojis(text)), repeat=3))
+        report(f'{label}: clean_unicode', timed(lambda: latex.clean_unicode(text), repeat=3))
+
+
+def legacy_fix_list_formatting(content):
+    """fix_list_formatting as it was before the line state machine"""
+    parts = re.split(r'(```[\s\S]*?```)', content)
+    result = []
+    for part in parts:
+        if not part.startswith('```'):
+            part = re.sub(r'(\S[^\n]*)\n([ \t]*[-*+] )', r'\1\n\n\2', part)
+            part = re.sub(r'(\S[^\n]*)\n([ \t]*\d+\. )', r'\1\n\n\2', part)
+        result.append(part)
+    return ''.join(result)
+
+
+def bench_list_formatting():
+    """Worst case for list spacing: one long paragraph line not followed by a list"""
+    latex = load_app('claude-md2latex2pdf.py')
+    for words in (1000, 2000, 4000):
+        text = 'word ' * words + '\nnext line\n- item\n'
+        report(f'{len(text)} chars: legacy regexes', timed(lambda: legacy_fix_list_formatting(text), repeat=3))
+        report(f'{len(text)} chars: line state machine', timed(lambda: latex.fix_list_formatting(text), repeat=3))
+
+
+def bench_code_layout():
+    """Line-box versus compact code layout: pisa time on a 5,000-line SQL dump, text parity on samples"""
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    dump = '\n'.join(f"INSERT INTO events VALUES ({i}, 'event {i}', NOW());" for i in range(5000))
+    md_text = f'# SQL dump\n\n```sql\n{dump}\n```\n'
+    for layout in ('lines', 'compact'):
+        settings = dict(ARTIFACT_SETTINGS, code_layout=layout)
+        profile = artifact.get_render_profile(settings)
+        html = profile['head'] + artifact.process_markdown(md_text, True, layout) + profile['tail']
+
+        def convert():
+            pisa.CreatePDF(
+                html.encode('utf-8'), dest=BytesIO(), encoding='utf-8', path='',
+                default_css=profile['default_css']
+            )
+
+        report(f'{layout} layout', timed(convert, repeat=1))
+        print(f'  {"peak memory":<40} {peak_memory(convert):10.1f} MB')
+
+    # Visual parity: both layouts must put the same text on the page, line
+    # for line (blank lines aside, which the line-box layout collapses)
+    from pypdf import PdfReader
+
+    def extracted_lines(md_text, layout):
+        profile = artifact.get_render_profile(dict(ARTIFACT_SETTINGS, code_layout=layout))
+        html = profile['head'] + artifact.process_markdown(md_text, True, layout) + profile['tail']
+        pdf_file = BytesIO()
+        pisa.CreatePDF(html.encode('utf-8'), dest=pdf_file, encoding='utf-8', path='',
+                       default_css=profile['default_css'])
+        text = ''.join(page.extract_text() for page in PdfReader(BytesIO(pdf_file.getvalue())).pages)
+        return [line.strip() for line in text.split('\n') if line.strip()]
+
+    samples = {
+        'sql, comment across chunks': '```sql\n' + '\n'.join(
+            ['SELECT id, name FROM users WHERE id = 1;'] * 45 + ['/* a comment', 'spanning lines'] * 6
+            + ['*/'] + ["INSERT INTO t VALUES (2, 'x');"] * 20
+        ) + '\n```\n',
+        'python, blank lines': '```python\n' + '\n\n'.join(
+            f'def f{i}(x):\n    """Doc {i}"""\n    return x * {i}  # note' for i in range(40)
+        ) + '\n```\n',
+        'tree, wrapped lines': '```\n' + '\n'.join(
+            f'\u251c\u2500\u2500 dir{i} \u2502 ' + 'word ' * 30 for i in range(60)
+        ) + '\n```\n',
+    }
+    for label, md_text in samples.items():
+        lines = extracted_lines(md_text, 'lines')
+        if extracted_lines(md_text, 'compact') != lines:
+            raise AssertionError(f'compact layout text differs from line boxes: {label}')
+        print(f'  {"parity, " + label:<40} {f"{len(lines)} lines":>10}')
+
+
+def bench_large_tables():
+    """One unsplittable 10,000-row table versus page-sized pieces (pisa time only)"""
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    settings = ARTIFACT_SETTINGS
+    profile = artifact.get_render_profile(settings)
+    md_text = '# Query result\n\n| id | name | value |\n|---|---|---|\n' + ''.join(
+        f'| {i} | row {i} | {i * 3.5} |\n' for i in range(10000)
+    )
+    single = artifact.process_markdown(md_text, table_rows=10 ** 9)
+    paginated = artifact.process_markdown(md_text, table_rows=artifact.table_rows_per_page(settings))
+    for label, content in (('single table', single), ('paginated tables', paginated)):
+        html = (profile['head'] + content + profile['tail']).encode('utf-8')
+        report(label, timed(lambda: pisa.CreatePDF(
+            html, dest=BytesIO(), encoding='utf-8', path='', default_css=profile['default_css']
+        ), repeat=1))
+
+
+def bench_reportlab_backend():
+    """HTML/CSS through pisa versus direct reportlab flowables on a code- and table-heavy report"""
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    settings = dict(ARTIFACT_SETTINGS, code_layout='lines')
+    md_text = '# Nightly report\n\n' + ''.join(
+        f'## Job {i}\n\nJob **{i}** loaded `{i * 10}` rows.\n\n'
+        f'```sql\nSELECT id, SUM(amount) FROM sales_{i} WHERE day = {i} GROUP BY id;\n'
+        f'-- checked by job {i}\n```\n\n'
+        '| step | rows | seconds |\n|---|---|---|\n'
+        + ''.join(f'| step {j} | {i * j} | {j * 0.5} |\n' for j in range(10))
+        + '\n'
+        for i in range(100)
+    )
+
+    def through_pisa():
+        profile = artifact.get_render_profile(settings)
+        html = profile['head'] + artifact.process_markdown(md_text) + profile['tail']
+        pisa.CreatePDF(
+            html.encode('utf-8'), dest=BytesIO(), encoding='utf-8', path='',
+            default_css=profile['default_css']
+        )
+
+    report('pisa (markdown -> HTML -> CSS)', timed(through_pisa, repeat=1))
+    report('reportlab flowables', timed(lambda: artifact.render_pdf_reportlab(md_text, settings), repeat=1))
+
+
+def bench_document_model():
+    """Filename extraction plus preprocessing with a cold versus warm document cache"""
+    import docmodel
+    artifact = load_app('claude-artifact2pdf.py')
+    latex = load_app('claude-md2latex2pdf.py')
+    md_text = '# Nightly report\n\n' + ''.join(
+        f'## Job {i}\n\nJob **{i}** loaded rows.\n\n**💡 Note:** check job {i}.\n\n'
+        f'```sql\nSELECT id FROM sales_{i};\n```\n\n- step one\n- step two\n\n'
+        for i in range(2000)
+    )
+
+    def latex_request():
+        latex.extract_first_header(md_text)
+        latex.preprocess_markdown(md_text)
+
+    def artifact_request():
+        artifact.extract_first_header(md_text)
+        artifact.process_code_blocks(md_text)
+
+    for label, func in (('latex', latex_request), ('artifact', artifact_request)):
+        report(f'{label}: cold cache', timed(lambda: (docmodel.parsed_documents.clear(), func()), repeat=5))
+        report(f'{label}: warm cache', timed(func, repeat=5))
+
+
+def bench_parallel_highlighting():
+    """Serial versus process-pool highlighting of 600 fenced blocks"""
+    import highlighters
+    blocks = [
+        ('\n'.join(f"SELECT a, COUNT(*) FROM t_{i} WHERE x = {j}; -- check {j}" for j in range(20)), 'sql')
+        for i in range(600)
+    ]
+    workers = highlighters.HIGHLIGHT_WORKERS
+    print(f'  {"workers":<40} {workers:10d}')
+    highlighters.HIGHLIGHT_WORKERS = 1
+    report('serial', timed(lambda: highlighters.highlight_blocks(blocks), repeat=3))
+    highlighters.HIGHLIGHT_WORKERS = max(workers, 2)
+    report('process pool', timed(lambda: highlighters.highlight_blocks(blocks), repeat=3))
+    highlighters.HIGHLIGHT_WORKERS = workers
+
+
+def bench_lexers():
+    """Built-in single-pass lexers on 5,000 lines, and cold versus warm Pygments lookups"""
+    import lexers
+    sql = '\n'.join(f"INSERT INTO events VALUES ({i}, 'event {i}', NOW()); -- row {i}" for i in range(5000))
+    python = '\n'.join(f"def f_{i}(x=1):  # step {i}\n    return len('s') + {i}" for i in range(2500))
+    report('sql built-in', timed(lambda: lexers.highlight(sql, 'sql'), repeat=5))
+    report('python built-in', timed(lambda: lexers.highlight(python, 'py'), repeat=5))
+
+    def cold_pygments():
+        lexers.pygments_lexers.clear()
+        lexers.highlight('echo "$HOME"', 'bash')
+
+    report('pygments bash, cold lexer cache', timed(cold_pygments, repeat=5))
+    report('pygments bash, warm lexer cache', timed(lambda: lexers.highlight('echo "$HOME"', 'bash'), repeat=5))
+
+
+def bench_verbatim_code():
+    """Python-side cost of pre-highlighted Verbatim blocks for 500 fences (TeX time not included)"""
+    import docmodel
+    latex = load_app('claude-md2latex2pdf.py')
+    md_text = '# Queries\n\n' + ''.join(
+        f'```sql\nSELECT id, SUM(amount) FROM sales_{i % 50} WHERE day = {i % 50} GROUP BY id;\n```\n\n'
+        for i in range(500)
+    )
+
+    def preprocess(renderer, clear_cache):
+        if clear_cache:
+            latex.highlight_verbatim.cache_clear()
+        docmodel.parsed_documents.clear()
+        latex.preprocess_markdown(md_text, code_renderer=renderer)
+
+    report('listings', timed(lambda: preprocess('listings', False), repeat=5))
+    report('verbatim, cold block cache', timed(lambda: preprocess('verbatim', True), repeat=5))
+    report('verbatim, warm block cache', timed(lambda: preprocess('verbatim', False), repeat=5))
+
+
+def bench_latex_engines():
+    """Pandoc converter latency per installed TeX engine on a small and a code-heavy report"""
+    latex = load_app('claude-md2latex2pdf.py')
+    settings = {
+        'base_font_size': 11, 'code_font_size': 9, 'page_size': 'A4', 'page_margin': 2,
+        'paragraph_spacing': 6, 'code_padding_vertical': 8, 'code_padding_horizontal': 15,
+        'code_margin_top': 10, 'code_margin_bottom': 10, 'code_bg_color': '#f5f5f5',
+        'keyword_color': '#0000ff', 'string_color': '#a31515', 'comment_color': '#008000',
+        'number_color': '#098658', 'function_color': '#795e26',
+        'compile_mode': 'fast', 'code_renderer': 'verbatim',
+    }
+    corpus = {
+        'small': SMALL_DOCUMENT,
+        'report': '# Nightly report\n\n' + ''.join(
+            f'## Job {i}\n\nJob **{i}** loaded `{i * 10}` rows.\n\n'
+            f'```sql\nSELECT id, SUM(amount) FROM sales_{i} WHERE day = {i} GROUP BY id;\n```\n\n'
+            for i in range(50)
+        ),
+    }
+    if shutil.which('pandoc') is None:
+        print('  pandoc not installed, skipped')
+        return
+
+    for engine in latex.PDF_ENGINES:
+        if not latex.engine_installed(engine):
+            print(f'  {engine:<40} not installed')
+            continue
+        for label, md_text in corpus.items():
+            engine_settings = dict(settings, pdf_engine=engine)
+            report(f'{engine}, {label}', timed(lambda: latex.convert_md_to_pdf(md_text, engine_settings), repeat=3))
+
+
+def bench_pdf_optimize():
+    """Size and time of the PDF optimization profiles on the pisa and reportlab output of a report"""
+    import pdf_tools
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    settings = dict(ARTIFACT_SETTINGS, code_layout='lines')
+    md_text = '# Nightly report\n\n' + ''.join(
+        f'## Job {i}\n\nJob **{i}** loaded `{i * 10}` rows.\n\n'
+        f'```sql\nSELECT id, SUM(amount) FROM sales_{i} WHERE day = {i} GROUP BY id;\n```\n\n'
+        '| step | rows |\n|---|---|\n' + ''.join(f'| step {j} | {i * j} |\n' for j in range(5)) + '\n'
+        for i in range(50)
+    )
+    profile = artifact.get_render_profile(settings)
+    pisa_pdf = BytesIO()
+    pisa.CreatePDF(
+        (profile['head'] + artifact.process_markdown(md_text) + profile['tail']).encode('utf-8'),
+        dest=pisa_pdf, encoding='utf-8', path='', default_css=profile['default_css']
+    )
+    outputs = {'pisa': pisa_pdf.getvalue(), 'reportlab': artifact.render_pdf_reportlab(md_text, settings)}
+
+    for label, pdf_content in outputs.items():
+        for name in pdf_tools.OPTIMIZE_PROFILES:
+            optimized = pdf_tools.optimize_pdf(pdf_content, name)
+            ms = timed(lambda: pdf_tools.optimize_pdf(pdf_content, name), repeat=3)
+            report(f'{label}, {name} ({len(pdf_content) // 1024} -> {len(optimized) // 1024} KB)', ms)
+
+
+def bench_fonts():
+    """Font discovery and parsing versus per-request render time with and without the DejaVu faces"""
+    import fonts
+    from reportlab.pdfbase.ttfonts import TTFont
+    from xhtml2pdf.default import DEFAULT_FONT
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+
+    file_names = [name for styles in fonts.FONT_FILES.values() for name in styles.values()]
+    report('discover font files', timed(lambda: fonts.find_font_files(file_names), repeat=5))
+    paths = list(fonts.font_paths.values())
+    report(f'parse {len(paths)} TTF files (once per process)', timed(
+        lambda: [TTFont(f'bench-{index}', path) for index, path in enumerate(paths)], repeat=3
+    ))
+
+    profile = artifact.get_render_profile(ARTIFACT_SETTINGS)
+    html = (profile['head'] + artifact.process_markdown(SMALL_DOCUMENT * 20) + profile['tail']).encode('utf-8')
+
+    def render():
+        pisa.CreatePDF(html, dest=BytesIO(), encoding='utf-8', path='', default_css=profile['default_css'])
+
+    report('pisa, registered DejaVu', timed(render, repeat=5))
+    registered = {family.lower(): DEFAULT_FONT.pop(family.lower(), None) for family in fonts.FONT_FILES}
+    try:
+        report('pisa, standard PDF fonts', timed(render, repeat=5))
+    finally:
+        DEFAULT_FONT.update({key: value for key, value in registered.items() if value})
+
+
+def legacy_heading_scan(md_text):
+    """Headings found by rescanning the text line by line, skipping code fences"""
+    headings = []
+    in_fence = False
+    for line in md_text.split('\n'):
+        if line.lstrip().startswith(('```', '~~~')):
+            in_fence = not in_fence
+        elif not in_fence:
+            match = re.match(r'^(#{1,6})\s+(.+)$', line)
+            if match:
+                headings.append((len(match.group(1)), match.group(2).strip()))
+    return headings
+
+
+def bench_toc():
+    """Heading index versus a text rescan, and outline/TOC rendering of 1,200 headings"""
+    import docmodel
+    from xhtml2pdf import pisa
+    artifact = load_app('claude-artifact2pdf.py')
+    md_text = '# Runbook\n\n' + ''.join(
+        f'## Service {i}\n\nOwner **team {i % 7}**.\n\n### Checks {i}\n\n'
+        f'```sql\nSELECT status FROM checks_{i};\n```\n\n'
+        for i in range(600)
+    )
+    document = docmodel.parse_document(md_text)
+    print(f'  {"headings":<40} {len(docmodel.heading_index(document)):10d}')
+    report('rescan text for headings', timed(lambda: legacy_heading_scan(md_text), repeat=5))
+    report('heading index, cold document cache', timed(
+        lambda: (docmodel.parsed_documents.clear(), docmodel.heading_index(docmodel.parse_document(md_text))),
+        repeat=5
+    ))
+    report('heading index, warm document cache', timed(
+        lambda: docmodel.heading_index(docmodel.parse_document(md_text)), repeat=5
+    ))
+
+    settings = dict(ARTIFACT_SETTINGS, code_layout='compact')
+    profile = artifact.get_render_profile(settings)
+    for toc in artifact.TOC_MODES:
+        def render_pisa():
+            html = profile['head'] + artifact.process_markdown(md_text, True, 'compact', toc=toc) + profile['tail']
+            pisa.CreatePDF(html.encode('utf-8'), dest=BytesIO(), encoding='utf-8', path='',
+                                    default_css=profile['default_css'])
+
+        report(f'pisa, toc {toc}', timed(render_pisa, repeat=1))
+        toc_settings = dict(settings, toc=toc)
+        report(f'reportlab, toc {toc}', timed(lambda: artifact.render_pdf_reportlab(md_text, toc_settings), repeat=1))
+
+
+def bench_worker_recycling():
+    """pisa in this process versus in recyclable workers: job time, RSS growth and restart cost"""
+    import metrics
+    import workers
+    artifact = load_app('claude-artifact2pdf.py')
+    profile = artifact.get_render_profile(ARTIFACT_SETTINGS)
+    html = (profile['head'] + artifact.process_markdown(SMALL_DOCUMENT * 20) + profile['tail']).encode('utf-8')
+    default_css = profile['default_css']
+
+    rss_before = workers.current_rss()
+    report('in process', timed(lambda: workers.pisa_to_pdf(html, default_css), repeat=20))
+    print(f'  {"in process: RSS growth (MB)":<40} {(workers.current_rss() - rss_before) / 2 ** 20:10.1f}')
+
+    for max_jobs in (5, 1000):
+        pool = workers.RecyclingWorkerPool(1, max_jobs=max_jobs, name=f'bench{max_jobs}')
+        try:
+            report(f'worker, recycled every {max_jobs} jobs', timed(
+                lambda: pool.submit(workers.pisa_to_pdf, html, default_css).result(), repeat=20
+            ))
+            print(f'  {"  worker RSS after the last job (MB)":<40} {pool.slots[0]["rss"] / 2 ** 20:10.1f}')
+        finally:
+            pool.shutdown()
+    start = metrics.snapshot()['timings'].get('workers.bench5.start')
+    if start:
+        report('worker start (mean)', start['mean_ms'])
+
+
+def bench_render_queue():
+    """Submit, claim and finish 500 jobs (half of them duplicates) on the memory and SQLite queues"""
+    import render_queue
+
+    def cycle(queue):
+        for i in range(1000):
+            queue.submit(f'job-{i // 2}', {'filename': f'{i // 2}.pdf'})
+        while True:
+            job = queue.claim('bench')
+            if job is None:
+                break
+            queue.finish(job.id, b'%PDF-')
+
+    report('memory queue', timed(lambda: cycle(render_queue.MemoryQueue()), repeat=3))
+    with tempfile.TemporaryDirectory() as directory:
+        paths = iter(range(10))
+        report('SQLite queue', timed(
+            lambda: cycle(render_queue.SqliteQueue(os.path.join(directory, f'queue-{next(paths)}.db'))), repeat=3
+        ))
+
+
+def bench_result_store():
+    """On-disk result store: write, lookup and read of a 100 KB PDF, and a collection over 1,000 entries"""
+    import hashlib
+    import result_store
+
+    def lock_and_release():
+        with result_store.key_lock(key):
+            pass
+
+    directory = result_store.RESULT_STORE_DIR
+    with tempfile.TemporaryDirectory() as store_dir:
+        result_store.RESULT_STORE_DIR = store_dir
+        try:
+            pdf_content = b'%PDF-' + os.urandom(100 * 1024)
+            keys = iter(hashlib.sha256(str(i).encode()).hexdigest() for i in range(10 ** 6))
+            report('save (atomic write)', timed(lambda: result_store.save(next(keys), pdf_content, 'doc.pdf')))
+            key = next(keys)
+            result_store.save(key, pdf_content, 'doc.pdf')
+            report('lookup (hit)', timed(lambda: result_store.lookup(key).file.close()))
+            report('load (hit)', timed(lambda: result_store.load(key)))
+            report('key lock and release', timed(lock_and_release))
+            for _ in range(1000):
+                result_store.save(next(keys), b'%PDF-', 'doc.pdf')
+            report('collect garbage, 1,000 entries', timed(
+                lambda: result_store.collect_garbage(max_bytes=10 ** 12), repeat=5
+            ))
+        finally:
+            result_store.RESULT_STORE_DIR = directory
+
+
+BENCHMARKS = {
+    'profile_cache': bench_profile_cache,
+    'streaming': bench_streaming,
+    'unicode_cleaning': bench_unicode_cleaning,
+    'list_formatting': bench_list_formatting,
+    'code_layout': bench_code_layout,
+    'large_tables': bench_large_tables,
+    'reportlab_backend': bench_reportlab_backend,
+    'document_model': bench_document_model,
+    'parallel_highlighting': bench_parallel_highlighting,
+    'lexers': bench_lexers,
+    'verbatim_code': bench_verbatim_code,
+    'latex_engines': bench_latex_engines,
+    'pdf_optimize': bench_pdf_optimize,
+    'fonts': bench_fonts,
+    'toc': bench_toc,
+    'worker_recycling': bench_worker_recycling,
+    'render_queue': bench_render_queue,
+    'result_store': bench_result_store,
+}
+
+
+def main():
+    logging.disable(logging.WARNING)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f'{name}: {BENCHMARKS[name].__doc__}')
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
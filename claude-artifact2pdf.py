@@ -1,56 +1,95 @@
-from flask import Flask, render_template_string, request, send_file
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, jsonify, render_template_string, request, send_file
 import markdown
+from html import escape
 from io import BytesIO
 import re
-from xhtml2pdf import pisa
+import tempfile
+from xml.etree.ElementTree import Element
+from reportlab import rl_config
+from reportlab.lib.colors import HexColor, white
+from reportlab.lib.enums import TA_JUSTIFY, TA_LEFT
+from reportlab.lib.pagesizes import A3, A4, legal, letter
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.platypus import (
+    HRFlowable, ListFlowable, ListItem, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle,
+    XPreformatted
+)
+from reportlab.platypus.tableofcontents import TableOfContents
+from xhtml2pdf.default import DEFAULT_CSS
+
+from css_cache import install_css_parse_cache
+from docmodel import FENCE_OPEN_PATTERN, has_callout, heading_index, largest_table_rows, parse_document
+from fonts import font_names, register_fonts
+from highlighters import highlight_blocks
+import metrics
+from pdf_tools import merge_pdfs, optimize_pdf
+from preview import render_preview
+import result_store
+from results import (
+    DEFAULT_THUMBNAIL_DPI, RESULT_MAX_AGE, clamp_dpi, get_result, get_thumbnail, result_key,
+    result_summary, save_result
+)
+from uploads import (
+    MAX_CONTENT_LENGTH, detect_compression, input_hash, input_size, open_markdown_input,
+    read_first_header_line, read_markdown_text, spool_stream, text_lines
+)
+from workers import WorkerCrashed, convert_html, pool_stats
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+# Fixed creation dates and document IDs in every reportlab/pisa PDF, so the
+# same request always produces the same bytes
+rl_config.invariant = 1
+
+# Parse the DejaVu fonts the CSS asks for once, at startup, instead of
+# letting pisa fall back to Times and Courier
+register_fonts()
 
 
 def extract_first_header(md_text):
     """Extract the first header from markdown text for use as filename"""
-    # Match headers (# Header, ## Header, etc.)
-    header_pattern = r'^#{1,6}\s+(.+?)$'
-    match = re.search(header_pattern, md_text, re.MULTILINE)
+    # The document model finds the first header outside code fences, with
+    # inline formatting (bold, italic, links, etc.) already removed
+    header_text = parse_document(md_text).title
     
-    if match:
-        header_text = match.group(1).strip()
-        # Remove any markdown formatting from header (bold, italic, links, etc.)
-        header_text = re.sub(r'\*\*(.+?)\*\*', r'\1', header_text)  # Bold
-        header_text = re.sub(r'\*(.+?)\*', r'\1', header_text)      # Italic
-        header_text = re.sub(r'__(.+?)__', r'\1', header_text)      # Bold
-        header_text = re.sub(r'_(.+?)_', r'\1', header_text)        # Italic
-        header_text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', header_text)  # Links
-        header_text = re.sub(r'`(.+?)`', r'\1', header_text)        # Inline code
-        
-        # Clean up for filename (remove invalid characters)
-        filename = re.sub(r'[<>:"/\\|?*]', '', header_text)
-        filename = filename.strip()
-        
-        # Limit filename length
-        if len(filename) > 100:
-            filename = filename[:100].rsplit(' ', 1)[0]
-        
-        return filename if filename else 'document'
+    # Clean up for filename (remove invalid characters)
+    filename = re.sub(r'[<>:"/\\|?*]', '', header_text)
+    filename = filename.strip()
+    
+    # Limit filename length
+    if len(filename) > 100:
+        filename = filename[:100].rsplit(' ', 1)[0]
     
-    return 'document'
+    return filename if filename else 'document'
 
 
 def generate_css(settings):
     """Generate CSS based on user settings"""
+    return generate_page_css(settings) + generate_rules_css(settings)
+
+
+def generate_page_css(settings):
+    """Generate the @page rule, which xhtml2pdf applies to its conversion context"""
+    return f'''
+    @page {{
+        size: {settings['page_size']};
+        margin: {settings['page_margin']}cm;
+    }}
+    '''
+
+
+def generate_rules_css(settings):
+    """Generate the element rules, which parse without touching the conversion context"""
     base_size = settings['base_font_size']
     h1_size = base_size * 2
     h2_size = base_size * 1.4
     h3_size = base_size * 1.2
-    page_size = settings['page_size']
     wrap_behavior = 'pre-wrap' if settings['enable_wrap'] else 'pre'
-    
-    return f'''
-    @page {{
-        size: {page_size};
-        margin: {settings['page_margin']}cm;
-    }}
 
+    return f'''
     * {{
         margin: 0;
         padding: 0;
@@ -149,6 +188,25 @@ def generate_css(settings):
         word-wrap: break-word;
     }}
 
+    .code-chunk {{
+        font-family: 'DejaVu Sans Mono', 'DejaVu Sans', 'Consolas', 'Monaco', 'Courier New', monospace;
+        font-size: {settings['code_font_size']}pt;
+        line-height: 1.4;
+        white-space: {wrap_behavior};
+        padding: 0 {settings['code_padding_horizontal']}px !important;
+        margin: 0 !important;
+    }}
+
+    .code-chunk-first {{
+        padding-top: {settings['code_padding_vertical']}px !important;
+        margin-top: {settings['code_margin_top']}px !important;
+    }}
+
+    .code-chunk-last {{
+        padding-bottom: {settings['code_padding_vertical']}px !important;
+        margin-bottom: {settings['code_margin_bottom']}px !important;
+    }}
+
     .sql-keyword {{
         color: {settings['keyword_color']};
         font-weight: bold;
@@ -231,6 +289,10 @@ def generate_css(settings):
         background-color: #f9f9f9;
     }}
 
+    table.table-chunk {{
+        margin: 0;
+    }}
+
     ul, ol {{
         margin-left: 25px;
         margin-bottom: 10px;
@@ -287,6 +349,26 @@ def generate_css(settings):
         margin: 10px 0;
         border-radius: 3px;
     }}
+
+    .toc {{
+        margin-bottom: 20px;
+    }}
+
+    .toc p {{
+        margin-bottom: 3px;
+        text-align: left;
+    }}
+
+    .toc a {{
+        color: #2c3e50;
+        text-decoration: none;
+    }}
+
+    .toc-depth-1 {{ margin-left: 15px; }}
+    .toc-depth-2 {{ margin-left: 30px; }}
+    .toc-depth-3 {{ margin-left: 45px; }}
+    .toc-depth-4 {{ margin-left: 60px; }}
+    .toc-depth-5 {{ margin-left: 75px; }}
     '''
 
 
@@ -307,315 +389,681 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
-
-def highlight_sql(code):
-    """LaTeX-quality SQL syntax highlighting"""
-    keywords = [
-        'SELECT', 'FROM', 'WHERE', 'INSERT', 'UPDATE', 'DELETE', 'CREATE', 'DROP', 'ALTER',
-        'TABLE', 'DATABASE', 'INDEX', 'VIEW', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER',
-        'FULL', 'CROSS', 'ON', 'USING', 'AS', 'AND', 'OR', 'NOT', 'NULL', 'IS', 'IN',
-        'BETWEEN', 'LIKE', 'ORDER', 'BY', 'GROUP', 'HAVING', 'LIMIT', 'OFFSET', 'DISTINCT',
-        'UNION', 'ALL', 'INTERSECT', 'EXCEPT', 'EXISTS', 'CASE', 'WHEN', 'THEN', 'ELSE',
-        'END', 'IF', 'WITH', 'RECURSIVE', 'ASC', 'DESC', 'INTO', 'VALUES', 'SET', 'DEFAULT',
-        'PRIMARY', 'KEY', 'FOREIGN', 'REFERENCES', 'CONSTRAINT', 'UNIQUE', 'CHECK',
-        'AUTO_INCREMENT', 'SERIAL', 'AUTOINCREMENT', 'IDENTITY', 'RETURNS', 'BEGIN',
-        'COMMIT', 'ROLLBACK', 'TRANSACTION', 'GRANT', 'REVOKE', 'CASCADE', 'RESTRICT',
-        'INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT', 'DECIMAL', 'NUMERIC', 'FLOAT',
-        'REAL', 'DOUBLE', 'VARCHAR', 'CHAR', 'TEXT', 'BLOB', 'DATE', 'TIME', 'DATETIME',
-        'TIMESTAMP', 'BOOLEAN', 'BOOL', 'ENUM', 'JSON', 'ARRAY'
-    ]
-    functions = [
-        'COUNT', 'SUM', 'AVG', 'MAX', 'MIN', 'CONCAT', 'UPPER', 'LOWER', 'LENGTH',
-        'SUBSTRING', 'TRIM', 'ROUND', 'FLOOR', 'CEIL', 'ABS', 'NOW', 'CURRENT_DATE',
-        'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'DATE', 'TIME', 'YEAR', 'MONTH', 'DAY',
-        'COALESCE', 'NULLIF', 'CAST', 'CONVERT'
-    ]
-    
-    result = code
-    comment_placeholder = {}
-    comment_counter = 0
-    
-    matches = list(re.finditer(r'--[^\n]*', result))
-    for match in reversed(matches):
-        placeholder = f'___COMMENT_{comment_counter}___'
-        comment_text = match.group(0).rstrip('\n')
-        comment_placeholder[placeholder] = f'<span class="sql-comment">{comment_text}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        comment_counter += 1
-    
-    matches = list(re.finditer(r'/\*.*?\*/', result, re.DOTALL))
-    for match in reversed(matches):
-        placeholder = f'___COMMENT_{comment_counter}___'
-        comment_placeholder[placeholder] = f'<span class="sql-comment">{match.group(0)}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        comment_counter += 1
-    
-    string_placeholder = {}
-    string_counter = 0
-    
-    matches = list(re.finditer(r"'(?:[^'\\]|\\.)*'", result))
-    for match in reversed(matches):
-        placeholder = f'___STRING_{string_counter}___'
-        string_placeholder[placeholder] = f'<span class="sql-string">{match.group(0)}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        string_counter += 1
-    
-    result = re.sub(r'\b(\d+\.?\d*)\b', r'<span class="sql-number">\1</span>', result)
-    
-    for func in functions:
-        result = re.sub(
-            r'\b(' + func + r')\s*\(',
-            r'<span class="sql-function">\1</span>(',
-            result,
-            flags=re.IGNORECASE
-        )
-    
-    for keyword in keywords:
-        result = re.sub(
-            r'\b(' + keyword + r')\b',
-            r'<span class="sql-keyword">\1</span>',
-            result,
-            flags=re.IGNORECASE
-        )
-    
-    for placeholder, original in string_placeholder.items():
-        result = result.replace(placeholder, original)
-    
-    for placeholder, original in comment_placeholder.items():
-        result = result.replace(placeholder, original)
+CONTENT_MARKER = '<!--content-->'
+MAX_CACHED_PROFILES = 32
+
+# Inputs above STREAM_THRESHOLD are converted in block groups of about
+# BLOCK_GROUP_CHARS, so peak memory follows the largest group, not the document
+STREAM_THRESHOLD = 1024 * 1024
+BLOCK_GROUP_CHARS = 256 * 1024
+CODE_CHUNK_LINES = 50
+
+# Table of contents: 'links' is built from the heading index and needs no
+# extra layout pass; 'pages' adds page numbers at the cost of a second pass
+TOC_MODES = ('none', 'links', 'pages')
+PISA_TOC = '<div class="toc"><pdf:toc /></div>'
+
+# /merge renders up to MAX_MERGE_DOCUMENTS documents, MERGE_WORKERS at a time
+MAX_MERGE_DOCUMENTS = 50
+MERGE_WORKERS = 4
+
+# Tables with more body rows than LARGE_TABLE_ROWS are split into page-sized pieces
+LARGE_TABLE_ROWS = 100
+TABLE_ROWS_PER_PAGE = 40
+POINTS_PER_CM = 28.35
+PAGE_HEIGHTS_CM = {'A4': 29.7, 'Letter': 27.9, 'Legal': 35.6, 'A3': 42.0}
+TABLE_PATTERN = re.compile(r'<table>\s*(<thead>.*?</thead>)\s*<tbody>(.*?)</tbody>\s*</table>', re.DOTALL)
+TABLE_ROW_PATTERN = re.compile(r'<tr>.*?</tr>', re.DOTALL)
+HTML_SPOOL_SIZE = 8 * 1024 * 1024
+LIST_ITEM_PATTERN = re.compile(r'[ \t]*(?:[-*+]|\d+\.)[ \t]')
+
+# Direct reportlab backend: CSS px are converted to points, fonts are the
+# DejaVu faces the HTML path draws with (standard PDF faces without them)
+PX = 0.75
+BODY_FONT, BODY_FONT_BOLD, BODY_FONT_ITALIC = font_names(
+    'DejaVu Sans', ('Times-Roman', 'Times-Bold', 'Times-Italic')
+)
+MONO_FONT, MONO_FONT_BOLD, MONO_FONT_ITALIC = font_names(
+    'DejaVu Sans Mono', ('Courier', 'Courier-Bold', 'Courier-Oblique')
+)
+REPORTLAB_PAGE_SIZES = {'A4': A4, 'Letter': letter, 'Legal': legal, 'A3': A3}
+CALLOUTS = {
+    '⚠️': ('Warning:', '#fff3cd', '#ffc107'),
+    '✓': ('Best Practice:', '#d4edda', '#28a745'),
+    '✗': ('Common Mistake:', '#f8d7da', '#dc3545'),
+    '💡': ('Info:', '#d1ecf1', '#0c5460'),
+}
+BLOCK_TAGS = {'p', 'ul', 'ol', 'pre', 'blockquote', 'table', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'div'}
+HTML_PLACEHOLDER_PATTERN = re.compile('\x02wzxhzdk:(\\d+)\x03')
+SPAN_OPEN_PATTERN = re.compile(r'<span class="([\w-]+)">')
+SPAN_TAG_PATTERN = re.compile(r'<span class="[\w-]+">|</span>')
+# Leading spaces and runs of spaces, which a wrapping Paragraph would collapse
+CODE_SPACES_PATTERN = re.compile(r'^ +| {2,}')
+
+# Tree-drawing characters mapped to ASCII (multi-character runs such as
+# '├──' map character by character to the same '|--')
+BOX_DRAWING_TABLE = str.maketrans({'├': '|', '└': '`', '│': '|', '─': '-'})
+
+render_profiles = {}
+
+install_css_parse_cache()
+
+
+def settings_key(settings):
+    """Hashable key identifying a settings profile"""
+    return tuple(sorted(settings.items()))
+
+
+def get_render_profile(settings):
+    """Return the conversion profile (stylesheets and HTML shell) for these settings.
+
+    The element rules travel as pisa's default CSS so their parsed form is cached,
+    while the small @page rule stays in the document and is parsed per render.
+    """
+    key = settings_key(settings)
+    profile = render_profiles.get(key)
+    if profile is None:
+        page_css = generate_page_css(settings)
+        shell = app.jinja_env.from_string(HTML_TEMPLATE).render(css=page_css, content=CONTENT_MARKER)
+        head, tail = shell.split(CONTENT_MARKER)
+        profile = {
+            'default_css': DEFAULT_CSS + generate_rules_css(settings),
+            'head': head,
+            'tail': tail,
+        }
+        if len(render_profiles) >= MAX_CACHED_PROFILES:
+            render_profiles.pop(next(iter(render_profiles)))
+        render_profiles[key] = profile
+    return profile
+
+
+def layout_code_lines(lines):
+    """One block box per source line (the original layout)"""
+    html_lines = ''.join(f'<div class="code-line">{line if line.strip() else " "}</div>' for line in lines)
+    return f'<pre class="code-block">{html_lines}</pre>'
+
+
+def code_chunks(lines):
+    """Split highlighted lines into runs of CODE_CHUNK_LINES lines.
+
+    A highlighter span can cover several lines (a /* ... */ comment), so spans
+    still open at the end of a run are closed there and reopened at the start
+    of the next, keeping every run well-formed on its own.
+    """
+    chunks = []
+    open_spans = []
+    for start in range(0, len(lines), CODE_CHUNK_LINES):
+        chunk = lines[start:start + CODE_CHUNK_LINES]
+        reopened = ''.join(open_spans)
+        for line in chunk:
+            for tag in SPAN_TAG_PATTERN.findall(line):
+                if tag != '</span>':
+                    open_spans.append(tag)
+                elif open_spans:
+                    open_spans.pop()
+        chunk[0] = reopened + chunk[0]
+        if open_spans:
+            chunk[-1] += '</span>' * len(open_spans)
+        chunks.append(chunk)
+    return chunks
+
+
+def layout_code_compact(lines):
+    """Preformatted runs of CODE_CHUNK_LINES lines with inline spans.
+
+    A 5,000-line block becomes 100 boxes instead of 5,000. Blank lines are
+    kept as a single space so the raw HTML block never contains an empty line.
+    """
+    chunks = code_chunks(lines)
+    html = []
+    for index, chunk in enumerate(chunks):
+        classes = 'code-chunk'
+        if index == 0:
+            classes += ' code-chunk-first'
+        if index == len(chunks) - 1:
+            classes += ' code-chunk-last'
+        text = '\n'.join(line if line.strip() else ' ' for line in chunk)
+        html.append(f'<pre class="{classes}">{text}</pre>')
+    return ''.join(html)
+
+
+CODE_LAYOUTS = {
+    'lines': layout_code_lines,
+    'compact': layout_code_compact,
+}
+
+
+def process_code_blocks(md_text, enable_wrap=True, code_layout='lines', anchors=False):
+    """Process all code blocks in markdown, optionally anchoring every heading for the TOC links"""
+    layout = CODE_LAYOUTS.get(code_layout, layout_code_lines)
+    document = parse_document(md_text)
+    blocks = document.blocks
+    headings = iter(heading_index(document)) if anchors else None
     
-    return result
-
-
-def highlight_python(code, is_pyspark=False):
-    """LaTeX-quality Python/PySpark syntax highlighting"""
-    keywords = [
-        'def', 'class', 'import', 'from', 'as', 'if', 'elif', 'else', 'for', 'while',
-        'return', 'try', 'except', 'finally', 'with', 'lambda', 'yield', 'async', 'await',
-        'pass', 'break', 'continue', 'and', 'or', 'not', 'in', 'is', 'None', 'True', 'False',
-        'raise', 'assert', 'del', 'global', 'nonlocal'
+    # Collect every fence first so the highlighter can run them in parallel
+    fences = [
+        (escape(block.content.strip('\n').translate(BOX_DRAWING_TABLE), quote=False), block.info)
+        for block in blocks if block.kind == 'fence'
     ]
-    builtins = [
-        'print', 'len', 'range', 'str', 'int', 'float', 'list', 'dict', 'set', 'tuple',
-        'open', 'input', 'type', 'isinstance', 'enumerate', 'zip', 'map', 'filter', 'sum',
-        'max', 'min', 'sorted', 'reversed', 'all', 'any', 'abs', 'round', 'pow'
-    ]
-    
-    # PySpark specific keywords and functions
-    if is_pyspark:
-        builtins.extend([
-            'SparkSession', 'SparkContext', 'SQLContext', 'HiveContext',
-            'DataFrame', 'Column', 'Row', 'GroupedData',
-            'select', 'filter', 'where', 'groupBy', 'orderBy', 'sortBy',
-            'join', 'union', 'distinct', 'drop', 'dropDuplicates',
-            'withColumn', 'withColumnRenamed', 'alias', 'cast',
-            'agg', 'count', 'collect', 'show', 'printSchema', 'describe',
-            'read', 'write', 'csv', 'json', 'parquet', 'orc', 'jdbc',
-            'createDataFrame', 'createOrReplaceTempView', 'sql',
-            'cache', 'persist', 'unpersist', 'checkpoint', 'repartition', 'coalesce',
-            'broadcast', 'accumulator', 'parallelize',
-            'map', 'flatMap', 'reduceByKey', 'groupByKey', 'sortByKey',
-            'col', 'lit', 'when', 'otherwise', 'isnull', 'isnan',
-            'concat', 'concat_ws', 'substring', 'trim', 'lower', 'upper',
-            'split', 'explode', 'array', 'struct', 'to_date', 'to_timestamp',
-            'datediff', 'date_add', 'date_sub', 'year', 'month', 'dayofmonth',
-            'window', 'partitionBy', 'over', 'rowNumber', 'rank', 'dense_rank',
-            'lag', 'lead', 'first', 'last', 'collect_list', 'collect_set',
-            'approx_count_distinct', 'countDistinct', 'sumDistinct',
-            'udf', 'pandas_udf', 'PandasUDFType'
-        ])
-    
-    result = code
-    comment_placeholder = {}
-    comment_counter = 0
-    
-    matches = list(re.finditer(r'#[^\n]*', result))
-    for match in reversed(matches):
-        placeholder = f'___COMMENT_{comment_counter}___'
-        comment_text = match.group(0).rstrip('\n')
-        comment_placeholder[placeholder] = f'<span class="py-comment">{comment_text}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        comment_counter += 1
-    
-    string_placeholder = {}
-    string_counter = 0
-    
-    matches = list(re.finditer(r'"""(?:[^"\\]|\\.)*?"""|\'\'\'(?:[^\'\\]|\\.)*?\'\'\'', result, re.DOTALL))
-    for match in reversed(matches):
-        placeholder = f'___STRING_{string_counter}___'
-        string_placeholder[placeholder] = f'<span class="py-string">{match.group(0)}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        string_counter += 1
+    highlighted = iter(highlight_blocks(fences))
     
-    matches = list(re.finditer(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'', result))
-    for match in reversed(matches):
-        placeholder = f'___STRING_{string_counter}___'
-        string_placeholder[placeholder] = f'<span class="py-string">{match.group(0)}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        string_counter += 1
-    
-    result = re.sub(r'(@\w+)', r'<span class="py-decorator">\1</span>', result)
-    result = re.sub(r'\b(\d+\.?\d*)\b', r'<span class="py-number">\1</span>', result)
-    
-    for keyword in keywords:
-        result = re.sub(r'\b(' + keyword + r')\b', r'<span class="py-keyword">\1</span>', result)
-    
-    for builtin in builtins:
-        result = re.sub(r'\b(' + builtin + r')\b', r'<span class="py-builtin">\1</span>', result)
-    
-    for placeholder, original in string_placeholder.items():
-        result = result.replace(placeholder, original)
-    
-    for placeholder, original in comment_placeholder.items():
-        result = result.replace(placeholder, original)
+    parts = []
+    for block in blocks:
+        if block.kind == 'fence':
+            parts.append(layout(next(highlighted).split('\n')))
+        elif block.kind == 'heading' and headings is not None:
+            parts.append(f'{"#" * block.info} <a name="{next(headings).anchor}"></a>{block.content}')
+        else:
+            parts.append(block.source)
     
-    return result
+    return '\n'.join(parts)
 
 
-def highlight_r(code):
-    """LaTeX-quality R syntax highlighting"""
-    keywords = [
-        'if', 'else', 'for', 'while', 'repeat', 'in', 'next', 'break',
-        'function', 'return', 'TRUE', 'FALSE', 'NULL', 'NA', 'NA_integer_',
-        'NA_real_', 'NA_complex_', 'NA_character_', 'Inf', 'NaN',
-        'library', 'require', 'source', 'setwd', 'getwd'
-    ]
-    builtins = [
-        'print', 'cat', 'paste', 'paste0', 'sprintf', 'format',
-        'c', 'list', 'vector', 'matrix', 'array', 'data.frame', 'tibble',
-        'length', 'nrow', 'ncol', 'dim', 'names', 'colnames', 'rownames',
-        'head', 'tail', 'str', 'summary', 'class', 'typeof', 'mode',
-        'sum', 'mean', 'median', 'sd', 'var', 'min', 'max', 'range',
-        'abs', 'sqrt', 'log', 'log10', 'log2', 'exp', 'round', 'floor', 'ceiling',
-        'seq', 'rep', 'sort', 'order', 'rank', 'rev', 'unique', 'duplicated',
-        'which', 'any', 'all', 'is.na', 'is.null', 'is.numeric', 'is.character',
-        'as.numeric', 'as.character', 'as.factor', 'as.Date', 'as.POSIXct',
-        'subset', 'merge', 'rbind', 'cbind', 'split', 'apply', 'lapply', 'sapply',
-        'mapply', 'tapply', 'aggregate', 'transform', 'within',
-        'read.csv', 'read.table', 'write.csv', 'write.table', 'readRDS', 'saveRDS',
-        'grep', 'grepl', 'sub', 'gsub', 'regexpr', 'strsplit', 'nchar', 'substr',
-        'tolower', 'toupper', 'trimws', 'chartr',
-        'factor', 'levels', 'nlevels', 'droplevels', 'cut', 'table', 'prop.table',
-        'plot', 'hist', 'boxplot', 'barplot', 'pie', 'lines', 'points', 'abline',
-        'ggplot', 'aes', 'geom_point', 'geom_line', 'geom_bar', 'geom_histogram',
-        'geom_boxplot', 'facet_wrap', 'facet_grid', 'theme', 'labs', 'ggtitle',
-        'mutate', 'select', 'filter', 'arrange', 'group_by', 'summarise', 'summarize',
-        'left_join', 'right_join', 'inner_join', 'full_join', 'anti_join', 'semi_join',
-        'bind_rows', 'bind_cols', 'pivot_longer', 'pivot_wider', 'gather', 'spread',
-        'rename', 'relocate', 'across', 'everything', 'starts_with', 'ends_with',
-        'contains', 'matches', 'num_range', 'where', 'pull', 'distinct', 'count',
-        'slice', 'slice_head', 'slice_tail', 'slice_min', 'slice_max', 'slice_sample',
-        'lm', 'glm', 'aov', 'anova', 't.test', 'chisq.test', 'cor', 'cov',
-        'predict', 'fitted', 'residuals', 'coef', 'confint',
-        'tryCatch', 'stop', 'warning', 'message', 'stopifnot'
-    ]
-    
-    result = code
-    comment_placeholder = {}
-    comment_counter = 0
-    
-    # R comments start with #
-    matches = list(re.finditer(r'#[^\n]*', result))
-    for match in reversed(matches):
-        placeholder = f'___COMMENT_{comment_counter}___'
-        comment_text = match.group(0).rstrip('\n')
-        comment_placeholder[placeholder] = f'<span class="py-comment">{comment_text}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        comment_counter += 1
-    
-    string_placeholder = {}
-    string_counter = 0
-    
-    # Double and single quoted strings
-    matches = list(re.finditer(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'', result))
-    for match in reversed(matches):
-        placeholder = f'___STRING_{string_counter}___'
-        string_placeholder[placeholder] = f'<span class="py-string">{match.group(0)}</span>'
-        result = result[:match.start()] + placeholder + result[match.end():]
-        string_counter += 1
-    
-    # Highlight numbers (including scientific notation)
-    result = re.sub(r'\b(\d+\.?\d*(?:[eE][+-]?\d+)?[Li]?)\b', r'<span class="py-number">\1</span>', result)
-    
-    # Highlight keywords
-    for keyword in keywords:
-        result = re.sub(r'\b(' + re.escape(keyword) + r')\b', r'<span class="py-keyword">\1</span>', result)
-    
-    # Highlight builtins/functions
-    for builtin in builtins:
-        result = re.sub(r'\b(' + re.escape(builtin) + r')\b', r'<span class="py-builtin">\1</span>', result)
-    
-    # Highlight assignment operators
-    result = re.sub(r'(&lt;-|&lt;&lt;-|-&gt;|-&gt;&gt;)', r'<span class="py-keyword">\1</span>', result)
-    result = re.sub(r'(<-|<<-|->|->>)', r'<span class="py-keyword">\1</span>', result)
-    
-    # Highlight pipe operators
-    result = re.sub(r'(%&gt;%|%&lt;&gt;%|\|&gt;)', r'<span class="sql-function">\1</span>', result)
-    result = re.sub(r'(%>%|%<>%|\|>)', r'<span class="sql-function">\1</span>', result)
-    
-    # Restore strings and comments
-    for placeholder, original in string_placeholder.items():
-        result = result.replace(placeholder, original)
-    
-    for placeholder, original in comment_placeholder.items():
-        result = result.replace(placeholder, original)
-    
-    return result
-
+def toc_html(headings):
+    """Table of contents linking to the anchored headings, laid out in the same pass as the text"""
+    entries = ''.join(
+        f'<p class="toc-depth-{heading.depth}"><a href="#{heading.anchor}">{escape(heading.title)}</a></p>'
+        for heading in headings
+    )
+    return f'<div class="toc">{entries}</div>' if entries else ''
 
-def process_code_blocks(md_text, enable_wrap=True):
-    """Process all code blocks in markdown"""
-    
-    def replace_code_block(match):
-        lang = match.group(1) if match.group(1) else ''
-        code = match.group(2).strip('\n')
-        lang_lower = lang.lower().strip()
-        
-        code = code.replace('├──', '|--')
-        code = code.replace('└──', '`--')
-        code = code.replace('├─', '|-')
-        code = code.replace('└─', '`-')
-        code = code.replace('│', '|')
-        code = code.replace('─', '-')
-        code = code.replace('├', '|')
-        code = code.replace('└', '`')
-        
-        if lang_lower in ['sql', 'mysql', 'postgresql', 'postgres', 'sqlite', 'tsql', 'plsql']:
-            highlighted = highlight_sql(code)
-        elif lang_lower in ['python', 'py', 'python3']:
-            highlighted = highlight_python(code, is_pyspark=False)
-        elif lang_lower in ['pyspark', 'spark']:
-            highlighted = highlight_python(code, is_pyspark=True)
-        elif lang_lower in ['r', 'rlang', 'rscript']:
-            highlighted = highlight_r(code)
-        else:
-            highlighted = code
-        
-        lines = highlighted.split('\n')
-        html_lines = ''.join(f'<div class="code-line">{line if line.strip() else " "}</div>' for line in lines)
-        return f'<pre class="code-block">{html_lines}</pre>'
-    
-    result = re.sub(r'```([a-zA-Z0-9]*)\n(.*?)\n```', replace_code_block, md_text, flags=re.DOTALL)
-    result = re.sub(r'```([a-zA-Z0-9]*)\n(.*?)```', replace_code_block, result, flags=re.DOTALL)
-    result = re.sub(r'```\s*([a-zA-Z0-9]*)\s*\n(.*?)```', replace_code_block, result, flags=re.DOTALL)
-    
-    return result
 
+def process_markdown(md_text, enable_wrap=True, code_layout='lines', table_rows=TABLE_ROWS_PER_PAGE, toc='none'):
+    """Convert markdown to HTML with syntax highlighting.
 
-def process_markdown(md_text, enable_wrap=True):
-    """Convert markdown to HTML with syntax highlighting"""
-    md_with_highlighted_code = process_code_blocks(md_text, enable_wrap)
+    toc 'links' puts a linked list of the headings in front of the text;
+    'pages' asks pisa for its table of contents with page numbers, which
+    costs pisa an extra layout pass.
+    """
+    md_with_highlighted_code = process_code_blocks(md_text, enable_wrap, code_layout, toc == 'links')
     html = markdown.markdown(md_with_highlighted_code, extensions=['tables', 'fenced_code'])
     html = re.sub(r'style="[^"]*"', '', html)
     
-    html = re.sub(r'<p><strong>⚠️[^<]*</strong>', r'<div class="warning"><strong>⚠️ Warning:</strong>', html)
-    html = re.sub(r'<p><strong>✓[^<]*</strong>', r'<div class="success"><strong>✓ Best Practice:</strong>', html)
-    html = re.sub(r'<p><strong>✗[^<]*</strong>', r'<div class="error"><strong>✗ Common Mistake:</strong>', html)
-    html = re.sub(r'<p><strong>💡[^<]*</strong>', r'<div class="info"><strong>💡 Info:</strong>', html)
+    # The document model says which of the HTML passes below have anything to do
+    document = parse_document(md_text)
+    if largest_table_rows(document) > LARGE_TABLE_ROWS:
+        html = paginate_large_tables(html, table_rows)
     
+    if has_callout(document, '⚠️'):
+        html = re.sub(r'<p><strong>⚠️[^<]*</strong>', r'<div class="warning"><strong>⚠️ Warning:</strong>', html)
+    if has_callout(document, '✓'):
+        html = re.sub(r'<p><strong>✓[^<]*</strong>', r'<div class="success"><strong>✓ Best Practice:</strong>', html)
+    if has_callout(document, '✗'):
+        html = re.sub(r'<p><strong>✗[^<]*</strong>', r'<div class="error"><strong>✗ Common Mistake:</strong>', html)
+    if has_callout(document, '💡'):
+        html = re.sub(r'<p><strong>💡[^<]*</strong>', r'<div class="info"><strong>💡 Info:</strong>', html)
+
+    if toc == 'links':
+        html = toc_html(heading_index(document)) + html
+    elif toc == 'pages':
+        html = PISA_TOC + html
     return html
 
 
+def table_rows_per_page(settings):
+    """Estimate how many table rows fit on one page with these settings"""
+    page_height_cm = PAGE_HEIGHTS_CM.get(settings['page_size'], PAGE_HEIGHTS_CM['A4'])
+    usable_pt = (page_height_cm - 2 * settings['page_margin']) * POINTS_PER_CM
+    # 1.2 line height plus 4px + 4px cell padding (0.75pt per px) and the border
+    row_pt = (settings['base_font_size'] - 1) * 1.2 + 6 + 1
+    return max(10, int(usable_pt / row_pt) - 2)
+
+
+def paginate_large_tables(html, rows_per_page=TABLE_ROWS_PER_PAGE):
+    """Split tables longer than LARGE_TABLE_ROWS into page-sized tables with repeated headers.
+
+    One huge table is a single block xhtml2pdf keeps trying to fit; page-sized
+    pieces each lay out once.
+    """
+    def split_table(match):
+        rows = TABLE_ROW_PATTERN.findall(match.group(2))
+        if len(rows) <= LARGE_TABLE_ROWS:
+            return match.group(0)
+        thead = match.group(1)
+        return ''.join(
+            f'<table class="table-chunk">{thead}<tbody>{"".join(rows[i:i + rows_per_page])}</tbody></table>'
+            for i in range(0, len(rows), rows_per_page)
+        )
+
+    return TABLE_PATTERN.sub(split_table, html)
+
+
+def iter_markdown_blocks(lines, max_chars=BLOCK_GROUP_CHARS):
+    """Group markdown lines into self-contained chunks of roughly max_chars.
+
+    Chunks are only cut before an unindented line that follows a blank line
+    outside a code fence, so fences, tables, lists and paragraphs stay whole.
+    """
+    group = []
+    size = 0
+    fence = None
+    previous_blank = False
+
+    for line in lines:
+        stripped = line.lstrip()
+        can_cut = (
+            fence is None
+            and previous_blank
+            and size >= max_chars
+            and line[:1] not in (' ', '\t', '\n', '\r')
+            and not LIST_ITEM_PATTERN.match(line)
+        )
+        if can_cut:
+            yield ''.join(group)
+            group = []
+            size = 0
+
+        if fence is None:
+            fence_match = FENCE_OPEN_PATTERN.match(line) if stripped[:1] in ('`', '~') else None
+            if fence_match:
+                fence = fence_match.group(1)
+        elif stripped.startswith(fence) and not stripped.strip().strip(fence[0]):
+            # Same closing rule as the document model
+            fence = None
+
+        group.append(line)
+        size += len(line)
+        previous_blank = not stripped
+
+    if group:
+        yield ''.join(group)
+
+
+def process_markdown_stream(lines, enable_wrap=True, code_layout='lines', table_rows=TABLE_ROWS_PER_PAGE,
+                            toc='none'):
+    """Convert markdown to HTML one block group at a time, yielding HTML fragments"""
+    # A streamed document's headings are not known up front, so any table
+    # of contents is pisa's, placed in the first fragment
+    group_toc = 'none' if toc == 'none' else 'pages'
+    for block in iter_markdown_blocks(lines):
+        yield process_markdown(block, enable_wrap, code_layout, table_rows, group_toc)
+        group_toc = 'none'
+
+
+def write_html_document(profile, fragments):
+    """Write the document shell around the HTML fragments into a spooled file"""
+    html_file = tempfile.SpooledTemporaryFile(max_size=HTML_SPOOL_SIZE)
+    html_file.write(profile['head'].encode('utf-8'))
+    for fragment in fragments:
+        html_file.write(fragment.encode('utf-8'))
+    html_file.write(profile['tail'].encode('utf-8'))
+    html_file.seek(0)
+    return html_file
+
+
+def markdown_element_tree(md_text, md=None):
+    """Run python-markdown up to its finished element tree, skipping serialization.
+
+    Passing the Markdown instance of the previous call reuses it instead of
+    building a new parser.
+    """
+    md = md.reset() if md is not None else markdown.Markdown(extensions=['tables'])
+    lines = md_text.split('\n')
+    for preprocessor in md.preprocessors:
+        lines = preprocessor.run(lines)
+    root = md.parser.parseDocument(lines).getroot()
+    for treeprocessor in md.treeprocessors:
+        new_root = treeprocessor.run(root)
+        if new_root is not None:
+            root = new_root
+    return root, md.htmlStash
+
+
+class FlowableBuilder:
+    """Build reportlab Platypus flowables from markdown, styled like generate_css"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        base = settings['base_font_size']
+        code_size = settings['code_font_size']
+        self.body_style = ParagraphStyle(
+            'body', fontName=BODY_FONT, fontSize=base, leading=base * 1.5,
+            textColor=HexColor('#1a1a1a'), alignment=TA_JUSTIFY,
+            spaceAfter=settings['paragraph_spacing'] * PX
+        )
+        self.heading_styles = {
+            'h1': ParagraphStyle('h1', self.body_style, fontName=BODY_FONT_BOLD, fontSize=base * 2,
+                                 leading=base * 2.4, textColor=HexColor('#2c3e50'), alignment=TA_LEFT,
+                                 spaceAfter=8 * PX, keepWithNext=1),
+            'h2': ParagraphStyle('h2', self.body_style, fontName=BODY_FONT_BOLD, fontSize=base * 1.4,
+                                 leading=base * 1.7, textColor=HexColor('#34495e'), alignment=TA_LEFT,
+                                 spaceBefore=20 * PX, spaceAfter=10 * PX, keepWithNext=1),
+            'h3': ParagraphStyle('h3', self.body_style, fontName=BODY_FONT_BOLD, fontSize=base * 1.2,
+                                 leading=base * 1.45, textColor=HexColor('#555555'), alignment=TA_LEFT,
+                                 spaceBefore=15 * PX, spaceAfter=8 * PX, keepWithNext=1),
+            'h4': ParagraphStyle('h4', self.body_style, fontName=BODY_FONT_BOLD, fontSize=base,
+                                 leading=base * 1.2, textColor=HexColor('#666666'), alignment=TA_LEFT,
+                                 spaceBefore=12 * PX, spaceAfter=6 * PX, keepWithNext=1),
+        }
+        for level in ('h5', 'h6'):
+            self.heading_styles[level] = self.heading_styles['h4']
+        self.cell_style = ParagraphStyle('cell', self.body_style, fontSize=base - 1,
+                                         leading=(base - 1) * 1.2, alignment=TA_LEFT, spaceAfter=0)
+        self.header_cell_style = ParagraphStyle('header-cell', self.cell_style, fontName=BODY_FONT_BOLD,
+                                                textColor=white)
+        self.toc_styles = [
+            ParagraphStyle(f'toc-{depth}', self.body_style, alignment=TA_LEFT, leftIndent=depth * 15 * PX,
+                           spaceAfter=3 * PX, textColor=HexColor('#2c3e50'))
+            for depth in range(6)
+        ]
+        self.next_heading = None
+        self.quote_style = ParagraphStyle('quote', self.body_style, fontName=BODY_FONT_ITALIC,
+                                          textColor=HexColor('#555555'), spaceAfter=0)
+        self.code_style = ParagraphStyle('code', fontName=MONO_FONT, fontSize=code_size,
+                                         leading=code_size * 1.4, textColor=HexColor('#000000'))
+        self.code_colors = {
+            'sql-keyword': (settings['keyword_color'], MONO_FONT_BOLD),
+            'sql-comment': (settings['comment_color'], MONO_FONT_ITALIC),
+            'sql-string': (settings['string_color'], MONO_FONT),
+            'sql-number': (settings['number_color'], MONO_FONT),
+            'sql-function': (settings['function_color'], MONO_FONT_BOLD),
+            'py-keyword': (settings['keyword_color'], MONO_FONT_BOLD),
+            'py-string': (settings['string_color'], MONO_FONT),
+            'py-number': (settings['number_color'], MONO_FONT),
+            'py-comment': (settings['comment_color'], MONO_FONT_ITALIC),
+            'py-function': (settings['function_color'], MONO_FONT),
+            'py-builtin': (settings['keyword_color'], MONO_FONT),
+            'py-decorator': ('#808080', MONO_FONT),
+        }
+
+    def build(self, md_text, toc='none'):
+        """Return the flowables for a whole markdown document.
+
+        Every heading starts a new prose group, so the heading index entry
+        it matches is known when its paragraph is built.
+        """
+        document = parse_document(md_text)
+        blocks = document.blocks
+        headings = heading_index(document)
+        next_headings = iter(headings)
+        fences = [
+            (escape(block.content.strip('\n').translate(BOX_DRAWING_TABLE), quote=False), block.info)
+            for block in blocks if block.kind == 'fence'
+        ]
+        highlighted = iter(zip(fences, highlight_blocks(fences)))
+
+        story = self.table_of_contents(headings, toc)
+        md = markdown.Markdown(extensions=['tables'])
+        prose = []
+        for block in blocks + [None]:
+            if block is not None and block.kind not in ('fence', 'heading'):
+                prose.append(block.source)
+                continue
+            if prose:
+                root, self.html_stash = markdown_element_tree('\n'.join(prose), md)
+                story.extend(self.blocks(root))
+                prose = []
+                self.next_heading = None
+            if block is None:
+                break
+            if block.kind == 'heading':
+                prose.append(block.source)
+                self.next_heading = next(next_headings)
+            else:
+                (code, _), markup = next(highlighted)
+                story.extend(self.code_block(code, markup))
+        return story
+
+    def table_of_contents(self, headings, toc):
+        """Flowables for the table of contents: linked titles, or reportlab's page-numbered TOC"""
+        if not headings or toc not in ('links', 'pages'):
+            return []
+        if toc == 'pages':
+            return [TableOfContents(levelStyles=self.toc_styles), Spacer(1, 20 * PX)]
+        entries = [
+            Paragraph(f'<a href="#{heading.anchor}">{escape(heading.title, quote=False)}</a>',
+                      self.toc_styles[heading.depth])
+            for heading in headings
+        ]
+        return entries + [Spacer(1, 20 * PX)]
+
+    def blocks(self, parent):
+        flowables = []
+        for element in parent:
+            flowables.extend(self.block(element))
+        return flowables
+
+    def block(self, element):
+        tag = element.tag
+        if tag in self.heading_styles:
+            heading, self.next_heading = self.next_heading, None
+            text = self.inline(element)
+            if heading is not None:
+                text = f'<a name="{heading.anchor}"/>{text}'
+            paragraph = Paragraph(text, self.heading_styles[tag])
+            paragraph.heading = heading
+            flowables = [paragraph]
+            if tag == 'h1':
+                flowables.append(HRFlowable(width='100%', thickness=2, color=HexColor('#3498db'),
+                                            spaceBefore=0, spaceAfter=15 * PX))
+            return flowables
+        if tag == 'p':
+            callout = self.callout(element)
+            if callout:
+                return [callout]
+            return [Paragraph(self.inline(element), self.body_style)]
+        if tag in ('ul', 'ol'):
+            return [self.list_flowable(element)]
+        if tag == 'blockquote':
+            quote = [Paragraph(self.inline(child), self.quote_style) if child.tag == 'p' else self.block(child)
+                     for child in element]
+            return [self.boxed(quote or [Paragraph('', self.quote_style)], '#f8f9fa', '#3498db')]
+        if tag == 'hr':
+            return [HRFlowable(width='100%', thickness=1, color=HexColor('#ecf0f1'),
+                               spaceBefore=15 * PX, spaceAfter=15 * PX)]
+        if tag == 'table':
+            return [self.table(element)]
+        if tag == 'pre':
+            code = element.find('code')
+            code = ''.join((code if code is not None else element).itertext())
+            return self.code_block(escape(code.strip('\n').translate(BOX_DRAWING_TABLE), quote=False))
+        if len(element):
+            return self.blocks(element)
+        text = self.inline(element)
+        return [Paragraph(text, self.body_style)] if text.strip() else []
+
+    def inline(self, element):
+        """Convert an element's content to reportlab paragraph markup"""
+        parts = [self.text(element.text)]
+        for child in element:
+            inner = self.inline(child)
+            tag = child.tag
+            if tag in ('strong', 'b'):
+                parts.append(f'<b><font color="#2c3e50">{inner}</font></b>')
+            elif tag in ('em', 'i'):
+                parts.append(f'<i>{inner}</i>')
+            elif tag == 'code':
+                parts.append(f'<font face="{MONO_FONT}">{inner}</font>')
+            elif tag == 'a':
+                href = escape(child.get('href', ''), quote=True)
+                parts.append(f'<a href="{href}" color="#3498db">{inner}</a>')
+            elif tag == 'br':
+                parts.append('<br/>')
+            elif tag == 'img':
+                parts.append(self.text(child.get('alt', '')))
+            else:
+                parts.append(inner)
+            parts.append(self.text(child.tail))
+        return ''.join(parts)
+
+    def text(self, value):
+        """Escape text, resolving raw HTML placeholders to their visible text"""
+        if not value:
+            return ''
+        value = HTML_PLACEHOLDER_PATTERN.sub(self.raw_html_text, value)
+        return escape(value, quote=False)
+
+    def raw_html_text(self, match):
+        index = int(match.group(1))
+        if index < len(self.html_stash.rawHtmlBlocks):
+            return re.sub(r'<[^>]+>', '', str(self.html_stash.rawHtmlBlocks[index]))
+        return ''
+
+    def callout(self, element):
+        """Render the ⚠️ ✓ ✗ 💡 lead-in paragraphs as coloured boxes"""
+        first = element[0] if len(element) else None
+        if first is None or first.tag != 'strong' or (element.text or '').strip():
+            return None
+        label = ''.join(first.itertext())
+        for marker, (title, background, border) in CALLOUTS.items():
+            if label.startswith(marker):
+                rest = self.text(first.tail) + ''.join(
+                    self.inline_child(child) for child in list(element)[1:]
+                )
+                markup = f'<b><font color="#2c3e50">{escape(title)}</font></b>{rest}'
+                return self.boxed([Paragraph(markup, ParagraphStyle('callout', self.body_style, spaceAfter=0))],
+                                  background, border)
+        return None
+
+    def inline_child(self, child):
+        wrapper = Element('span')
+        wrapper.append(child)
+        return self.inline(wrapper)
+
+    def boxed(self, flowables, background, border):
+        """Wrap flowables in a box with a coloured left border, like the CSS callouts"""
+        box = Table([[flowables]], colWidths=['100%'])
+        box.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, -1), HexColor(background)),
+            ('LINEBEFORE', (0, 0), (0, -1), 3 * PX, HexColor(border)),
+            ('LEFTPADDING', (0, 0), (-1, -1), 12 * PX),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 12 * PX),
+            ('TOPPADDING', (0, 0), (-1, -1), 8 * PX),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 8 * PX),
+        ]))
+        box.spaceBefore = box.spaceAfter = 10 * PX
+        return box
+
+    def list_flowable(self, element):
+        items = []
+        for li in element.findall('li'):
+            content = []
+            if (li.text or '').strip() or any(child.tag not in BLOCK_TAGS for child in li):
+                inline = Element('li')
+                inline.text = li.text
+                for child in li:
+                    if child.tag in BLOCK_TAGS:
+                        break
+                    inline.append(child)
+                content.append(Paragraph(self.inline(inline), ParagraphStyle('li', self.body_style,
+                                                                                 spaceAfter=4 * PX)))
+            for child in li:
+                if child.tag in BLOCK_TAGS:
+                    content.extend(self.block(child))
+            items.append(ListItem(content or [Paragraph('', self.body_style)]))
+        bullet = '1' if element.tag == 'ol' else 'bullet'
+        return ListFlowable(items, bulletType=bullet, bulletFormat='%s.' if bullet == '1' else None,
+                            leftIndent=25 * PX, bulletFontName=BODY_FONT,
+                            bulletFontSize=self.settings['base_font_size'], start=None if bullet == '1' else '•',
+                            spaceAfter=10 * PX)
+
+    def table(self, element):
+        rows = []
+        for tr in element.iter('tr'):
+            cells = []
+            for cell in tr:
+                style = self.header_cell_style if cell.tag == 'th' else self.cell_style
+                cells.append(Paragraph(self.inline(cell), style))
+            rows.append(cells)
+        if not rows:
+            return Spacer(0, 0)
+        width = max(len(row) for row in rows)
+        rows = [row + [''] * (width - len(row)) for row in rows]
+        has_header = element.find('thead') is not None
+        table = Table(rows, repeatRows=1 if has_header else 0, colWidths=[f'{100 / width}%'] * width)
+        style = [
+            ('GRID', (0, 0), (-1, -1), 1 * PX, HexColor('#dddddd')),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8 * PX),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 8 * PX),
+            ('TOPPADDING', (0, 0), (-1, -1), 4 * PX),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 4 * PX),
+            ('ROWBACKGROUNDS', (0, 1 if has_header else 0), (-1, -1), [white, HexColor('#f9f9f9')]),
+        ]
+        if has_header:
+            style += [
+                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#3498db')),
+                ('LINEBELOW', (0, 0), (-1, 0), 1 * PX, HexColor('#2980b9')),
+            ]
+        table.setStyle(TableStyle(style))
+        table.spaceBefore = table.spaceAfter = 10 * PX
+        return table
+
+    def code_block(self, code, highlighted=None):
+        """Lay out escaped code, and its highlighted markup, as runs of CODE_CHUNK_LINES lines.
+
+        Platypus re-wraps the remainder of a paragraph every time it splits it
+        across a page, so one flowable per block is quadratic in its length.
+        """
+        plain_lines = code.split('\n')
+        highlighted = code if highlighted is None else highlighted
+        chunks = code_chunks(highlighted.split('\n'))
+        starts = range(0, len(plain_lines), CODE_CHUNK_LINES)
+        settings = self.settings
+        padding_v = settings['code_padding_vertical'] * PX
+        padding_h = settings['code_padding_horizontal'] * PX
+
+        flowables = []
+        for start, chunk in zip(starts, chunks):
+            first, last = start == 0, start == starts[-1]
+            # Platypus collapses adjacent spacing and draws borderPadding outside
+            # the paragraph, so reserve the padding on both sides of the margin
+            style = ParagraphStyle(
+                'code-block', self.code_style, backColor=HexColor(settings['code_bg_color']),
+                borderPadding=(padding_v if first else 0, padding_h, padding_v if last else 0, padding_h),
+                leftIndent=padding_h, rightIndent=padding_h,
+                spaceBefore=settings['code_margin_top'] * PX + 2 * padding_v if first else 0,
+                spaceAfter=settings['code_margin_bottom'] * PX + 2 * padding_v if last else 0,
+            )
+            try:
+                lines = [SPAN_OPEN_PATTERN.sub(self.span_font, line).replace('</span>', '</font>') for line in chunk]
+                flowables.append(self.code_flowable(lines, style))
+            except ValueError:
+                # Highlighter output that is not well-formed markup falls back to plain text
+                flowables.append(self.code_flowable(plain_lines[start:start + CODE_CHUNK_LINES], style))
+        return flowables
+
+    def code_flowable(self, lines, style):
+        if self.settings['enable_wrap']:
+            lines = [CODE_SPACES_PATTERN.sub(lambda m: '&nbsp;' * len(m.group()), line) or '&nbsp;'
+                     for line in lines]
+            return Paragraph('<br/>'.join(lines), style)
+        return XPreformatted('\n'.join(lines), style)
+
+    def span_font(self, match):
+        color, font = self.code_colors.get(match.group(1), ('#000000', MONO_FONT))
+        return f'<font color="{color}" face="{font}">'
+
+
+class OutlineDocTemplate(SimpleDocTemplate):
+    """SimpleDocTemplate that adds every indexed heading to the PDF outline and the TOC"""
+
+    def afterFlowable(self, flowable):
+        heading = getattr(flowable, 'heading', None)
+        if heading is None:
+            return
+        self.canv.addOutlineEntry(heading.title, heading.anchor, heading.depth, closed=heading.depth > 0)
+        self.notify('TOCEntry', (heading.depth, escape(heading.title, quote=False), self.page, heading.anchor))
+
+
+def render_pdf_reportlab(md_text, settings):
+    """Render markdown straight to reportlab flowables, without HTML or CSS"""
+    margin = settings['page_margin'] * cm
+    pdf_file = BytesIO()
+    doc = OutlineDocTemplate(
+        pdf_file, pagesize=REPORTLAB_PAGE_SIZES.get(settings['page_size'], A4),
+        leftMargin=margin, rightMargin=margin, topMargin=margin, bottomMargin=margin,
+        title=extract_first_header(md_text)
+    )
+    story = FlowableBuilder(settings).build(md_text, settings['toc'])
+    # Page numbers in the TOC are only known after a first layout pass
+    if settings['toc'] == 'pages':
+        doc.multiBuild(story)
+    else:
+        doc.build(story)
+    return pdf_file.getvalue()
+
+
 @app.route('/')
 def index():
     return render_template_string('''
@@ -657,12 +1105,62 @@ def index():
         }
         .main-grid {
             display: grid;
-            grid-template-columns: 1fr 350px;
+            grid-template-columns: 1fr 1fr 350px;
             gap: 25px;
             flex: 1;
             overflow: hidden;
             min-height: 0;
         }
+        .preview-pane {
+            overflow-y: auto;
+            min-height: 0;
+            padding: 15px 20px;
+            border: 2px solid #e0e0e0;
+            border-radius: 10px;
+            font-size: 14px;
+            line-height: 1.5;
+        }
+        .preview-pane .page-thumbnail {
+            display: block;
+            max-width: 100%;
+            margin: 10px auto;
+            border: 1px solid #dee2e6;
+            box-shadow: 0 2px 6px rgba(0,0,0,0.15);
+        }
+        .preview-pane pre {
+            background: #f5f5f5;
+            padding: 8px 12px;
+            border-radius: 5px;
+            white-space: pre-wrap;
+            font-size: 12px;
+        }
+        .preview-pane .code-block {
+            padding: 8px 12px;
+        }
+        .preview-pane table {
+            border-collapse: collapse;
+        }
+        .preview-pane th, .preview-pane td {
+            border: 1px solid #dee2e6;
+            padding: 4px 8px;
+        }
+        .preview-pane .sql-keyword, .preview-pane .py-keyword {
+            color: #0000ff;
+            font-weight: bold;
+        }
+        .preview-pane .sql-string, .preview-pane .py-string {
+            color: #a31515;
+        }
+        .preview-pane .sql-comment, .preview-pane .py-comment {
+            color: #008000;
+            font-style: italic;
+        }
+        .preview-pane .sql-number, .preview-pane .py-number {
+            color: #098658;
+        }
+        .preview-pane .sql-function, .preview-pane .py-function, .preview-pane .py-builtin {
+            color: #795e26;
+        }
         .textarea-wrapper {
             display: flex;
             flex-direction: column;
@@ -812,6 +1310,9 @@ def index():
             color: #28a745;
             transition: all 0.3s;
         }
+        .btn-thumbnails {
+            margin-top: 10px;
+        }
         .btn-preset:hover {
             background: #28a745;
             color: white;
@@ -830,6 +1331,17 @@ def index():
             overflow: hidden;
             min-height: 0;
         }
+        .upload-field {
+            margin-top: 10px;
+            color: #666;
+            font-size: 0.9em;
+            flex-shrink: 0;
+        }
+        .upload-field label {
+            display: block;
+            margin-bottom: 5px;
+            font-weight: 500;
+        }
         .wrap-toggle {
             background-color: #e7f3ff;
             padding: 12px;
@@ -844,7 +1356,7 @@ def index():
         <h1>📄 Markdown to PDF Converter</h1>
         <p class="subtitle">PDF filename will be based on your first header</p>
         
-        <form method="POST" action="/generate">
+        <form method="POST" action="/generate" enctype="multipart/form-data">
             <div class="main-grid">
                 <div class="textarea-wrapper">
                     <textarea name="markdown" placeholder="# Your Document Title
@@ -854,9 +1366,16 @@ Your content here...
 ```sql
 SELECT * FROM users;
 ```"></textarea>
+                    <div class="upload-field">
+                        <label for="markdown_file">Or upload a file (.md, .txt, .gz, .zst)</label>
+                        <input type="file" name="markdown_file" id="markdown_file" accept=".md,.markdown,.txt,.gz,.zst">
+                    </div>
                     <button type="submit" class="btn-generate">Generate PDF</button>
+                    <button type="button" class="btn-preset btn-thumbnails" onclick="previewPages()">Preview pages</button>
                 </div>
                 
+                <div class="preview-pane" id="preview"></div>
+                
                 <div class="settings-panel">
                     <h3>⚙️ PDF Settings</h3>
                     
@@ -870,6 +1389,36 @@ SELECT * FROM users;
                             <input type="checkbox" name="enable_wrap" id="enable_wrap" value="true" checked>
                             <label for="enable_wrap">✨ Enable code wrapping</label>
                         </div>
+                        <div class="field">
+                            <label>Code Layout</label>
+                            <select name="code_layout">
+                                <option value="lines">Line boxes (classic)</option>
+                                <option value="compact">Compact runs (faster for long code)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Renderer</label>
+                            <select name="backend">
+                                <option value="pisa">HTML/CSS (xhtml2pdf)</option>
+                                <option value="reportlab">Direct (reportlab, faster)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Optimize Size</label>
+                            <select name="optimize">
+                                <option value="none">Off</option>
+                                <option value="compact">Compact (compress, deduplicate)</option>
+                                <option value="web">Web (compact, linearized)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Table of Contents</label>
+                            <select name="toc">
+                                <option value="none">Off</option>
+                                <option value="links">Linked headings</option>
+                                <option value="pages">With page numbers (slower)</option>
+                            </select>
+                        </div>
                     </div>
                     
                     <div class="section">
@@ -962,6 +1511,83 @@ SELECT * FROM users;
     </div>
     
     <script>
+        // Live preview: re-render only the sections whose hash changed,
+        // PREVIEW_DELAY ms after the last edit
+        const PREVIEW_DELAY = 400;
+        let previewHtml = {};
+        let previewTimer = null;
+        let previewRequest = 0;
+
+        function schedulePreview() {
+            clearTimeout(previewTimer);
+            previewTimer = setTimeout(updatePreview, PREVIEW_DELAY);
+        }
+
+        async function updatePreview() {
+            const form = document.querySelector('form');
+            const requestId = ++previewRequest;
+            const response = await fetch('/preview', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    markdown: form.markdown.value,
+                    known: Object.keys(previewHtml),
+                    code_layout: form.code_layout.value,
+                    enable_wrap: form.enable_wrap.checked
+                })
+            });
+            if (!response.ok || requestId !== previewRequest) {
+                return;
+            }
+            const sections = (await response.json()).sections;
+            const pane = document.getElementById('preview');
+            const html = {};
+            sections.forEach((section, index) => {
+                html[section.hash] = section.html !== undefined ? section.html : previewHtml[section.hash];
+                const existing = pane.children[index];
+                if (existing && existing.dataset.hash === section.hash) {
+                    return;
+                }
+                const node = document.createElement('div');
+                node.dataset.hash = section.hash;
+                node.innerHTML = html[section.hash] || '';
+                if (existing) {
+                    pane.replaceChild(node, existing);
+                } else {
+                    pane.appendChild(node);
+                }
+            });
+            while (pane.children.length > sections.length) {
+                pane.lastChild.remove();
+            }
+            previewHtml = html;
+        }
+
+        document.querySelector('[name="markdown"]').addEventListener('input', schedulePreview);
+
+        // Render the PDF on the server and show its first pages instead of downloading it
+        async function previewPages() {
+            const response = await fetch('/render', {method: 'POST', body: new FormData(document.querySelector('form'))});
+            if (!response.ok) {
+                alert(await response.text());
+                return;
+            }
+            const result = await response.json();
+            const link = document.createElement('a');
+            link.href = result.download;
+            link.textContent = `Download ${result.filename} (${Math.ceil(result.size / 1024)} KB, ${result.pages} pages)`;
+            const images = result.thumbnails.map(url => {
+                const image = document.createElement('img');
+                image.src = url;
+                image.className = 'page-thumbnail';
+                return image;
+            });
+            document.getElementById('preview').replaceChildren(link, ...images);
+            previewHtml = {};
+        }
+        document.querySelector('[name="code_layout"]').addEventListener('change', schedulePreview);
+        document.querySelector('#enable_wrap').addEventListener('change', schedulePreview);
+
         function applyDefault() {
             document.querySelector('[name="base_font_size"]').value = 12;
             document.querySelector('[name="code_font_size"]').value = 11;
@@ -1005,58 +1631,274 @@ SELECT * FROM users;
     ''')
 
 
-@app.route('/generate', methods=['POST'])
-def generate_pdf():
-    markdown_text = request.form.get('markdown', '')
-    
-    if not markdown_text:
-        return "No markdown content provided", 400
+def parse_settings(values):
+    """PDF settings from request values (form fields, query string or a JSON object)"""
+    return {
+        'base_font_size': float(values.get('base_font_size', 12)),
+        'code_font_size': float(values.get('code_font_size', 11)),
+        'page_size': values.get('page_size', 'A4'),
+        'page_margin': float(values.get('page_margin', 1.5)),
+        'paragraph_spacing': int(values.get('paragraph_spacing', 8)),
+        'code_padding_vertical': int(values.get('code_padding_vertical', 15)),
+        'code_padding_horizontal': int(values.get('code_padding_horizontal', 12)),
+        'code_margin_top': int(values.get('code_margin_top', 15)),
+        'code_margin_bottom': int(values.get('code_margin_bottom', 15)),
+        'code_bg_color': values.get('code_bg_color', '#f5f5f5'),
+        'keyword_color': values.get('keyword_color', '#00BFFF'),
+        'string_color': values.get('string_color', '#ff8c00'),
+        'comment_color': values.get('comment_color', '#006400'),
+        'number_color': values.get('number_color', '#FF00FF'),
+        'function_color': values.get('function_color', '#795e26'),
+        'enable_wrap': str(values.get('enable_wrap')).lower() == 'true',
+        'code_layout': values.get('code_layout', 'lines'),
+        'backend': values.get('backend', 'pisa'),
+        'optimize': values.get('optimize', 'none'),
+        'toc': values.get('toc', 'none'),
+    }
+
+
+def read_request():
+    """Markdown file, PDF filename and settings of this request; return (file, filename, settings, error)"""
+    md_file, error = open_markdown_input(request)
+    if error:
+        return None, None, None, error
     
     # Extract filename from first header
-    pdf_filename = extract_first_header(markdown_text) + '.pdf'
-    
-    settings = {
-        'base_font_size': float(request.form.get('base_font_size', 12)),
-        'code_font_size': float(request.form.get('code_font_size', 11)),
-        'page_size': request.form.get('page_size', 'A4'),
-        'page_margin': float(request.form.get('page_margin', 1.5)),
-        'paragraph_spacing': int(request.form.get('paragraph_spacing', 8)),
-        'code_padding_vertical': int(request.form.get('code_padding_vertical', 15)),
-        'code_padding_horizontal': int(request.form.get('code_padding_horizontal', 12)),
-        'code_margin_top': int(request.form.get('code_margin_top', 15)),
-        'code_margin_bottom': int(request.form.get('code_margin_bottom', 15)),
-        'code_bg_color': request.form.get('code_bg_color', '#f5f5f5'),
-        'keyword_color': request.form.get('keyword_color', '#00BFFF'),
-        'string_color': request.form.get('string_color', '#ff8c00'),
-        'comment_color': request.form.get('comment_color', '#006400'),
-        'number_color': request.form.get('number_color', '#FF00FF'),
-        'function_color': request.form.get('function_color', '#795e26'),
-        'enable_wrap': request.form.get('enable_wrap') == 'true',
-    }
+    pdf_filename = extract_first_header(read_first_header_line(md_file)) + '.pdf'
     
-    css = generate_css(settings)
-    content_html = process_markdown(markdown_text, settings['enable_wrap'])
-    full_html = render_template_string(HTML_TEMPLATE, css=css, content=content_html)
+    return md_file, pdf_filename, parse_settings(request.values), None
+
+
+def render_result(key, md_file, pdf_filename, settings):
+    """Render (or look up) the PDF stored under key; return (result, error)"""
+    result = get_result(key)
+    if result is not None:
+        return result, None
     
-    pdf_file = BytesIO()
-    pisa_status = pisa.CreatePDF(
-        full_html.encode('utf-8'),
-        dest=pdf_file,
-        encoding='utf-8',
-        path=''
-    )
+    # One process renders a key; the others wait for it and then find it stored
+    with result_store.key_lock(key):
+        result = get_result(key)
+        if result is not None:
+            return result, None
+        return render_new_result(key, md_file, pdf_filename, settings)
+
+
+def render_new_result(key, md_file, pdf_filename, settings):
+    """Render the PDF for key and store it; return (result, error)"""
+    if settings['backend'] == 'reportlab':
+        pdf_content = render_pdf_reportlab(read_markdown_text(md_file), settings)
+        return save_result(key, optimize_pdf(pdf_content, settings['optimize']), pdf_filename), None
     
-    if pisa_status.err:
-        return "Error generating PDF", 500
+    profile = get_render_profile(settings)
+    table_rows = table_rows_per_page(settings)
+    if input_size(md_file) > STREAM_THRESHOLD:
+        fragments = process_markdown_stream(
+            text_lines(md_file), settings['enable_wrap'], settings['code_layout'], table_rows, settings['toc']
+        )
+        html_source = write_html_document(profile, fragments)
+    else:
+        content_html = process_markdown(
+            read_markdown_text(md_file), settings['enable_wrap'], settings['code_layout'], table_rows,
+            settings['toc']
+        )
+        html_source = (profile['head'] + content_html + profile['tail']).encode('utf-8')
+
+    # pisa runs in a recyclable worker process, which keeps its caches from
+    # growing this one
+    try:
+        pdf_content = convert_html(html_source, profile['default_css'])
+    except WorkerCrashed:
+        return None, ("PDF worker crashed while generating the PDF", 500)
     
-    pdf_file.seek(0)
+    if pdf_content is None:
+        return None, ("Error generating PDF", 500)
     
-    return send_file(
-        pdf_file,
+    return save_result(key, optimize_pdf(pdf_content, settings['optimize']), pdf_filename), None
+
+
+def pdf_response(key, pdf_source, filename, size=None):
+    """Download response for PDF bytes or an open stored PDF file of the given size, validated by its key"""
+    # A stored file is sent from disk, with sendfile where the server supports it
+    response = send_file(
+        BytesIO(pdf_source) if isinstance(pdf_source, bytes) else pdf_source,
         mimetype='application/pdf',
         as_attachment=True,
-        download_name=pdf_filename
+        download_name=filename,
+        etag=False
     )
+    if size is not None:
+        response.content_length = size
+    # Output is deterministic, so the result key identifies the exact bytes
+    response.set_etag(key)
+    response.headers['X-Result-Key'] = key
+    response.headers['Content-Location'] = f'/result/{key}.pdf'
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = RESULT_MAX_AGE
+    return response
+
+
+def not_modified(key):
+    """304 for a client whose If-None-Match already names this result"""
+    metrics.increment('results.not_modified')
+    response = app.response_class(status=304)
+    response.set_etag(key)
+    response.headers['X-Result-Key'] = key
+    return response
+
+
+@app.route('/generate', methods=['POST'])
+def generate_pdf():
+    md_file, pdf_filename, settings, error = read_request()
+    if error:
+        return error
+    
+    key = result_key('artifact', settings, input_hash(md_file))
+    if request.if_none_match.contains(key):
+        return not_modified(key)
+    
+    # Any process on this host may have rendered it already
+    stored = result_store.lookup(key)
+    if stored is not None:
+        return pdf_response(key, stored.file, stored.filename, stored.size)
+    
+    result, error = render_result(key, md_file, pdf_filename, settings)
+    if error:
+        return error
+    return pdf_response(key, result['pdf'], result['filename'])
+
+
+def read_merge_request():
+    """Ordered markdown files and settings of a /merge request; return (files, settings, error)
+
+    Takes either a JSON object {"documents": [markdown, ...], "settings": {...}},
+    where a document may also be {"markdown": ...}, or several 'markdown_file'
+    uploads with the settings as form fields.
+    """
+    payload = request.get_json(silent=True)
+    if payload is not None:
+        documents = payload.get('documents') if isinstance(payload, dict) else None
+        if not isinstance(documents, list):
+            return None, None, ("Expected a JSON object with a 'documents' list", 400)
+        texts = [document.get('markdown') if isinstance(document, dict) else document for document in documents]
+        if not all(isinstance(text, str) for text in texts):
+            return None, None, ("Every document must be a markdown string", 400)
+        md_files = [BytesIO(text.encode('utf-8')) for text in texts]
+        settings = payload.get('settings')
+        settings = parse_settings(settings if isinstance(settings, dict) else {})
+    else:
+        md_files = []
+        for upload in request.files.getlist('markdown_file'):
+            md_file, error = spool_stream(
+                upload.stream, detect_compression(None, upload.mimetype, upload.filename)
+            )
+            if error:
+                return None, None, error
+            md_files.append(md_file)
+        settings = parse_settings(request.values)
+    
+    if not md_files:
+        return None, None, ("No markdown documents provided", 400)
+    if len(md_files) > MAX_MERGE_DOCUMENTS:
+        return None, None, (f"At most {MAX_MERGE_DOCUMENTS} documents can be merged", 400)
+    for number, md_file in enumerate(md_files, 1):
+        if input_size(md_file) == 0:
+            return None, None, (f"Document {number} is empty", 400)
+    return md_files, settings, None
+
+
+@app.route('/merge', methods=['POST'])
+def merge_pdf():
+    md_files, settings, error = read_merge_request()
+    if error:
+        return error
+    
+    keys = [result_key('artifact', settings, input_hash(md_file)) for md_file in md_files]
+    key = result_key('artifact-merge', settings, ' '.join(keys))
+    if request.if_none_match.contains(key):
+        return not_modified(key)
+    
+    result = get_result(key)
+    if result is None:
+        titles = [extract_first_header(read_first_header_line(md_file)) for md_file in md_files]
+        # Each document goes through the result cache, so a document already
+        # rendered by /generate (or an earlier merge) is not rendered again
+        with ThreadPoolExecutor(max_workers=min(MERGE_WORKERS, len(md_files))) as pool:
+            rendered = list(pool.map(
+                lambda job: render_result(job[0], job[1], job[2] + '.pdf', settings),
+                zip(keys, md_files, titles)
+            ))
+        for part, error in rendered:
+            if error:
+                return error
+        
+        pdf_content, error = merge_pdfs([(title, part['pdf']) for title, (part, _) in zip(titles, rendered)])
+        if error:
+            return error, 501
+        result = save_result(key, optimize_pdf(pdf_content, settings['optimize']), titles[0] + '.pdf')
+    return pdf_response(key, result['pdf'], result['filename'])
+
+
+@app.route('/render', methods=['POST'])
+def render_pdf():
+    md_file, pdf_filename, settings, error = read_request()
+    if error:
+        return error
+    
+    key = result_key('artifact', settings, input_hash(md_file))
+    result, error = render_result(key, md_file, pdf_filename, settings)
+    if error:
+        return error
+    return jsonify(result_summary(key, result))
+
+
+@app.route('/result/<key>.pdf')
+def download_result(key):
+    if request.if_none_match.contains(key):
+        return not_modified(key)
+    stored = result_store.lookup(key)
+    if stored is not None:
+        return pdf_response(key, stored.file, stored.filename, stored.size)
+    result = get_result(key)
+    if result is None:
+        return "Result not found (it may have expired)", 404
+    return pdf_response(key, result['pdf'], result['filename'])
+
+
+@app.route('/thumbnail/<key>/<int:page>.png')
+def show_thumbnail(key, page):
+    result = get_result(key)
+    if result is None:
+        return "Result not found (it may have expired)", 404
+    dpi = clamp_dpi(request.args.get('dpi', DEFAULT_THUMBNAIL_DPI, type=int))
+    png = get_thumbnail(result, page, dpi)
+    if png is None:
+        return "No such page", 404
+    response = send_file(BytesIO(png), mimetype='image/png')
+    response.set_etag(f'{key}-{page}-{dpi}')
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+@app.route('/preview', methods=['POST'])
+def show_preview():
+    payload = request.get_json(silent=True) or {}
+    enable_wrap = bool(payload.get('enable_wrap', True))
+    code_layout = payload.get('code_layout', 'lines')
+    if code_layout not in CODE_LAYOUTS:
+        code_layout = 'lines'
+    sections = render_preview(
+        str(payload.get('markdown', '')),
+        lambda source: process_markdown(source, enable_wrap, code_layout),
+        payload.get('known') or (),
+        variant=f'artifact:{code_layout}:{enable_wrap}'
+    )
+    return jsonify(sections=sections)
+
+
+@app.route('/metrics')
+def show_metrics():
+    return jsonify(dict(metrics.snapshot(), workers=pool_stats()))
 
 
 def main():
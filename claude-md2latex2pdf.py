@@ -1,109 +1,275 @@
 import subprocess
+import shutil
 import tempfile
 import os
 import re
+import sys
+from functools import lru_cache
+from html import escape, unescape
 from io import BytesIO
-from flask import Flask, render_template_string, request, send_file
+from flask import Flask, jsonify, render_template_string, request, send_file
+
+from docmodel import content_hash, heading_index, parse_document
+from fonts import discover_fonts, fontspec_font, warm_fontconfig_cache
+from lexers import highlight, latex_style
+import metrics
+from pdf_tools import optimize_pdf
+from preview import render_markdown_html, render_preview
+from render_queue import get_queue, run_worker, start_workers
+import result_store
+from results import (
+    DEFAULT_THUMBNAIL_DPI, RESULT_MAX_AGE, clamp_dpi, get_result, get_thumbnail, result_key,
+    result_summary, save_result
+)
+from uploads import MAX_CONTENT_LENGTH, open_markdown_input, read_markdown_text
 
 app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
 
 def extract_first_header(md_text):
     """Extract the first header from markdown text for use as filename."""
-    header_pattern = r'^#{1,6}\s+(.+?)$'
-    match = re.search(header_pattern, md_text, re.MULTILINE)
-    
-    if match:
-        header_text = match.group(1).strip()
-        header_text = re.sub(r'\*\*(.+?)\*\*', r'\1', header_text)
-        header_text = re.sub(r'\*(.+?)\*', r'\1', header_text)
-        header_text = re.sub(r'__(.+?)__', r'\1', header_text)
-        header_text = re.sub(r'_(.+?)_', r'\1', header_text)
-        header_text = re.sub(r'\[(.+?)\]\(.+?\)', r'\1', header_text)
-        header_text = re.sub(r'`(.+?)`', r'\1', header_text)
-        filename = re.sub(r'[<>:"/\\|?*]', '', header_text)
-        filename = filename.strip()
-        
-        if len(filename) > 100:
-            filename = filename[:100].rsplit(' ', 1)[0]
-        
-        return filename if filename else 'document'
-    
-    return 'document'
-
-
-def remove_emojis(content):
-    """Remove all emojis from content."""
-    emoji_pattern = re.compile(
-        "["
-        "\U0001F600-\U0001F64F"
-        "\U0001F300-\U0001F5FF"
-        "\U0001F680-\U0001F6FF"
-        "\U0001F1E0-\U0001F1FF"
-        "\U00002702-\U000027B0"
-        "\U000024C2-\U0001F251"
-        "\U0001F900-\U0001F9FF"
-        "\U00002600-\U000026FF"
-        "\U00002700-\U000027BF"
-        "\U0001FA00-\U0001FA6F"
-        "\U0001FA70-\U0001FAFF"
-        "\U00002B50"
-        "\U0000FE0F"
-        "]+",
-        flags=re.UNICODE
-    )
-    return emoji_pattern.sub('', content)
+    header_text = parse_document(md_text).title
+    filename = re.sub(r'[<>:"/\\|?*]', '', header_text)
+    filename = filename.strip()
+    
+    if len(filename) > 100:
+        filename = filename[:100].rsplit(' ', 1)[0]
+    
+    return filename if filename else 'document'
+
+
+# Codepoint ranges treated as emoji, inclusive
+EMOJI_RANGES = [
+    (0x1F600, 0x1F64F),
+    (0x1F300, 0x1F5FF),
+    (0x1F680, 0x1F6FF),
+    (0x1F1E0, 0x1F1FF),
+    (0x2702, 0x27B0),
+    (0x24C2, 0x1F251),
+    (0x1F900, 0x1F9FF),
+    (0x2600, 0x26FF),
+    (0x2700, 0x27BF),
+    (0x1FA00, 0x1FA6F),
+    (0x1FA70, 0x1FAFF),
+    (0x2B50, 0x2B50),
+    (0xFE0F, 0xFE0F),
+]
+EMOJI_REPLACEMENT = '?'
+
+# Tree-drawing characters mapped to ASCII (multi-character runs such as
+# '├──' map character by character to the same '|--')
+BOX_DRAWING_CHARS = {'├': '|', '└': '`', '│': '|', '─': '-'}
+BOX_DRAWING_TABLE = str.maketrans(BOX_DRAWING_CHARS)
+
+NON_ASCII_RUN_PATTERN = re.compile(r'[^\x00-\x7f]+')
+
+MAX_COMPILE_PASSES = 3
+
+# Font selections only a fontspec (XeTeX/LuaTeX) engine can honour
+FONTSPEC_FONT_PATTERN = re.compile(r'\\set(?:main|sans|mono)font\b')
+
+# Pandoc output cached per (content hash, emoji mode, code renderer, TOC
+# depth). The settings are left as markers, so colour and size changes reuse
+# the cached document and go straight to the TeX engine.
+MAX_CACHED_LATEX_DOCUMENTS = 32
+FONTSIZE_MARKER = 'MDPDFFONTSIZE'
+GEOMETRY_MARKER = 'MDPDFGEOMETRY'
+HEADER_MARKER = '% MDPDF-HEADER'
+# Deepest heading level listed in a table of contents (Pandoc's default)
+MAX_TOC_DEPTH = 3
+latex_documents = {}
+
+# TeX engines that can compile the generated .tex. 'unicode' engines load
+# fontspec and take any UTF-8 input; 'reruns' is False for engines that
+# repeat their own passes until references settle.
+PDF_ENGINES = {
+    'xelatex': {
+        'command': ['xelatex', '-interaction=nonstopmode', '-halt-on-error'],
+        'draft_args': ['-output-driver=xdvipdfmx -q -z0'],
+        'unicode': True,
+        'reruns': True,
+    },
+    'lualatex': {
+        'command': ['lualatex', '-interaction=nonstopmode', '-halt-on-error'],
+        'draft_args': [],
+        'unicode': True,
+        'reruns': True,
+    },
+    'pdflatex': {
+        'command': ['pdflatex', '-interaction=nonstopmode', '-halt-on-error'],
+        'draft_args': [],
+        'unicode': False,
+        'reruns': True,
+    },
+    'tectonic': {
+        'command': ['tectonic', '--keep-logs', '--chatter', 'minimal'],
+        'draft_args': [],
+        'unicode': True,
+        'reruns': False,
+    },
+}
+# pdfTeX, XeTeX and LuaTeX take the PDF's dates and /ID from SOURCE_DATE_EPOCH; a fixed
+# value (overridable) makes the same .tex always compile to the same bytes
+REPRODUCIBLE_ENV = dict(os.environ, SOURCE_DATE_EPOCH=os.environ.get('SOURCE_DATE_EPOCH', '0'))
+
+# Fastest first: pdflatex takes every ASCII-only document, the rest fall
+# through to XeLaTeX. Override with e.g. PDF_ENGINES=tectonic,xelatex
+DEFAULT_ENGINE_ORDER = 'pdflatex,xelatex,lualatex,tectonic'
+
+# Threads working the render queue (/jobs) in the web process; worker
+# nodes started with `worker` add more when RENDER_QUEUE is shared
+QUEUE_WORKERS = int(os.environ.get('QUEUE_WORKERS', 1))
+
+# Commands that read back what an earlier pass wrote to the .aux/.toc files.
+# Pandoc labels every heading, so labels alone never need a second pass.
+CROSS_REFERENCE_PATTERN = re.compile(
+    r'\\(?:tableofcontents|listoffigures|listoftables|ref|pageref|autoref|nameref|eqref|cite)\b'
+)
+# Log messages asking for another pass (the same ones Pandoc checks)
+RERUN_PATTERN = re.compile(
+    r'Rerun to get|Please \(?re\)?run|Label\(s\) may have changed|Rerun LaTeX|There were undefined references'
+)
+
+# Span classes from the shared highlighters mapped to the \Code... macros
+# defined by create_verbatim_header
+LATEX_TOKEN_MACROS = {
+    'sql-keyword': 'CodeKeyword',
+    'py-keyword': 'CodeKeyword',
+    'py-builtin': 'CodeBuiltin',
+    'sql-string': 'CodeString',
+    'py-string': 'CodeString',
+    'sql-comment': 'CodeComment',
+    'py-comment': 'CodeComment',
+    'sql-number': 'CodeNumber',
+    'py-number': 'CodeNumber',
+    'sql-function': 'CodeFunction',
+    'py-function': 'CodeFunction',
+    'py-decorator': 'CodeDecorator',
+}
+HIGHLIGHT_TOKEN_PATTERN = re.compile(r'<span class="([\w-]+)">|</span>|[^<]+|<')
+VERBATIM_ESCAPE_TABLE = str.maketrans({'\\': r'\textbackslash{}', '{': r'\{', '}': r'\}'})
+
+FENCE_PATTERN = re.compile(r'[ \t]*(`{3,}(?=[^`]*$)|~{3,})')
+LIST_ITEM_PATTERN = re.compile(r'[ \t]*(?:[-*+]|\d+\.) ')
+
+
+def emoji_character_class():
+    """Regex character class of EMOJI_RANGES, with overlapping ranges merged."""
+    merged = []
+    for start, end in sorted(EMOJI_RANGES):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return '[' + ''.join(f'{chr(start)}-{chr(end)}' for start, end in merged) + ']'
+
+
+EMOJI_RUN_PATTERN = re.compile(emoji_character_class() + '+')
+EMOJI_CHAR_PATTERN = re.compile(emoji_character_class())
+
+
+def clean_unicode(content, emoji_mode='remove'):
+    """Handle emojis and map box-drawing characters to ASCII.
+    
+    Pure ASCII returns immediately. Otherwise each box-drawing character
+    present is replaced with str.replace, then one precompiled regex pass
+    removes emoji runs ('remove') or replaces each emoji ('replace'), all
+    without calling back into Python. Box-drawing characters go first
+    because the emoji ranges cover them.
+    """
+    if content.isascii():
+        return content
+    for char, ascii_char in BOX_DRAWING_CHARS.items():
+        if char in content:
+            content = content.replace(char, ascii_char)
+    if emoji_mode == 'remove':
+        content = EMOJI_RUN_PATTERN.sub('', content)
+    elif emoji_mode == 'replace':
+        content = EMOJI_CHAR_PATTERN.sub(EMOJI_REPLACEMENT, content)
+    return content
 
 
 def fix_list_formatting(content):
     """Ensure proper blank lines before lists for Pandoc compatibility.
     
     Pandoc requires a blank line before list items when they follow a paragraph.
-    This function adds blank lines where needed while preserving code blocks.
+    This walks the lines once, tracking fence state (``` and ~~~) and whether
+    we are inside a list, so consecutive and nested items stay a tight list and
+    only the first item after a paragraph gets a blank line.
     """
-    # Split by code blocks to avoid modifying content inside them
-    code_block_pattern = r'(```[\s\S]*?```)'
-    parts = re.split(code_block_pattern, content)
-    
     result = []
-    for part in parts:
-        if part.startswith('```'):
-            # This is a code block, don't modify
-            result.append(part)
-        else:
-            # Add blank line before unordered list items that follow non-empty lines
-            # Pattern: (non-empty line)(newline)(list item starting with -, *, or +)
-            part = re.sub(
-                r'(\S[^\n]*)\n([ \t]*[-*+] )',
-                r'\1\n\n\2',
-                part
-            )
-            # Add blank line before ordered list items (1. 2. etc.)
-            part = re.sub(
-                r'(\S[^\n]*)\n([ \t]*\d+\. )',
-                r'\1\n\n\2',
-                part
-            )
-            result.append(part)
-    
-    return ''.join(result)
-
+    fence = None
+    in_list = False
+    previous_blank = True
+    
+    for line in content.split('\n'):
+        blank = not line.strip()
+        if fence:
+            # Inside a code block, don't modify
+            if line.lstrip().startswith(fence):
+                fence = None
+            result.append(line)
+            previous_blank = blank
+            continue
+        
+        fence_match = FENCE_PATTERN.match(line)
+        if not fence_match and LIST_ITEM_PATTERN.match(line):
+            if not previous_blank and not in_list:
+                result.append('')
+            in_list = True
+        elif not blank and previous_blank and line[:1] not in (' ', '\t'):
+            # An unindented paragraph or fence after a blank line ends the list
+            in_list = False
+        if fence_match:
+            fence = fence_match.group(1)
+        
+        result.append(line)
+        previous_blank = blank
+    
+    return '\n'.join(result)
 
-def create_latex_header(settings):
-    """Create LaTeX header with listings configuration based on settings."""
-    header = rf"""
-\usepackage{{listings}}
-\usepackage{{xcolor}}
-\usepackage{{fontspec}}
 
-% Define colors from settings
+def create_color_definitions(settings):
+    """Create the xcolor definitions shared by both code renderers."""
+    return rf"""% Define colors from settings
 \definecolor{{codebg}}{{HTML}}{{{settings['code_bg_color'].lstrip('#')}}}
 \definecolor{{keywordcolor}}{{HTML}}{{{settings['keyword_color'].lstrip('#')}}}
 \definecolor{{stringcolor}}{{HTML}}{{{settings['string_color'].lstrip('#')}}}
 \definecolor{{commentcolor}}{{HTML}}{{{settings['comment_color'].lstrip('#')}}}
 \definecolor{{numbercolor}}{{HTML}}{{{settings['number_color'].lstrip('#')}}}
 \definecolor{{functioncolor}}{{HTML}}{{{settings['function_color'].lstrip('#')}}}
+"""
+
 
+def create_font_commands(settings):
+    """fontspec commands loading the DejaVu fonts by file path when they are selected."""
+    if settings.get('font') != 'dejavu':
+        return ''
+    commands = [
+        fontspec_font('setmainfont', 'DejaVu Sans'),
+        fontspec_font('setsansfont', 'DejaVu Sans'),
+        fontspec_font('setmonofont', 'DejaVu Sans Mono'),
+    ]
+    commands = [command for command in commands if command]
+    if not commands:
+        return ''
+    return '\\ifPDFTeX\\else\n' + '\n'.join(commands) + '\n\\fi'
+
+
+def create_latex_header(settings):
+    """Create LaTeX header with listings configuration based on settings."""
+    if settings.get('code_renderer') == 'verbatim':
+        return create_verbatim_header(settings)
+    
+    header = rf"""
+\usepackage{{listings}}
+\usepackage{{xcolor}}
+\usepackage{{iftex}}
+\ifPDFTeX\else\usepackage{{fontspec}}\fi
+{create_font_commands(settings)}
+
+{create_color_definitions(settings)}
 % Define Python style
 \lstdefinestyle{{pythonstyle}}{{
     language=Python,
@@ -190,95 +356,280 @@ def create_latex_header(settings):
     return header
 
 
+def create_verbatim_header(settings):
+    """Create LaTeX header for pre-highlighted Verbatim code blocks.
+    
+    listings is not loaded at all: the code arrives already coloured, so TeX
+    only has to typeset it.
+    """
+    code_size = settings['code_font_size']
+    padding = settings['code_padding_horizontal']
+    return rf"""
+\usepackage{{xcolor}}
+\usepackage{{iftex}}
+\ifPDFTeX\else\usepackage{{fontspec}}\fi
+{create_font_commands(settings)}
+\usepackage{{fvextra}}
+\usepackage{{framed}}
+
+{create_color_definitions(settings)}
+\newcommand{{\CodeKeyword}}[1]{{\textcolor{{keywordcolor}}{{\textbf{{#1}}}}}}
+\newcommand{{\CodeBuiltin}}[1]{{\textcolor{{keywordcolor}}{{#1}}}}
+\newcommand{{\CodeString}}[1]{{\textcolor{{stringcolor}}{{#1}}}}
+\newcommand{{\CodeComment}}[1]{{\textcolor{{commentcolor}}{{\textit{{#1}}}}}}
+\newcommand{{\CodeNumber}}[1]{{\textcolor{{numbercolor}}{{#1}}}}
+\newcommand{{\CodeFunction}}[1]{{\textcolor{{functioncolor}}{{#1}}}}
+\newcommand{{\CodeDecorator}}[1]{{\textcolor{{gray}}{{#1}}}}
+
+\newenvironment{{CodeBlock}}{{%
+    \par\vspace{{{settings['code_margin_top']}pt}}%
+    \def\FrameCommand{{\fboxsep=5pt\colorbox{{codebg}}}}%
+    \MakeFramed{{\advance\hsize-\width\FrameRestore}}%
+}}{{\endMakeFramed\vspace{{{settings['code_margin_bottom']}pt}}}}
+
+\DefineVerbatimEnvironment{{CodeVerbatim}}{{Verbatim}}{{commandchars=\\\{{\}}, breaklines=true,
+    tabsize=4, xleftmargin={padding}pt, xrightmargin={padding}pt,
+    fontsize=\fontsize{{{code_size}}}{{{code_size + 2}}}\selectfont}}
+"""
+
+
 def get_language_style(lang):
     """Map language identifier to LaTeX listing style."""
-    if not lang:
-        return 'defaultstyle'
-    
-    lang = lang.lower().strip()
-    
-    if lang in ['python', 'py', 'python3', 'pyspark', 'spark']:
-        return 'pythonstyle'
-    elif lang in ['sql', 'mysql', 'postgresql', 'postgres', 'sqlite', 'tsql', 'plsql']:
-        return 'sqlstyle'
-    elif lang in ['r', 'rlang', 'rscript']:
-        return 'rstyle'
-    
-    return 'defaultstyle'
+    return latex_style(lang)
 
 
 def clean_special_chars(code):
     """Replace special unicode characters with ASCII equivalents."""
-    replacements = [
-        ('├──', '|--'),
-        ('└──', '`--'),
-        ('├─', '|-'),
-        ('└─', '`-'),
-        ('│', '|'),
-        ('─', '-'),
-        ('├', '|'),
-        ('└', '`'),
-    ]
-    for old, new in replacements:
-        code = code.replace(old, new)
-    return code
+    return code.translate(BOX_DRAWING_TABLE)
 
 
-def process_code_blocks(content):
-    """Convert markdown code blocks to LaTeX listings."""
+@lru_cache(maxsize=1024)
+def highlight_verbatim(code, lang):
+    """Colour code in Python and return the body of a CodeVerbatim block.
     
-    def replace_code_block(match):
-        lang = match.group(1) if match.group(1) else ''
-        code = match.group(2)
-        
-        lang_style = get_language_style(lang)
-        code = clean_special_chars(code)
-        
-        code = code.strip('\n')
-        
+    Uses the same lexers as the artifact converter and turns their spans into
+    \\Code... macros. Verbatim reads line by line, so macros still open at a
+    line end are closed and reopened on the next line. Cached per code block.
+    """
+    highlighted = highlight(escape(code, quote=False), lang)
+    lines = [[]]
+    open_macros = []
+    
+    for match in HIGHLIGHT_TOKEN_PATTERN.finditer(highlighted):
+        token = match.group()
+        if match.group(1):
+            macro = LATEX_TOKEN_MACROS.get(match.group(1))
+            open_macros.append(macro)
+            if macro:
+                lines[-1].append(f'\\{macro}{{')
+        elif token == '</span>':
+            if open_macros and open_macros.pop():
+                lines[-1].append('}')
+        else:
+            text = unescape(token).translate(VERBATIM_ESCAPE_TABLE)
+            for index, piece in enumerate(text.split('\n')):
+                if index:
+                    active = [macro for macro in open_macros if macro]
+                    lines[-1].append('}' * len(active))
+                    lines.append([f'\\{macro}{{' for macro in active])
+                lines[-1].append(piece)
+    
+    return '\n'.join(''.join(line) for line in lines)
+
+
+def code_block_to_latex(code, lang, code_renderer='listings'):
+    """Convert one code block to a raw LaTeX listing, or a pre-highlighted Verbatim block."""
+    code = clean_special_chars(code)
+    
+    code = code.strip('\n')
+    
+    if code_renderer == 'verbatim':
         return f'''
 ```{{=latex}}
+\\begin{{CodeBlock}}
+\\begin{{CodeVerbatim}}
+{highlight_verbatim(code, lang)}
+\\end{{CodeVerbatim}}
+\\end{{CodeBlock}}
+```
+'''
+    
+    lang_style = get_language_style(lang)
+    
+    return f'''
+```{{=latex}}
 \\begin{{lstlisting}}[style={lang_style}]
 {code}
 \\end{{lstlisting}}
 ```
 '''
+
+
+def preprocess_markdown(md_text, emoji_mode='remove', code_renderer='listings'):
+    """Preprocess markdown for Pandoc conversion.
     
-    pattern = r'```(\w*)\n(.*?)```'
-    result = re.sub(pattern, replace_code_block, content, flags=re.DOTALL)
-    
-    return result
+    Works from the cached document model, so the fences found while
+    extracting the filename are not searched for again.
+    """
+    parts = []
+    for block in parse_document(md_text).blocks:
+        if block.kind == 'fence':
+            parts.append(code_block_to_latex(
+                clean_unicode(block.content, emoji_mode), block.info, code_renderer
+            ))
+        else:
+            parts.append(clean_unicode(block.source, emoji_mode))
+    return fix_list_formatting('\n'.join(parts))
 
 
-def preprocess_markdown(md_text):
-    """Preprocess markdown for Pandoc conversion."""
-    content = remove_emojis(md_text)
-    content = fix_list_formatting(content)  # Fix list formatting before code blocks
-    content = process_code_blocks(content)
-    return content
+def needs_cross_references(tex_source):
+    """Whether a LaTeX document reads back anything a previous pass wrote (refs, TOC, citations)."""
+    return CROSS_REFERENCE_PATTERN.search(tex_source) is not None
 
 
-def convert_md_to_pdf(md_text, settings):
-    """Convert markdown to PDF using Pandoc with XeLaTeX."""
-    processed_content = preprocess_markdown(md_text)
-    
-    with tempfile.NamedTemporaryFile(
-        mode='w', suffix='.tex', delete=False, encoding='utf-8'
-    ) as header_file:
-        header_file.write(create_latex_header(settings))
-        header_path = header_file.name
-    
-    with tempfile.NamedTemporaryFile(
-        mode='w', suffix='.md', delete=False, encoding='utf-8'
-    ) as temp_md:
-        temp_md.write(processed_content)
-        temp_md_path = temp_md.name
-    
-    with tempfile.NamedTemporaryFile(
-        suffix='.pdf', delete=False
-    ) as temp_pdf:
-        output_path = temp_pdf.name
+def engine_preference():
+    """Known engine names in the order configured by PDF_ENGINES."""
+    names = os.environ.get('PDF_ENGINES', DEFAULT_ENGINE_ORDER).split(',')
+    return [name.strip() for name in names if name.strip() in PDF_ENGINES]
+
+
+@lru_cache(maxsize=None)
+def engine_installed(name):
+    """Whether an engine's executable is on the PATH."""
+    return shutil.which(PDF_ENGINES[name]['command'][0]) is not None
+
+
+def engine_supports(name, tex_source):
+    """Whether an engine can compile this LaTeX source."""
+    if PDF_ENGINES[name]['unicode']:
+        return True
+    # pdflatex has no fontspec and only the 8-bit input encodings
+    return NON_ASCII_RUN_PATTERN.search(tex_source) is None and FONTSPEC_FONT_PATTERN.search(tex_source) is None
+
+
+def select_engine(tex_source, requested='auto'):
+    """First installed engine able to compile the source, trying the requested one first."""
+    candidates = engine_preference()
+    if requested in PDF_ENGINES:
+        candidates.insert(0, requested)
+    for name in candidates:
+        if engine_installed(name) and engine_supports(name, tex_source):
+            if requested in PDF_ENGINES and name != requested:
+                metrics.increment('latex.engine_fallback')
+            return name
+    return None
+
+
+def verify_pdf(pdf_content):
+    """Error message when an engine's output is not a complete PDF, else None."""
+    if not pdf_content.startswith(b'%PDF-'):
+        return "output is not a PDF"
+    if b'%%EOF' not in pdf_content[-1024:]:
+        return "PDF output is truncated"
+    return None
+
+
+def run_latex_passes(tex_path, engine, compile_mode='full'):
+    """Run a TeX engine on a .tex file until its references settle; return (passes, error)."""
+    workdir, tex_name = os.path.split(tex_path)
+    log_path = os.path.splitext(tex_path)[0] + '.log'
+    spec = PDF_ENGINES[engine]
+    cmd = list(spec['command'])
+    if compile_mode == 'draft':
+        cmd.extend(spec['draft_args'])
+    cmd.append(tex_name)
+
+    if not spec['reruns']:
+        max_passes = 1   # the engine reruns itself
+    elif compile_mode in ('fast', 'draft'):
+        with open(tex_path, encoding='utf-8') as f:
+            max_passes = MAX_COMPILE_PASSES if needs_cross_references(f.read()) else 1
+    else:
+        max_passes = MAX_COMPILE_PASSES
+
+    passes = 0
+    while passes < max_passes:
+        passes += 1
+        try:
+            with metrics.timed(f'latex.pass.{engine}'):
+                subprocess.run(
+                    cmd, cwd=workdir, env=REPRODUCIBLE_ENV, capture_output=True, text=True, check=True
+                )
+        except subprocess.CalledProcessError as e:
+            return passes, f"{engine} error: {(e.stdout or e.stderr)[-2000:]}"
+        except FileNotFoundError:
+            return passes, f"{engine} not found. Please install it or change PDF_ENGINES."
+
+        if passes < max_passes:
+            with open(log_path, encoding='utf-8', errors='replace') as f:
+                if not RERUN_PATTERN.search(f.read()):
+                    break
+
+    return passes, None
+
+
+def toc_depth(md_text):
+    """Table of contents depth covering the document's headings (at most MAX_TOC_DEPTH), 0 without any."""
+    levels = [heading.level for heading in heading_index(parse_document(md_text))]
+    return min(max(levels), MAX_TOC_DEPTH) if levels else 0
+
+
+def markdown_to_latex(md_text, emoji_mode='remove', code_renderer='listings', toc=0):
+    """Settings-independent standalone LaTeX for a markdown text, cached; return (tex, error).
+
+    A non-zero toc is the depth of the table of contents Pandoc puts in front.
+    """
+    key = (content_hash(md_text), emoji_mode, code_renderer, toc)
+    tex_source = latex_documents.get(key)
+    if tex_source is not None:
+        metrics.increment('latex.body_cache_hit')
+        return tex_source, None
     
+    processed_content = preprocess_markdown(md_text, emoji_mode, code_renderer)
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        header_path = os.path.join(workdir, 'header.tex')
+        md_path = os.path.join(workdir, 'document.md')
+        
+        with open(header_path, 'w', encoding='utf-8') as f:
+            f.write(HEADER_MARKER + '\n')
+        with open(md_path, 'w', encoding='utf-8') as f:
+            f.write(processed_content)
+        
+        # Settings enter the .tex only through the markers, which
+        # assemble_latex replaces
+        cmd = [
+            'pandoc',
+            md_path,
+            '-s',
+            '-t', 'latex',
+            '-H', header_path,
+            '-V', f'fontsize={FONTSIZE_MARKER}',
+            '-V', f'geometry={GEOMETRY_MARKER}',
+            '--highlight-style=tango'
+        ]
+        if toc:
+            cmd += ['--toc', f'--toc-depth={toc}']
+        
+        try:
+            with metrics.timed('latex.pandoc'):
+                result = subprocess.run(
+                    cmd, capture_output=True, text=True, encoding='utf-8', check=True
+                )
+        except subprocess.CalledProcessError as e:
+            return None, f"Pandoc error: {e.stderr}"
+        except FileNotFoundError:
+            return None, "Pandoc not found. Please install pandoc and xelatex."
+    
+    tex_source = result.stdout
+    if len(latex_documents) >= MAX_CACHED_LATEX_DOCUMENTS:
+        latex_documents.pop(next(iter(latex_documents)))
+    latex_documents[key] = tex_source
+    return tex_source, None
+
+
+def assemble_latex(tex_source, settings):
+    """Fill the page, font size and header markers of a cached document with the settings."""
     page_size_map = {
         'A4': 'a4paper',
         'Letter': 'letterpaper',
@@ -286,38 +637,69 @@ def convert_md_to_pdf(md_text, settings):
         'A3': 'a3paper'
     }
     paper = page_size_map.get(settings['page_size'], 'a4paper')
+    header = (
+        create_latex_header(settings)
+        + f'\n\\setlength{{\\parskip}}{{{settings["paragraph_spacing"]}pt}}\n'
+    )
+    return (
+        tex_source
+        .replace(FONTSIZE_MARKER, f'{settings["base_font_size"]}pt', 1)
+        .replace(GEOMETRY_MARKER, f'margin={settings["page_margin"]}cm,{paper}', 1)
+        .replace(HEADER_MARKER, header, 1)
+    )
+
+
+def compile_latex(tex_source, settings):
+    """Compile a complete LaTeX document with the best available engine; return (pdf, compile passes, error)."""
+    engine = select_engine(tex_source, settings.get('pdf_engine', 'auto'))
+    if engine is None:
+        return None, 0, "No suitable PDF engine found. Please install xelatex or set PDF_ENGINES."
     
-    cmd = [
-        'pandoc',
-        temp_md_path,
-        '-o', output_path,
-        '--pdf-engine=xelatex',
-        '-H', header_path,
-        '-V', f'geometry:margin={settings["page_margin"]}cm',
-        '-V', f'fontsize={settings["base_font_size"]}pt',
-        '-V', f'geometry:{paper}',
-        '-V', f'parskip={settings["paragraph_spacing"]}pt',
-        '--highlight-style=tango'
-    ]
-    
-    try:
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, check=True
-        )
+    with tempfile.TemporaryDirectory() as workdir:
+        tex_path = os.path.join(workdir, 'document.tex')
+        with open(tex_path, 'w', encoding='utf-8') as f:
+            f.write(tex_source)
         
-        with open(output_path, 'rb') as f:
-            pdf_content = f.read()
+        compile_mode = settings.get('compile_mode', 'full')
+        with metrics.timed(f'latex.compile.{engine}.{compile_mode}'):
+            passes, error = run_latex_passes(tex_path, engine, compile_mode)
+        metrics.increment('latex.compile_passes', passes)
+        metrics.increment(f'latex.documents.{passes}_pass')
+        metrics.increment(f'latex.engine.{engine}')
+        if error:
+            return None, passes, error
         
-        return pdf_content, None
-        
-    except subprocess.CalledProcessError as e:
-        return None, f"Pandoc error: {e.stderr}"
-    except FileNotFoundError:
-        return None, "Pandoc not found. Please install pandoc and xelatex."
-    finally:
-        for path in [header_path, temp_md_path, output_path]:
-            if os.path.exists(path):
-                os.unlink(path)
+        pdf_path = os.path.join(workdir, 'document.pdf')
+        if not os.path.exists(pdf_path):
+            return None, passes, f"{engine} produced no PDF"
+        with open(pdf_path, 'rb') as f:
+            pdf_content = f.read()
+    
+    error = verify_pdf(pdf_content)
+    if error:
+        metrics.increment('latex.invalid_output')
+        return None, passes, f"{engine} error: {error}"
+    return pdf_content, passes, None
+
+
+def convert_md_to_latex(md_text, settings):
+    """Complete LaTeX source for a markdown text and settings; return (tex, error)."""
+    # The heading index decides whether a TOC has anything to list, and how deep
+    toc = toc_depth(md_text) if settings.get('toc', 'none') != 'none' else 0
+    tex_source, error = markdown_to_latex(
+        md_text, settings.get('emoji_mode', 'remove'), settings.get('code_renderer', 'listings'), toc
+    )
+    if error:
+        return None, error
+    return assemble_latex(tex_source, settings), None
+
+
+def convert_md_to_pdf(md_text, settings):
+    """Convert markdown to PDF using Pandoc and a TeX engine; return (pdf, compile passes, error)."""
+    tex_source, error = convert_md_to_latex(md_text, settings)
+    if error:
+        return None, 0, error
+    return compile_latex(tex_source, settings)
 
 
 @app.route('/')
@@ -353,12 +735,62 @@ def index():
         .subtitle { color: #7f8c8d; margin-bottom: 15px; font-size: 1em; }
         .main-grid {
             display: grid;
-            grid-template-columns: 1fr 350px;
+            grid-template-columns: 1fr 1fr 350px;
             gap: 25px;
             flex: 1;
             overflow: hidden;
             min-height: 0;
         }
+        .preview-pane {
+            overflow-y: auto;
+            min-height: 0;
+            padding: 15px 20px;
+            border: 2px solid #e0e0e0;
+            border-radius: 10px;
+            font-size: 14px;
+            line-height: 1.5;
+        }
+        .preview-pane .page-thumbnail {
+            display: block;
+            max-width: 100%;
+            margin: 10px auto;
+            border: 1px solid #dee2e6;
+            box-shadow: 0 2px 6px rgba(0,0,0,0.15);
+        }
+        .preview-pane pre {
+            background: #f5f5f5;
+            padding: 8px 12px;
+            border-radius: 5px;
+            white-space: pre-wrap;
+            font-size: 12px;
+        }
+        .preview-pane .code-block {
+            padding: 8px 12px;
+        }
+        .preview-pane table {
+            border-collapse: collapse;
+        }
+        .preview-pane th, .preview-pane td {
+            border: 1px solid #dee2e6;
+            padding: 4px 8px;
+        }
+        .preview-pane .sql-keyword, .preview-pane .py-keyword {
+            color: #0000ff;
+            font-weight: bold;
+        }
+        .preview-pane .sql-string, .preview-pane .py-string {
+            color: #a31515;
+        }
+        .preview-pane .sql-comment, .preview-pane .py-comment {
+            color: #008000;
+            font-style: italic;
+        }
+        .preview-pane .sql-number, .preview-pane .py-number {
+            color: #098658;
+        }
+        .preview-pane .sql-function, .preview-pane .py-function, .preview-pane .py-builtin {
+            color: #795e26;
+        }
         .textarea-wrapper {
             display: flex;
             flex-direction: column;
@@ -475,6 +907,9 @@ def index():
             color: #28a745;
             transition: all 0.3s;
         }
+        .btn-thumbnails {
+            margin-top: 10px;
+        }
         .btn-preset:hover { background: #28a745; color: white; }
         .btn-preset.compact { border-color: #17a2b8; color: #17a2b8; }
         .btn-preset.compact:hover { background: #17a2b8; }
@@ -485,6 +920,8 @@ def index():
             overflow: hidden;
             min-height: 0;
         }
+        .upload-field { margin-top: 10px; color: #666; font-size: 0.9em; flex-shrink: 0; }
+        .upload-field label { display: block; margin-bottom: 5px; font-weight: 500; }
         .info-box {
             background-color: #e7f3ff;
             padding: 12px;
@@ -501,7 +938,7 @@ def index():
         <h1>Markdown to PDF Converter</h1>
         <p class="subtitle">Powered by Pandoc + XeLaTeX</p>
         
-        <form method="POST" action="/generate">
+        <form method="POST" action="/generate" enctype="multipart/form-data">
             <div class="main-grid">
                 <div class="textarea-wrapper">
                     <textarea name="markdown" placeholder="# Your Document Title
@@ -516,9 +953,16 @@ def hello():
 ```sql
 SELECT * FROM users WHERE active = TRUE;
 ```"></textarea>
+                    <div class="upload-field">
+                        <label for="markdown_file">Or upload a file (.md, .txt, .gz, .zst)</label>
+                        <input type="file" name="markdown_file" id="markdown_file" accept=".md,.markdown,.txt,.gz,.zst">
+                    </div>
                     <button type="submit" class="btn-generate">Generate PDF</button>
+                    <button type="button" class="btn-preset btn-thumbnails" onclick="previewPages()">Preview pages</button>
                 </div>
                 
+                <div class="preview-pane" id="preview"></div>
+                
                 <div class="settings-panel">
                     <h3>PDF Settings</h3>
                     
@@ -558,6 +1002,68 @@ SELECT * FROM users WHERE active = TRUE;
                             <label>Page Margin (cm)</label>
                             <input type="number" name="page_margin" value="2" step="0.1" min="0.5" max="4">
                         </div>
+                        <div class="field">
+                            <label>Font</label>
+                            <select name="font">
+                                <option value="default">Latin Modern (TeX default)</option>
+                                <option value="dejavu">DejaVu Sans</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Table of Contents</label>
+                            <select name="toc">
+                                <option value="none">Off</option>
+                                <option value="pages">On (needs a second pass)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Emojis</label>
+                            <select name="emoji_mode">
+                                <option value="remove">Remove</option>
+                                <option value="replace">Replace with ?</option>
+                                <option value="keep">Keep</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Code Blocks</label>
+                            <select name="code_renderer">
+                                <option value="listings">listings (highlighted by TeX)</option>
+                                <option value="verbatim">Pre-highlighted (faster)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Compile</label>
+                            <select name="compile_mode">
+                                <option value="full">Full (rerun for references)</option>
+                                <option value="fast">Fast (single pass when possible)</option>
+                                <option value="draft">Draft (fast, uncompressed)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>PDF Engine</label>
+                            <select name="pdf_engine">
+                                <option value="auto">Automatic (fastest compatible)</option>
+                                <option value="xelatex">XeLaTeX</option>
+                                <option value="lualatex">LuaLaTeX</option>
+                                <option value="pdflatex">pdfLaTeX (ASCII only)</option>
+                                <option value="tectonic">Tectonic</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Output</label>
+                            <select name="output_format">
+                                <option value="pdf">PDF</option>
+                                <option value="tex">LaTeX source (.tex)</option>
+                            </select>
+                        </div>
+                        <div class="field">
+                            <label>Optimize Size</label>
+                            <select name="optimize">
+                                <option value="none">Off</option>
+                                <option value="compact">Compact (compress, deduplicate)</option>
+                                <option value="web">Web (compact, linearized)</option>
+                            </select>
+                        </div>
                     </div>
                     
                     <div class="section">
@@ -617,6 +1123,79 @@ SELECT * FROM users WHERE active = TRUE;
     </div>
     
     <script>
+        // Live preview: re-render only the sections whose hash changed,
+        // PREVIEW_DELAY ms after the last edit
+        const PREVIEW_DELAY = 400;
+        let previewHtml = {};
+        let previewTimer = null;
+        let previewRequest = 0;
+
+        function schedulePreview() {
+            clearTimeout(previewTimer);
+            previewTimer = setTimeout(updatePreview, PREVIEW_DELAY);
+        }
+
+        async function updatePreview() {
+            const form = document.querySelector('form');
+            const requestId = ++previewRequest;
+            const response = await fetch('/preview', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    markdown: form.markdown.value,
+                    known: Object.keys(previewHtml)
+                })
+            });
+            if (!response.ok || requestId !== previewRequest) {
+                return;
+            }
+            const sections = (await response.json()).sections;
+            const pane = document.getElementById('preview');
+            const html = {};
+            sections.forEach((section, index) => {
+                html[section.hash] = section.html !== undefined ? section.html : previewHtml[section.hash];
+                const existing = pane.children[index];
+                if (existing && existing.dataset.hash === section.hash) {
+                    return;
+                }
+                const node = document.createElement('div');
+                node.dataset.hash = section.hash;
+                node.innerHTML = html[section.hash] || '';
+                if (existing) {
+                    pane.replaceChild(node, existing);
+                } else {
+                    pane.appendChild(node);
+                }
+            });
+            while (pane.children.length > sections.length) {
+                pane.lastChild.remove();
+            }
+            previewHtml = html;
+        }
+
+        document.querySelector('[name="markdown"]').addEventListener('input', schedulePreview);
+
+        // Render the PDF on the server and show its first pages instead of downloading it
+        async function previewPages() {
+            const response = await fetch('/render', {method: 'POST', body: new FormData(document.querySelector('form'))});
+            if (!response.ok) {
+                alert(await response.text());
+                return;
+            }
+            const result = await response.json();
+            const link = document.createElement('a');
+            link.href = result.download;
+            link.textContent = `Download ${result.filename} (${Math.ceil(result.size / 1024)} KB, ${result.pages} pages)`;
+            const images = result.thumbnails.map(url => {
+                const image = document.createElement('img');
+                image.src = url;
+                image.className = 'page-thumbnail';
+                return image;
+            });
+            document.getElementById('preview').replaceChildren(link, ...images);
+            previewHtml = {};
+        }
+
         function applyDefault() {
             document.querySelector('[name="base_font_size"]').value = 11;
             document.querySelector('[name="code_font_size"]').value = 9;
@@ -656,48 +1235,255 @@ SELECT * FROM users WHERE active = TRUE;
     ''')
 
 
-@app.route('/generate', methods=['POST'])
-def generate_pdf():
-    markdown_text = request.form.get('markdown', '')
-    
-    if not markdown_text:
-        return "No markdown content provided", 400
+def read_request():
+    """Markdown, PDF filename and settings of this request; return (markdown, filename, settings, error)."""
+    md_file, error = open_markdown_input(request)
+    if error:
+        return None, None, None, error
     
+    markdown_text = read_markdown_text(md_file)
     pdf_filename = extract_first_header(markdown_text) + '.pdf'
     
     settings = {
-        'base_font_size': int(request.form.get('base_font_size', 11)),
-        'code_font_size': int(request.form.get('code_font_size', 9)),
-        'page_size': request.form.get('page_size', 'A4'),
-        'page_margin': float(request.form.get('page_margin', 2)),
-        'paragraph_spacing': int(request.form.get('paragraph_spacing', 6)),
-        'code_padding_horizontal': int(request.form.get('code_padding_horizontal', 15)),
-        'code_margin_top': int(request.form.get('code_margin_top', 10)),
-        'code_margin_bottom': int(request.form.get('code_margin_bottom', 10)),
-        'code_bg_color': request.form.get('code_bg_color', '#f5f5f5'),
-        'keyword_color': request.form.get('keyword_color', '#0000ff'),
-        'string_color': request.form.get('string_color', '#a31515'),
-        'comment_color': request.form.get('comment_color', '#008000'),
-        'number_color': request.form.get('number_color', '#098658'),
-        'function_color': request.form.get('function_color', '#795e26'),
+        'base_font_size': int(request.values.get('base_font_size', 11)),
+        'code_font_size': int(request.values.get('code_font_size', 9)),
+        'page_size': request.values.get('page_size', 'A4'),
+        'page_margin': float(request.values.get('page_margin', 2)),
+        'paragraph_spacing': int(request.values.get('paragraph_spacing', 6)),
+        'code_padding_horizontal': int(request.values.get('code_padding_horizontal', 15)),
+        'code_margin_top': int(request.values.get('code_margin_top', 10)),
+        'code_margin_bottom': int(request.values.get('code_margin_bottom', 10)),
+        'code_bg_color': request.values.get('code_bg_color', '#f5f5f5'),
+        'keyword_color': request.values.get('keyword_color', '#0000ff'),
+        'string_color': request.values.get('string_color', '#a31515'),
+        'comment_color': request.values.get('comment_color', '#008000'),
+        'number_color': request.values.get('number_color', '#098658'),
+        'function_color': request.values.get('function_color', '#795e26'),
+        'emoji_mode': request.values.get('emoji_mode', 'remove'),
+        'code_renderer': request.values.get('code_renderer', 'listings'),
+        'compile_mode': request.values.get('compile_mode', 'full'),
+        'pdf_engine': request.values.get('pdf_engine', 'auto'),
+        'optimize': request.values.get('optimize', 'none'),
+        'font': request.values.get('font', 'default'),
+        'toc': request.values.get('toc', 'none'),
     }
+    return markdown_text, pdf_filename, settings, None
+
+
+def render_result(key, markdown_text, pdf_filename, settings):
+    """Render (or look up) the PDF stored under key; return (result, compile passes, error)."""
+    result = get_result(key)
+    if result is not None:
+        return result, 0, None
     
-    pdf_content, error = convert_md_to_pdf(markdown_text, settings)
+    # One process renders a key; the others wait for it and then find it stored
+    with result_store.key_lock(key):
+        result = get_result(key)
+        if result is not None:
+            return result, 0, None
+        return render_new_result(key, markdown_text, pdf_filename, settings)
+
+
+def render_new_result(key, markdown_text, pdf_filename, settings):
+    """Render the PDF for key and store it; return (result, compile passes, error)."""
+    pdf_content, passes, error = convert_md_to_pdf(markdown_text, settings)
+    if error:
+        return None, passes, error
+    pdf_content = optimize_pdf(pdf_content, settings.get('optimize', 'none'))
+    return save_result(key, pdf_content, pdf_filename), passes, None
+
+
+def render_job(key, payload):
+    """Render queue handler: render a submitted job; return (pdf, error)."""
+    result, _, error = render_result(key, payload['markdown'], payload['filename'], payload['settings'])
+    if error:
+        return None, f"Error generating PDF: {error}"
+    return result['pdf'], None
+
+
+def job_queue():
+    """The render queue, with this process's QUEUE_WORKERS threads working it."""
+    queue = get_queue()
+    start_workers(queue, render_job, QUEUE_WORKERS)
+    return queue
+
+
+def queued_result(key):
+    """Result of a job another process finished, copied into this process's results, or None."""
+    queue = get_queue()
+    pdf_content = queue.result(key)
+    if pdf_content is None:
+        return None
+    return save_result(key, pdf_content, queue.status(key)['filename'])
+
+
+def job_summary(status):
+    """JSON description of a queued job, with its download URL once it is done."""
+    summary = dict(status, status_url=f"/jobs/{status['id']}")
+    if status['state'] == 'done':
+        summary['download'] = f"/result/{status['id']}.pdf"
+    return summary
+
+
+def pdf_response(key, pdf_source, filename, size=None):
+    """Download response for PDF bytes or an open stored PDF file of the given size, validated by its key."""
+    # A stored file is sent from disk, with sendfile where the server supports it
+    response = send_file(
+        BytesIO(pdf_source) if isinstance(pdf_source, bytes) else pdf_source,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=filename,
+        etag=False
+    )
+    if size is not None:
+        response.content_length = size
+    # Output is deterministic, so the result key identifies the exact bytes
+    response.set_etag(key)
+    response.headers['X-Result-Key'] = key
+    response.headers['Content-Location'] = f'/result/{key}.pdf'
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = RESULT_MAX_AGE
+    return response
+
+
+def not_modified(key):
+    """304 for a client whose If-None-Match already names this result."""
+    metrics.increment('results.not_modified')
+    response = app.response_class(status=304)
+    response.set_etag(key)
+    response.headers['X-Result-Key'] = key
+    return response
+
+
+@app.route('/generate', methods=['POST'])
+def generate_pdf():
+    markdown_text, pdf_filename, settings, error = read_request()
+    if error:
+        return error
+    
+    if request.values.get('output_format') == 'tex':
+        tex_source, error = convert_md_to_latex(markdown_text, settings)
+        if error:
+            return f"Error generating LaTeX: {error}", 500
+        return send_file(
+            BytesIO(tex_source.encode('utf-8')),
+            mimetype='application/x-tex',
+            as_attachment=True,
+            download_name=pdf_filename[:-len('.pdf')] + '.tex'
+        )
+    
+    key = result_key('latex', settings, content_hash(markdown_text))
+    if request.if_none_match.contains(key):
+        return not_modified(key)
+    
+    # Any process on this host may have rendered it already
+    stored = result_store.lookup(key)
+    if stored is not None:
+        response = pdf_response(key, stored.file, stored.filename, stored.size)
+        response.headers['X-Compile-Passes'] = '0'
+        return response
+    
+    result, passes, error = render_result(key, markdown_text, pdf_filename, settings)
     
     if error:
         return f"Error generating PDF: {error}", 500
     
-    pdf_file = BytesIO(pdf_content)
+    response = pdf_response(key, result['pdf'], result['filename'])
+    response.headers['X-Compile-Passes'] = str(passes)
+    return response
+
+
+@app.route('/render', methods=['POST'])
+def render_pdf():
+    markdown_text, pdf_filename, settings, error = read_request()
+    if error:
+        return error
     
-    return send_file(
-        pdf_file,
-        mimetype='application/pdf',
-        as_attachment=True,
-        download_name=pdf_filename
+    key = result_key('latex', settings, content_hash(markdown_text))
+    result, passes, error = render_result(key, markdown_text, pdf_filename, settings)
+    if error:
+        return f"Error generating PDF: {error}", 500
+    return jsonify(dict(result_summary(key, result), compile_passes=passes))
+
+
+@app.route('/result/<key>.pdf')
+def download_result(key):
+    if request.if_none_match.contains(key):
+        return not_modified(key)
+    stored = result_store.lookup(key)
+    if stored is not None:
+        return pdf_response(key, stored.file, stored.filename, stored.size)
+    result = get_result(key) or queued_result(key)
+    if result is None:
+        return "Result not found (it may have expired)", 404
+    return pdf_response(key, result['pdf'], result['filename'])
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    markdown_text, pdf_filename, settings, error = read_request()
+    if error:
+        return error
+    
+    # Identical requests share one job: the job id is the result key
+    key = result_key('latex', settings, content_hash(markdown_text))
+    queue = job_queue()
+    state = queue.submit(key, {'markdown': markdown_text, 'filename': pdf_filename, 'settings': settings})
+    return jsonify(job_summary(queue.status(key))), 200 if state == 'done' else 202
+
+
+@app.route('/jobs/<key>')
+def show_job(key):
+    status = job_queue().status(key)
+    if status is None:
+        return "Job not found", 404
+    return jsonify(job_summary(status))
+
+
+@app.route('/thumbnail/<key>/<int:page>.png')
+def show_thumbnail(key, page):
+    result = get_result(key)
+    if result is None:
+        return "Result not found (it may have expired)", 404
+    dpi = clamp_dpi(request.args.get('dpi', DEFAULT_THUMBNAIL_DPI, type=int))
+    png = get_thumbnail(result, page, dpi)
+    if png is None:
+        return "No such page", 404
+    response = send_file(BytesIO(png), mimetype='image/png')
+    response.set_etag(f'{key}-{page}-{dpi}')
+    response.cache_control.max_age = 3600
+    return response.make_conditional(request)
+
+
+@app.route('/preview', methods=['POST'])
+def show_preview():
+    payload = request.get_json(silent=True) or {}
+    sections = render_preview(
+        str(payload.get('markdown', '')),
+        render_markdown_html,
+        payload.get('known') or (),
+        variant='markdown'
     )
+    return jsonify(sections=sections)
+
+
+@app.route('/metrics')
+def show_metrics():
+    return jsonify(dict(metrics.snapshot(), queue=get_queue().counts()))
 
 
 def main():
+    # Font lookups happen once here rather than in the first XeLaTeX run
+    discover_fonts()
+    warm_fontconfig_cache()
+    if sys.argv[1:2] == ['worker']:
+        # Worker node: render jobs from the shared RENDER_QUEUE until stopped
+        queue = get_queue()
+        if not queue.shared:
+            sys.exit('A worker node needs a shared queue, e.g. RENDER_QUEUE=sqlite:///path/to/queue.db')
+        run_worker(queue, render_job)
+        return
     app.run(debug=True, port=5000)
 
 
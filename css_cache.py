@@ -0,0 +1,43 @@
+"""Reuse pisa's parsed stylesheets across conversions that share the same CSS text.
+
+Every pisa conversion parses its default CSS and <style> blocks again,
+although the artifact converter sends the same element rules with every
+request of a settings profile. install_css_parse_cache wraps
+pisaCSSParser.parse so a parse is kept per CSS source. It has to run in
+every process that converts, including spawned worker processes, which
+never ran the converter script's setup; installing twice is a no-op.
+"""
+import re
+
+from xhtml2pdf.context import pisaCSSParser
+
+MAX_CACHED_STYLESHEETS = 64
+
+# Sources with these constructs act on the conversion context while parsing
+# (page templates, fonts, external files), so their parse is never reused
+UNCACHEABLE_CSS_PATTERN = re.compile(r'@page|@font-face|@import|url\(', re.IGNORECASE)
+
+parsed_stylesheets = {}
+css_cache_installed = False
+
+
+def install_css_parse_cache():
+    """Reuse parsed stylesheets across pisa conversions in this process (once per process)"""
+    global css_cache_installed
+    if css_cache_installed:
+        return
+    parse = pisaCSSParser.parse
+
+    def cached_parse(self, src):
+        if not isinstance(src, str) or UNCACHEABLE_CSS_PATTERN.search(src):
+            return parse(self, src)
+        stylesheet = parsed_stylesheets.get(src)
+        if stylesheet is None:
+            stylesheet = parse(self, src)
+            if len(parsed_stylesheets) >= MAX_CACHED_STYLESHEETS:
+                parsed_stylesheets.pop(next(iter(parsed_stylesheets)))
+            parsed_stylesheets[src] = stylesheet
+        return stylesheet
+
+    pisaCSSParser.parse = cached_parse
+    css_cache_installed = True
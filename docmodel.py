@@ -0,0 +1,173 @@
+"""Parse-once block model of a markdown document, shared by both converters.
+
+A single line scan splits the text into heading, fence, table, callout and
+paragraph blocks. Title extraction, code highlighting, HTML generation and
+LaTeX preprocessing read these blocks instead of re-scanning the text with
+their own regexes, and parsed documents are cached by content hash so a
+repeated request skips the scan altogether.
+"""
+import hashlib
+import re
+from collections import namedtuple
+
+MAX_CACHED_DOCUMENTS = 32
+MAX_CACHED_DOCUMENT_SIZE = 4 * 1024 * 1024   # larger documents are parsed but not kept
+
+# kind is 'heading', 'fence', 'table', 'callout' or 'paragraph' (any other
+# markdown: prose, lists, quotes, blank lines). source is the block's lines
+# exactly as written, so joining every source with '\n' gives the document
+# back. info and content depend on the kind:
+#   heading  - level, heading text
+#   fence    - language, code between the fence lines
+#   table    - number of body rows, source
+#   callout  - marker ('⚠️', '✓', '✗' or '💡'), source
+#   paragraph - None, source
+Block = namedtuple('Block', ['kind', 'source', 'info', 'content'])
+Document = namedtuple('Document', ['blocks', 'title'])
+# One heading of the index: markdown level (1-6), plain-text title, a unique
+# anchor name and the outline depth (0-based, at most one deeper than the
+# heading before it, as PDF outlines require)
+Heading = namedtuple('Heading', ['level', 'title', 'anchor', 'depth'])
+
+HEADING_PATTERN = re.compile(r'(#{1,6})\s+(.+?)\s*$')
+# A backtick fence's info string has no backticks, so ```SELECT 1``` stays inline code
+FENCE_OPEN_PATTERN = re.compile(r'[ \t]*(`{3,}(?=[^`]*$)|~{3,})[ \t]*([^\s`]*)')
+TABLE_SEPARATOR_PATTERN = re.compile(r'[ \t]*\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)+\|?[ \t]*$')
+# A callout may sit in a list item or a blockquote ('> **⚠️ Warning**')
+CALLOUT_PATTERN = re.compile(r'[ \t]*(?:>[ \t]*)*(?:(?:[-*+]|\d+\.)[ \t]+)?\*\*[ \t]*(⚠️|✓|✗|💡)')
+
+# Inline formatting removed from the title, in order
+INLINE_PATTERNS = [
+    (re.compile(r'\*\*(.+?)\*\*'), r'\1'),      # Bold
+    (re.compile(r'\*(.+?)\*'), r'\1'),          # Italic
+    (re.compile(r'__(.+?)__'), r'\1'),          # Bold
+    (re.compile(r'_(.+?)_'), r'\1'),            # Italic
+    (re.compile(r'\[(.+?)\]\(.+?\)'), r'\1'),   # Links
+    (re.compile(r'`(.+?)`'), r'\1'),            # Inline code
+]
+INLINE_MARKUP_PATTERN = re.compile(r'[*_\[`]')
+
+parsed_documents = {}
+
+
+def content_hash(md_text):
+    """Hex digest identifying a markdown text"""
+    return hashlib.sha256(md_text.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+
+def parse_document(md_text):
+    """Return the (cached) Document for a markdown text"""
+    if len(md_text) > MAX_CACHED_DOCUMENT_SIZE:
+        return build_document(md_text)
+    key = content_hash(md_text)
+    document = parsed_documents.get(key)
+    if document is None:
+        document = build_document(md_text)
+        if len(parsed_documents) >= MAX_CACHED_DOCUMENTS:
+            parsed_documents.pop(next(iter(parsed_documents)))
+        parsed_documents[key] = document
+    return document
+
+
+def build_document(md_text):
+    """Parse markdown into a Document without consulting the cache"""
+    blocks = list(iter_blocks(md_text.split('\n')))
+    title = ''
+    for block in blocks:
+        if block.kind == 'heading':
+            title = plain_text(block.content)
+            break
+    return Document(blocks, title)
+
+
+def plain_text(text):
+    """Strip inline markdown formatting (bold, italic, links, code)"""
+    if not INLINE_MARKUP_PATTERN.search(text):
+        return text.strip()
+    for pattern, replacement in INLINE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def iter_blocks(lines):
+    """Yield the Blocks of a list of markdown lines"""
+    paragraph = []
+    index = 0
+    count = len(lines)
+
+    while index < count:
+        line = lines[index]
+        # Cheap character checks first: most lines are plain prose
+        first = line.lstrip()[:1]
+        fence_match = FENCE_OPEN_PATTERN.match(line) if first in ('`', '~') else None
+        heading_match = HEADING_PATTERN.match(line) if line[:1] == '#' else None
+        callout_match = None
+        if '**' in line and (not paragraph or not paragraph[-1].strip()):
+            callout_match = CALLOUT_PATTERN.match(line)
+        is_table = (
+            '|' in line and not fence_match and index + 1 < count
+            and TABLE_SEPARATOR_PATTERN.match(lines[index + 1])
+        )
+
+        if not (fence_match or heading_match or callout_match or is_table):
+            paragraph.append(line)
+            index += 1
+            continue
+
+        if paragraph:
+            source = '\n'.join(paragraph)
+            yield Block('paragraph', source, None, source)
+            paragraph = []
+
+        if fence_match:
+            fence = fence_match.group(1)
+            end = index + 1
+            while end < count:
+                stripped = lines[end].strip()
+                if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                    break
+                end += 1
+            code = '\n'.join(lines[index + 1:end])
+            end = min(end + 1, count)
+            yield Block('fence', '\n'.join(lines[index:end]), fence_match.group(2), code)
+        elif heading_match:
+            end = index + 1
+            yield Block('heading', line, len(heading_match.group(1)), heading_match.group(2))
+        elif callout_match:
+            end = index + 1
+            while end < count and lines[end].strip() and not FENCE_OPEN_PATTERN.match(lines[end]):
+                end += 1
+            source = '\n'.join(lines[index:end])
+            yield Block('callout', source, callout_match.group(1), source)
+        else:
+            end = index + 2
+            while end < count and '|' in lines[end] and lines[end].strip():
+                end += 1
+            source = '\n'.join(lines[index:end])
+            yield Block('table', source, end - index - 2, source)
+        index = end
+
+    if paragraph:
+        source = '\n'.join(paragraph)
+        yield Block('paragraph', source, None, source)
+
+
+def has_callout(document, marker):
+    """Whether any callout block of the document starts with this marker"""
+    return any(block.kind == 'callout' and block.info == marker for block in document.blocks)
+
+
+def largest_table_rows(document):
+    """Body row count of the document's largest table (0 without tables)"""
+    return max((block.info for block in document.blocks if block.kind == 'table'), default=0)
+
+
+def heading_index(document):
+    """The document's headings in order, ready for outlines and tables of contents"""
+    headings = []
+    depth = -1
+    for block in document.blocks:
+        if block.kind == 'heading':
+            depth = min(block.info - 1, depth + 1)
+            headings.append(Heading(block.info, plain_text(block.content), f'h{len(headings) + 1}', depth))
+    return headings
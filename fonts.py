@@ -0,0 +1,180 @@
+"""Find, validate and register the DejaVu fonts once per process.
+
+The artifact CSS asks for 'DejaVu Sans' and 'DejaVu Sans Mono', but pisa
+only draws with fonts registered in reportlab, so without this module it
+silently falls back to Times and Courier. register_fonts looks the font
+files up in the usual font directories, parses each one once (an invalid
+file is skipped), registers the families with reportlab and tells pisa
+their CSS names. The LaTeX converter uses the same file paths to load the
+fonts with fontspec by path instead of by a fontconfig name lookup.
+"""
+import os
+import shutil
+import subprocess
+import time
+
+import metrics
+
+FONT_DIRS = [
+    '/usr/share/fonts',
+    '/usr/local/share/fonts',
+    os.path.expanduser('~/.fonts'),
+    os.path.expanduser('~/.local/share/fonts'),
+    '/Library/Fonts',
+    os.path.expanduser('~/Library/Fonts'),
+    os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+]
+# Extra directories to search first, separated by os.pathsep
+FONT_DIRS_ENV = 'FONT_DIRS'
+
+# Family -> style -> file name. A missing italic falls back to the upright
+# face of the same weight, a missing bold to the regular face.
+FONT_FILES = {
+    'DejaVu Sans': {
+        'normal': 'DejaVuSans.ttf',
+        'bold': 'DejaVuSans-Bold.ttf',
+        'italic': 'DejaVuSans-Oblique.ttf',
+        'boldItalic': 'DejaVuSans-BoldOblique.ttf',
+    },
+    'DejaVu Sans Mono': {
+        'normal': 'DejaVuSansMono.ttf',
+        'bold': 'DejaVuSansMono-Bold.ttf',
+        'italic': 'DejaVuSansMono-Oblique.ttf',
+        'boldItalic': 'DejaVuSansMono-BoldOblique.ttf',
+    },
+}
+STYLE_SUFFIXES = {'normal': '', 'bold': ' Bold', 'italic': ' Oblique', 'boldItalic': ' Bold Oblique'}
+STYLE_FALLBACKS = {'italic': 'normal', 'bold': 'normal', 'boldItalic': 'bold'}
+
+TRUETYPE_SIGNATURES = (b'\x00\x01\x00\x00', b'true', b'OTTO')
+
+font_paths = {}            # file name -> path of a valid font file
+registered_families = {}   # family -> style -> reportlab font name
+fonts_discovered = False
+fonts_registered = False
+
+
+def font_search_dirs():
+    """Font directories to search, FONT_DIRS entries first"""
+    extra = [path for path in os.environ.get(FONT_DIRS_ENV, '').split(os.pathsep) if path]
+    return [path for path in extra + FONT_DIRS if os.path.isdir(path)]
+
+
+def find_font_files(file_names):
+    """Map each wanted file name to the first path found for it, in one walk"""
+    wanted = set(file_names)
+    found = {}
+    for directory in font_search_dirs():
+        for root, _, files in os.walk(directory):
+            for name in wanted.intersection(files):
+                found.setdefault(name, os.path.join(root, name))
+            if len(found) == len(wanted):
+                return found
+    return found
+
+
+def is_font_file(path):
+    """Whether a file starts like a TrueType/OpenType font"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) in TRUETYPE_SIGNATURES
+    except OSError:
+        return False
+
+
+def discover_fonts():
+    """Find the font files of every family in FONT_FILES (once per process)"""
+    global fonts_discovered
+    if not fonts_discovered:
+        fonts_discovered = True
+        start = time.perf_counter()
+        file_names = [name for styles in FONT_FILES.values() for name in styles.values()]
+        for name, path in find_font_files(file_names).items():
+            if is_font_file(path):
+                font_paths[name] = path
+            else:
+                metrics.increment('fonts.invalid')
+        metrics.record_time('fonts.discover', time.perf_counter() - start)
+    return font_paths
+
+
+def load_family(family, styles):
+    """Parse and register one family's faces; return style -> reportlab name"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFError, TTFont
+
+    names = {}
+    for style in ('normal', 'bold', 'italic', 'boldItalic'):
+        path = font_paths.get(styles[style])
+        if path is None:
+            continue
+        name = family + STYLE_SUFFIXES[style]
+        try:
+            pdfmetrics.registerFont(TTFont(name, path))
+        except (TTFError, OSError):
+            metrics.increment('fonts.invalid')
+            del font_paths[styles[style]]
+            continue
+        names[style] = name
+    if 'normal' not in names:
+        return {}
+
+    for style in ('bold', 'italic', 'boldItalic'):
+        if style not in names:
+            names[style] = names.get(STYLE_FALLBACKS[style], names['normal'])
+    pdfmetrics.registerFontFamily(family, **names)
+    return names
+
+
+def register_fonts():
+    """Discover and register every family in FONT_FILES (once per process)"""
+    global fonts_registered
+    if fonts_registered:
+        return registered_families
+    fonts_registered = True
+    discover_fonts()
+
+    from xhtml2pdf.default import DEFAULT_FONT
+
+    start = time.perf_counter()
+    for family, styles in FONT_FILES.items():
+        names = load_family(family, styles)
+        if names:
+            registered_families[family] = names
+            # pisa copies this map into every document it renders
+            DEFAULT_FONT[family.lower()] = names['normal']
+    metrics.record_time('fonts.register', time.perf_counter() - start)
+    return registered_families
+
+
+def font_names(family, fallback):
+    """(regular, bold, italic) reportlab names of a registered family, else fallback"""
+    names = registered_families.get(family)
+    if not names:
+        return fallback
+    return names['normal'], names['bold'], names['italic']
+
+
+def fontspec_font(command, family):
+    """fontspec command loading a discovered family by path, or '' when it was not found"""
+    discover_fonts()
+    styles = FONT_FILES[family]
+    regular = font_paths.get(styles['normal'])
+    if regular is None:
+        return ''
+    directory = os.path.dirname(regular).replace('\\', '/') + '/'
+    options = [f'Path={directory}']
+    for style, key in (('bold', 'BoldFont'), ('italic', 'ItalicFont'), ('boldItalic', 'BoldItalicFont')):
+        path = font_paths.get(styles[style])
+        if path is not None and os.path.dirname(path) == os.path.dirname(regular):
+            options.append(f'{key}={styles[style]}')
+    return f"\\{command}{{{styles['normal']}}}[{', '.join(options)}]"
+
+
+def warm_fontconfig_cache():
+    """Build fontconfig's cache ahead of the first XeLaTeX run; False without fc-cache"""
+    if shutil.which('fc-cache') is None:
+        return False
+    with metrics.timed('fonts.fontconfig_cache'):
+        result = subprocess.run(['fc-cache'], capture_output=True)
+    return result.returncode == 0
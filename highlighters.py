@@ -0,0 +1,265 @@
+"""Built-in syntax highlighters for the artifact converter, and a pool to run them in parallel.
+
+Each highlighter is a single regex pass over HTML-escaped code that wraps
+tokens in the span classes styled by generate_css. They live outside the
+converter script so process pool workers can import them by module name;
+lexers.py maps fence languages onto them.
+"""
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import lexers
+import metrics
+
+HIGHLIGHT_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_BLOCKS = 4
+PARALLEL_MIN_CHARS = 64 * 1024      # total code below this is highlighted serially
+
+highlight_pool = None
+
+
+SQL_KEYWORDS = frozenset([
+    'SELECT', 'FROM', 'WHERE', 'INSERT', 'UPDATE', 'DELETE', 'CREATE', 'DROP', 'ALTER',
+    'TABLE', 'DATABASE', 'INDEX', 'VIEW', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER',
+    'FULL', 'CROSS', 'ON', 'USING', 'AS', 'AND', 'OR', 'NOT', 'NULL', 'IS', 'IN',
+    'BETWEEN', 'LIKE', 'ORDER', 'BY', 'GROUP', 'HAVING', 'LIMIT', 'OFFSET', 'DISTINCT',
+    'UNION', 'ALL', 'INTERSECT', 'EXCEPT', 'EXISTS', 'CASE', 'WHEN', 'THEN', 'ELSE',
+    'END', 'IF', 'WITH', 'RECURSIVE', 'ASC', 'DESC', 'INTO', 'VALUES', 'SET', 'DEFAULT',
+    'PRIMARY', 'KEY', 'FOREIGN', 'REFERENCES', 'CONSTRAINT', 'UNIQUE', 'CHECK',
+    'AUTO_INCREMENT', 'SERIAL', 'AUTOINCREMENT', 'IDENTITY', 'RETURNS', 'BEGIN',
+    'COMMIT', 'ROLLBACK', 'TRANSACTION', 'GRANT', 'REVOKE', 'CASCADE', 'RESTRICT',
+    'INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT', 'DECIMAL', 'NUMERIC', 'FLOAT',
+    'REAL', 'DOUBLE', 'VARCHAR', 'CHAR', 'TEXT', 'BLOB', 'DATE', 'TIME', 'DATETIME',
+    'TIMESTAMP', 'BOOLEAN', 'BOOL', 'ENUM', 'JSON', 'ARRAY'
+])
+SQL_FUNCTIONS = frozenset([
+    'COUNT', 'SUM', 'AVG', 'MAX', 'MIN', 'CONCAT', 'UPPER', 'LOWER', 'LENGTH',
+    'SUBSTRING', 'TRIM', 'ROUND', 'FLOOR', 'CEIL', 'ABS', 'NOW', 'CURRENT_DATE',
+    'CURRENT_TIME', 'CURRENT_TIMESTAMP', 'DATE', 'TIME', 'YEAR', 'MONTH', 'DAY',
+    'COALESCE', 'NULLIF', 'CAST', 'CONVERT'
+])
+
+PYTHON_KEYWORDS = frozenset([
+    'def', 'class', 'import', 'from', 'as', 'if', 'elif', 'else', 'for', 'while',
+    'return', 'try', 'except', 'finally', 'with', 'lambda', 'yield', 'async', 'await',
+    'pass', 'break', 'continue', 'and', 'or', 'not', 'in', 'is', 'None', 'True', 'False',
+    'raise', 'assert', 'del', 'global', 'nonlocal'
+])
+PYTHON_BUILTINS = frozenset([
+    'print', 'len', 'range', 'str', 'int', 'float', 'list', 'dict', 'set', 'tuple',
+    'open', 'input', 'type', 'isinstance', 'enumerate', 'zip', 'map', 'filter', 'sum',
+    'max', 'min', 'sorted', 'reversed', 'all', 'any', 'abs', 'round', 'pow'
+])
+# PySpark specific keywords and functions
+PYSPARK_BUILTINS = PYTHON_BUILTINS | frozenset([
+    'SparkSession', 'SparkContext', 'SQLContext', 'HiveContext',
+    'DataFrame', 'Column', 'Row', 'GroupedData',
+    'select', 'filter', 'where', 'groupBy', 'orderBy', 'sortBy',
+    'join', 'union', 'distinct', 'drop', 'dropDuplicates',
+    'withColumn', 'withColumnRenamed', 'alias', 'cast',
+    'agg', 'count', 'collect', 'show', 'printSchema', 'describe',
+    'read', 'write', 'csv', 'json', 'parquet', 'orc', 'jdbc',
+    'createDataFrame', 'createOrReplaceTempView', 'sql',
+    'cache', 'persist', 'unpersist', 'checkpoint', 'repartition', 'coalesce',
+    'broadcast', 'accumulator', 'parallelize',
+    'map', 'flatMap', 'reduceByKey', 'groupByKey', 'sortByKey',
+    'col', 'lit', 'when', 'otherwise', 'isnull', 'isnan',
+    'concat', 'concat_ws', 'substring', 'trim', 'lower', 'upper',
+    'split', 'explode', 'array', 'struct', 'to_date', 'to_timestamp',
+    'datediff', 'date_add', 'date_sub', 'year', 'month', 'dayofmonth',
+    'window', 'partitionBy', 'over', 'rowNumber', 'rank', 'dense_rank',
+    'lag', 'lead', 'first', 'last', 'collect_list', 'collect_set',
+    'approx_count_distinct', 'countDistinct', 'sumDistinct',
+    'udf', 'pandas_udf', 'PandasUDFType'
+])
+
+R_KEYWORDS = frozenset([
+    'if', 'else', 'for', 'while', 'repeat', 'in', 'next', 'break',
+    'function', 'return', 'TRUE', 'FALSE', 'NULL', 'NA', 'NA_integer_',
+    'NA_real_', 'NA_complex_', 'NA_character_', 'Inf', 'NaN',
+    'library', 'require', 'source', 'setwd', 'getwd'
+])
+R_BUILTINS = frozenset([
+    'print', 'cat', 'paste', 'paste0', 'sprintf', 'format',
+    'c', 'list', 'vector', 'matrix', 'array', 'data.frame', 'tibble',
+    'length', 'nrow', 'ncol', 'dim', 'names', 'colnames', 'rownames',
+    'head', 'tail', 'str', 'summary', 'class', 'typeof', 'mode',
+    'sum', 'mean', 'median', 'sd', 'var', 'min', 'max', 'range',
+    'abs', 'sqrt', 'log', 'log10', 'log2', 'exp', 'round', 'floor', 'ceiling',
+    'seq', 'rep', 'sort', 'order', 'rank', 'rev', 'unique', 'duplicated',
+    'which', 'any', 'all', 'is.na', 'is.null', 'is.numeric', 'is.character',
+    'as.numeric', 'as.character', 'as.factor', 'as.Date', 'as.POSIXct',
+    'subset', 'merge', 'rbind', 'cbind', 'split', 'apply', 'lapply', 'sapply',
+    'mapply', 'tapply', 'aggregate', 'transform', 'within',
+    'read.csv', 'read.table', 'write.csv', 'write.table', 'readRDS', 'saveRDS',
+    'grep', 'grepl', 'sub', 'gsub', 'regexpr', 'strsplit', 'nchar', 'substr',
+    'tolower', 'toupper', 'trimws', 'chartr',
+    'factor', 'levels', 'nlevels', 'droplevels', 'cut', 'table', 'prop.table',
+    'plot', 'hist', 'boxplot', 'barplot', 'pie', 'lines', 'points', 'abline',
+    'ggplot', 'aes', 'geom_point', 'geom_line', 'geom_bar', 'geom_histogram',
+    'geom_boxplot', 'facet_wrap', 'facet_grid', 'theme', 'labs', 'ggtitle',
+    'mutate', 'select', 'filter', 'arrange', 'group_by', 'summarise', 'summarize',
+    'left_join', 'right_join', 'inner_join', 'full_join', 'anti_join', 'semi_join',
+    'bind_rows', 'bind_cols', 'pivot_longer', 'pivot_wider', 'gather', 'spread',
+    'rename', 'relocate', 'across', 'everything', 'starts_with', 'ends_with',
+    'contains', 'matches', 'num_range', 'where', 'pull', 'distinct', 'count',
+    'slice', 'slice_head', 'slice_tail', 'slice_min', 'slice_max', 'slice_sample',
+    'lm', 'glm', 'aov', 'anova', 't.test', 'chisq.test', 'cor', 'cov',
+    'predict', 'fitted', 'residuals', 'coef', 'confint',
+    'tryCatch', 'stop', 'warning', 'message', 'stopifnot'
+])
+
+# One alternation per language, tried left to right at each position, so a
+# token is classified once and never re-scanned: strings hide the comment
+# markers inside them, and inserted <span class=...> markup is never seen
+# again. 'entity' swallows HTML entities of already escaped code.
+SQL_TOKEN_PATTERN = re.compile(r"""
+    (?P<string>'(?:[^'\\]|\\.)*')
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<entity>&\#?\w+;)
+  | (?P<call>[A-Za-z_]\w*)(?=\s*\()
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<number>\b\d+\.?\d*\b)
+""", re.VERBOSE | re.DOTALL)
+
+PYTHON_TOKEN_PATTERN = re.compile(r"""
+    (?P<string>\"\"\"(?:[^"\\]|\\.)*?\"\"\"|'''(?:[^'\\]|\\.)*?'''|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<comment>\#[^\n]*)
+  | (?P<entity>&\#?\w+;)
+  | (?P<decorator>@\w+)
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<number>\b\d+\.?\d*\b)
+""", re.VERBOSE | re.DOTALL)
+
+R_TOKEN_PATTERN = re.compile(r"""
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<comment>\#[^\n]*)
+  | (?P<assign>&lt;&lt;-|&lt;-|-&gt;&gt;|-&gt;|<<-|<-|->>|->)
+  | (?P<pipe>%&gt;%|%&lt;&gt;%|\|&gt;|%>%|%<>%|\|>)
+  | (?P<entity>&\#?\w+;)
+  | (?P<word>(?:[A-Za-z]|\.(?!\d))[\w.]*)
+  | (?P<number>\b\d+\.?\d*(?:[eE][+-]?\d+)?[Li]?\b)
+""", re.VERBOSE | re.DOTALL)
+
+
+def span(css_class, text):
+    return f'<span class="{css_class}">{text}</span>'
+
+
+def highlight_sql(code):
+    """LaTeX-quality SQL syntax highlighting"""
+    def replace(match):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'string':
+            return span('sql-string', text)
+        if kind == 'comment':
+            return span('sql-comment', text)
+        if kind == 'number':
+            return span('sql-number', text)
+        if kind in ('call', 'word'):
+            upper = text.upper()
+            if kind == 'call' and upper in SQL_FUNCTIONS:
+                return span('sql-function', text)
+            if upper in SQL_KEYWORDS:
+                return span('sql-keyword', text)
+        return text
+
+    return SQL_TOKEN_PATTERN.sub(replace, code)
+
+
+def highlight_python(code, is_pyspark=False):
+    """LaTeX-quality Python/PySpark syntax highlighting"""
+    builtins = PYSPARK_BUILTINS if is_pyspark else PYTHON_BUILTINS
+
+    def replace(match):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'string':
+            return span('py-string', text)
+        if kind == 'comment':
+            return span('py-comment', text)
+        if kind == 'decorator':
+            return span('py-decorator', text)
+        if kind == 'number':
+            return span('py-number', text)
+        if kind == 'word':
+            if text in PYTHON_KEYWORDS:
+                return span('py-keyword', text)
+            if text in builtins:
+                return span('py-builtin', text)
+        return text
+
+    return PYTHON_TOKEN_PATTERN.sub(replace, code)
+
+
+def highlight_pyspark(code):
+    """Python highlighting with the PySpark API names as builtins"""
+    return highlight_python(code, is_pyspark=True)
+
+
+def highlight_r(code):
+    """LaTeX-quality R syntax highlighting"""
+    def replace(match):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'string':
+            return span('py-string', text)
+        if kind == 'comment':
+            return span('py-comment', text)
+        if kind == 'number':
+            return span('py-number', text)
+        if kind == 'assign':
+            return span('py-keyword', text)
+        if kind == 'pipe':
+            return span('sql-function', text)
+        if kind == 'word':
+            if text in R_KEYWORDS:
+                return span('py-keyword', text)
+            if text in R_BUILTINS:
+                return span('py-builtin', text)
+        return text
+
+    return R_TOKEN_PATTERN.sub(replace, code)
+
+
+def highlight_code(code, lang):
+    """Highlight escaped code with the lexer registered for its fence language"""
+    return lexers.highlight(code, lang)
+
+
+def get_highlight_pool():
+    """Return the worker pool shared by every request, starting it on first use"""
+    global highlight_pool
+    if highlight_pool is None:
+        highlight_pool = ProcessPoolExecutor(max_workers=HIGHLIGHT_WORKERS)
+    return highlight_pool
+
+
+def highlight_blocks(blocks):
+    """Highlight a list of (code, lang) pairs, returning the results in order.
+
+    Documents with many blocks and enough code are spread over the process
+    pool; small ones stay serial, where pickling would cost more than it saves.
+    """
+    total_chars = sum(len(code) for code, _ in blocks)
+    if HIGHLIGHT_WORKERS < 2 or len(blocks) < PARALLEL_MIN_BLOCKS or total_chars < PARALLEL_MIN_CHARS:
+        return [highlight_code(code, lang) for code, lang in blocks]
+
+    # Workers keep their own per-lexer metrics, so time the whole batch here
+    global highlight_pool
+    codes = [code for code, _ in blocks]
+    langs = [lang for _, lang in blocks]
+    chunksize = max(1, len(blocks) // (HIGHLIGHT_WORKERS * 4))
+    start = time.perf_counter()
+    try:
+        highlighted = list(get_highlight_pool().map(highlight_code, codes, langs, chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool next time
+        highlight_pool = None
+        return [highlight_code(code, lang) for code, lang in blocks]
+    metrics.record_time('highlight.parallel_batch', time.perf_counter() - start)
+    return highlighted
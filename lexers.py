@@ -0,0 +1,158 @@
+"""Registry of code highlighters, looked up by fence language.
+
+Every lexer has a name, its fence aliases, a 'module:function' path to its
+highlight function and the LaTeX listings style used by the Pandoc
+converter. One alias index resolves any fence language with a single dict
+lookup, and the function is only imported the first time its language is
+used. Languages without a built-in lexer fall back to Pygments when it is
+installed, with one lexer instance kept warm per language.
+
+Highlight functions take HTML-escaped code and return it with tokens
+wrapped in the span classes styled by generate_css.
+"""
+import importlib
+import time
+from collections import namedtuple
+from html import escape, unescape
+
+import metrics
+
+MAX_CACHED_PYGMENTS_LEXERS = 64
+
+Lexer = namedtuple('Lexer', ['name', 'aliases', 'target', 'latex_style'])
+
+registered_lexers = {}       # name -> Lexer
+alias_index = {}             # lowercase alias -> name
+loaded_highlighters = {}     # name -> highlight function
+pygments_lexers = {}         # lowercase language -> Pygments lexer, or None when it has none
+pygments_classes = {}        # Pygments token type -> span class, or None for plain text
+
+# Pygments token types, most specific first, mapped onto the existing span classes
+PYGMENTS_TOKEN_CLASSES = [
+    ('Comment', 'py-comment'),
+    ('Literal.String', 'py-string'),
+    ('Literal.Number', 'py-number'),
+    ('Name.Decorator', 'py-decorator'),
+    ('Name.Builtin', 'py-builtin'),
+    ('Name.Function', 'py-function'),
+    ('Name.Class', 'py-function'),
+    ('Keyword', 'py-keyword'),
+    ('Operator.Word', 'py-keyword'),
+]
+
+
+def register_lexer(name, aliases, target, latex_style='defaultstyle'):
+    """Register (or replace) a lexer; target is a 'module:function' path"""
+    lexer = Lexer(name, tuple(aliases), target, latex_style)
+    registered_lexers[name] = lexer
+    loaded_highlighters.pop(name, None)
+    for alias in (name,) + lexer.aliases:
+        alias_index[alias.lower()] = name
+    return lexer
+
+
+def find_lexer(lang):
+    """Return the registered Lexer for a fence language, or None"""
+    name = alias_index.get(lang.lower().strip())
+    return registered_lexers[name] if name else None
+
+
+def get_highlighter(lexer):
+    """Import (once) and return a lexer's highlight function"""
+    highlighter = loaded_highlighters.get(lexer.name)
+    if highlighter is None:
+        module_name, _, function_name = lexer.target.partition(':')
+        highlighter = getattr(importlib.import_module(module_name), function_name)
+        loaded_highlighters[lexer.name] = highlighter
+    return highlighter
+
+
+def highlight(code, lang):
+    """Highlight escaped code for a fence language; unknown languages come back unchanged"""
+    lexer = find_lexer(lang)
+    if lexer is not None:
+        with metrics.timed(f'lexer.{lexer.name}'):
+            return get_highlighter(lexer)(code)
+    if lang.strip():
+        return highlight_with_pygments(code, lang)
+    return code
+
+
+def latex_style(lang):
+    """LaTeX listings style for a fence language"""
+    lexer = find_lexer(lang) if lang else None
+    return lexer.latex_style if lexer else 'defaultstyle'
+
+
+def get_pygments_lexer(lang):
+    """Return the cached Pygments lexer for a language, or None"""
+    key = lang.lower().strip()
+    if key in pygments_lexers:
+        return pygments_lexers[key]
+
+    try:
+        from pygments.lexers import get_lexer_by_name
+        from pygments.util import ClassNotFound
+    except ImportError:  # the fallback is optional
+        lexer = None
+    else:
+        start = time.perf_counter()
+        try:
+            lexer = get_lexer_by_name(key, stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            lexer = None
+        metrics.record_time('pygments.load', time.perf_counter() - start)
+
+    if len(pygments_lexers) >= MAX_CACHED_PYGMENTS_LEXERS:
+        pygments_lexers.pop(next(iter(pygments_lexers)))
+    pygments_lexers[key] = lexer
+    return lexer
+
+
+def pygments_class(token_type):
+    """Span class for a Pygments token type, from the type or its nearest parent"""
+    if token_type in pygments_classes:
+        return pygments_classes[token_type]
+
+    from pygments.token import string_to_tokentype
+
+    classes = {string_to_tokentype(name): css_class for name, css_class in PYGMENTS_TOKEN_CLASSES}
+    css_class = None
+    parent = token_type
+    while parent is not None:
+        if parent in classes:
+            css_class = classes[parent]
+            break
+        parent = parent.parent
+    pygments_classes[token_type] = css_class
+    return css_class
+
+
+def highlight_with_pygments(code, lang):
+    """Highlight escaped code with Pygments, keeping every span on one line"""
+    lexer = get_pygments_lexer(lang)
+    if lexer is None:
+        metrics.increment('pygments.unknown_language')
+        return code
+
+    start = time.perf_counter()
+    parts = []
+    for token_type, value in lexer.get_tokens(unescape(code)):
+        value = escape(value, quote=False)
+        css_class = pygments_class(token_type)
+        if css_class is None or not value.strip():
+            parts.append(value)
+        else:
+            parts.append('\n'.join(
+                f'<span class="{css_class}">{piece}</span>' if piece else piece
+                for piece in value.split('\n')
+            ))
+    metrics.record_time(f'pygments.{lexer.name}', time.perf_counter() - start)
+    return ''.join(parts)
+
+
+register_lexer('sql', ['mysql', 'postgresql', 'postgres', 'sqlite', 'tsql', 'plsql'],
+               'highlighters:highlight_sql', 'sqlstyle')
+register_lexer('python', ['py', 'python3'], 'highlighters:highlight_python', 'pythonstyle')
+register_lexer('pyspark', ['spark'], 'highlighters:highlight_pyspark', 'pythonstyle')
+register_lexer('r', ['rlang', 'rscript'], 'highlighters:highlight_r', 'rstyle')
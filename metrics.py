@@ -0,0 +1,51 @@
+"""Process-wide counters and timings, served as JSON by the converters' /metrics route.
+
+Metrics live in the process that records them; pool workers keep their own.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+metrics_lock = threading.Lock()
+counters = {}
+timings = {}
+
+
+def increment(name, amount=1):
+    """Add amount to a counter"""
+    with metrics_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def record_time(name, seconds):
+    """Add one observation, in seconds, to a timing"""
+    ms = seconds * 1000
+    with metrics_lock:
+        timing = timings.get(name)
+        if timing is None:
+            timing = timings[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        timing['count'] += 1
+        timing['total_ms'] += ms
+        timing['max_ms'] = max(timing['max_ms'], ms)
+
+
+@contextmanager
+def timed(name):
+    """Record the wall time of the with-block under name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, time.perf_counter() - start)
+
+
+def snapshot():
+    """Copy of every counter and timing, with the mean of each timing"""
+    with metrics_lock:
+        return {
+            'counters': dict(counters),
+            'timings': {
+                name: dict(timing, mean_ms=timing['total_ms'] / timing['count'])
+                for name, timing in timings.items()
+            },
+        }
@@ -0,0 +1,132 @@
+"""Post-processing of rendered PDFs, shared by both converters.
+
+merge_pdfs binds several rendered documents into one PDF with a bookmark
+per document. For size optimization, a profile names the steps to run on
+a finished PDF: recompressing page content streams, merging identical
+objects (repeated code-block backgrounds, fonts and images) and
+linearizing for fast web view. Every run checks for fonts embedded
+without subsetting and records the sizes before and after, and the time
+it took, in metrics. A result that comes out larger than its input is
+dropped in favour of the input.
+"""
+import re
+import time
+from io import BytesIO
+
+import metrics
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # optimization is optional
+    PdfReader = PdfWriter = None
+
+try:
+    import pikepdf
+except ImportError:  # linearization is optional
+    pikepdf = None
+
+OPTIMIZE_PROFILES = {
+    'none': (),
+    'compact': ('compress', 'dedupe'),
+    'web': ('compress', 'dedupe', 'linearize'),
+}
+COMPRESSION_LEVEL = 9
+
+SUBSET_PREFIX_PATTERN = re.compile(r'^/?[A-Z]{6}\+')
+FONT_FILE_KEYS = ('/FontFile', '/FontFile2', '/FontFile3')
+
+
+def iter_font_descriptors(reader):
+    """Yield (base font name, font descriptor) for every font used on a page"""
+    seen = set()
+    for page in reader.pages:
+        resources = page.get('/Resources')
+        fonts = resources.get_object().get('/Font') if resources else None
+        if not fonts:
+            continue
+        for font in fonts.get_object().values():
+            font = font.get_object()
+            descendants = font.get('/DescendantFonts')
+            candidates = [item.get_object() for item in descendants.get_object()] if descendants else [font]
+            for candidate in candidates:
+                descriptor = candidate.get('/FontDescriptor')
+                if descriptor is None or id(descriptor.get_object()) in seen:
+                    continue
+                seen.add(id(descriptor.get_object()))
+                yield str(candidate.get('/BaseFont', '')), descriptor.get_object()
+
+
+def unsubset_fonts(reader):
+    """Names of embedded fonts carrying every glyph instead of a subset"""
+    return [
+        name for name, descriptor in iter_font_descriptors(reader)
+        if any(key in descriptor for key in FONT_FILE_KEYS) and not SUBSET_PREFIX_PATTERN.match(name)
+    ]
+
+
+def linearize(pdf_content):
+    """Linearized copy of a PDF, or the PDF unchanged without pikepdf"""
+    if pikepdf is None:
+        metrics.increment('pdf.linearize_unavailable')
+        return pdf_content
+    output = BytesIO()
+    with pikepdf.open(BytesIO(pdf_content)) as pdf:
+        pdf.save(output, linearize=True, deterministic_id=True)
+    return output.getvalue()
+
+
+def optimize_pdf(pdf_content, profile='none'):
+    """Run a profile's optimization steps on a PDF and return the smaller of the two"""
+    steps = OPTIMIZE_PROFILES.get(profile, ())
+    if not steps:
+        return pdf_content
+    if PdfWriter is None:
+        metrics.increment('pdf.optimize_unavailable')
+        return pdf_content
+
+    start = time.perf_counter()
+    reader = PdfReader(BytesIO(pdf_content))
+    fonts = unsubset_fonts(reader)
+    if fonts:
+        metrics.increment('pdf.unsubset_fonts', len(fonts))
+
+    writer = PdfWriter(clone_from=reader)
+    if 'compress' in steps:
+        for page in writer.pages:
+            page.compress_content_streams(level=COMPRESSION_LEVEL)
+    if 'dedupe' in steps:
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+    output = BytesIO()
+    writer.write(output)
+    optimized = output.getvalue()
+    if 'linearize' in steps:
+        optimized = linearize(optimized)
+
+    metrics.record_time(f'pdf.optimize.{profile}', time.perf_counter() - start)
+    metrics.increment('pdf.optimize.bytes_before', len(pdf_content))
+    if len(optimized) >= len(pdf_content):
+        metrics.increment('pdf.optimize.bytes_after', len(pdf_content))
+        metrics.increment('pdf.optimize.not_smaller')
+        return pdf_content
+    metrics.increment('pdf.optimize.bytes_after', len(optimized))
+    return optimized
+
+
+def merge_pdfs(parts):
+    """Bind (bookmark title, PDF bytes) parts, in order, into one PDF.
+
+    Returns (pdf, error). Every part gets a top-level bookmark on its first
+    page, with the bookmarks it already has nested under it, and pages are
+    numbered straight through.
+    """
+    if PdfWriter is None:
+        return None, "Merging PDFs needs the 'pypdf' package"
+    with metrics.timed('pdf.merge'):
+        writer = PdfWriter()
+        for title, pdf_content in parts:
+            writer.append(PdfReader(BytesIO(pdf_content)), outline_item=title)
+        writer.page_mode = '/UseOutlines'
+        output = BytesIO()
+        writer.write(output)
+    metrics.increment('pdf.merged_documents', len(parts))
+    return output.getvalue(), None
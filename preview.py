@@ -0,0 +1,73 @@
+"""Section-by-section HTML preview behind both converters' /preview routes.
+
+The page posts the whole markdown text together with the hashes of the
+sections it already shows. The text is split at its headings, each section
+is rendered once per hash and cached, and only the sections the page does
+not have yet carry HTML in the reply, so a keystroke re-renders one section
+instead of the whole document.
+"""
+from docmodel import content_hash, parse_document
+import metrics
+
+MAX_CACHED_SECTIONS = 1024
+MAX_KNOWN_HASHES = 4096
+
+rendered_sections = {}   # section hash -> HTML
+
+
+def split_sections(md_text):
+    """Markdown source of each section; a section starts at every heading"""
+    sections = []
+    current = []
+    for block in parse_document(md_text).blocks:
+        if block.kind == 'heading' and current:
+            sections.append('\n'.join(current))
+            current = []
+        current.append(block.source)
+    if current:
+        sections.append('\n'.join(current))
+    return sections
+
+
+def section_hash(source, variant=''):
+    """Hash of a section's source under one rendering variant (renderer and its options)"""
+    return content_hash(f'{variant}\x00{source}')
+
+
+def render_section(source, render, variant=''):
+    """Return (hash, cached HTML) for one section"""
+    key = section_hash(source, variant)
+    html = rendered_sections.get(key)
+    if html is None:
+        metrics.increment('preview.section_rendered')
+        with metrics.timed('preview.render'):
+            html = render(source)
+        if len(rendered_sections) >= MAX_CACHED_SECTIONS:
+            rendered_sections.pop(next(iter(rendered_sections)))
+        rendered_sections[key] = html
+    else:
+        metrics.increment('preview.section_cached')
+    return key, html
+
+
+def render_preview(md_text, render, known_hashes=(), variant=''):
+    """Section list for the page: every hash in order, HTML only for hashes it lacks"""
+    if not isinstance(known_hashes, (list, tuple)):
+        known_hashes = ()
+    known = {key for key in known_hashes[:MAX_KNOWN_HASHES] if isinstance(key, str)}
+    sections = []
+    for source in split_sections(md_text):
+        key = section_hash(source, variant)
+        if key in known:
+            metrics.increment('preview.section_skipped')
+            sections.append({'hash': key})
+        else:
+            key, html = render_section(source, render, variant)
+            sections.append({'hash': key, 'html': html})
+    return sections
+
+
+def render_markdown_html(source):
+    """Plain Python-Markdown HTML, for converters without an HTML pipeline of their own"""
+    import markdown
+    return markdown.markdown(source, extensions=['tables', 'fenced_code'])
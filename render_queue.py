@@ -0,0 +1,318 @@
+"""Render jobs on a pluggable queue, so several processes share one backlog.
+
+A job's id is its result key (converter, settings and markdown hash), so
+submitting a job that is already queued, running or done returns that job
+instead of adding a duplicate, and a failed job is queued again. Workers
+claim one job at a time for LEASE_SECONDS; a job whose worker died is
+handed to another worker once its lease runs out, up to MAX_ATTEMPTS
+claims. The finished PDF is kept with the job, where every process using
+the same queue can read it.
+
+RENDER_QUEUE picks the backend:
+    memory                      this process only, worked by its own threads (default)
+    sqlite:///path/to/queue.db  a SQLite file shared by every process that opens it,
+                                a local stand-in for a networked broker
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import deque, namedtuple
+
+import metrics
+
+RENDER_QUEUE = os.environ.get('RENDER_QUEUE', 'memory')
+LEASE_SECONDS = 15 * 60
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.5
+MAX_FINISHED_JOBS = 64              # memory queue: finished jobs (and their PDFs) kept
+JOB_RETENTION = 24 * 60 * 60        # SQLite queue: seconds finished jobs are kept
+
+# state: 'queued', 'running', 'done' or 'failed'
+Job = namedtuple('Job', ['id', 'payload', 'attempts'])
+
+configured_queue = None
+local_workers = []
+queue_lock = threading.Lock()
+
+
+def job_status(job_id, state, payload, attempts, worker, error, created, finished):
+    """Status dict of a job, as both backends report it"""
+    return {
+        'id': job_id,
+        'state': state,
+        'filename': payload.get('filename'),
+        'attempts': attempts,
+        'worker': worker,
+        'error': error,
+        'created': created,
+        'finished': finished,
+    }
+
+
+class MemoryQueue:
+    """Queue held in this process; a crash loses it, so it needs no leases"""
+
+    shared = False
+
+    def __init__(self):
+        self.jobs = {}            # id -> job dict
+        self.pending = deque()    # ids of queued jobs, oldest first
+        self.finished = deque()   # ids of finished jobs, oldest first
+        self.condition = threading.Condition()
+
+    def submit(self, job_id, payload):
+        """Queue a job unless it is already queued, running or done; return its state"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is not None and job['state'] != 'failed':
+                metrics.increment('queue.deduplicated')
+                return job['state']
+            if job is not None:
+                self.finished.remove(job_id)
+            self.jobs[job_id] = {
+                'state': 'queued', 'payload': payload, 'attempts': 0, 'worker': None, 'error': None,
+                'result': None, 'created': time.time(), 'finished': None,
+            }
+            self.pending.append(job_id)
+            self.condition.notify()
+        metrics.increment('queue.submitted')
+        return 'queued'
+
+    def claim(self, worker_id, wait=0):
+        """Take the oldest queued job, waiting up to wait seconds for one; None when there is none"""
+        deadline = time.monotonic() + wait
+        with self.condition:
+            while not self.pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            job_id = self.pending.popleft()
+            job = self.jobs[job_id]
+            job.update(state='running', worker=worker_id, attempts=job['attempts'] + 1)
+            return Job(job_id, job['payload'], job['attempts'])
+
+    def finish(self, job_id, pdf_content=None, error=None):
+        """Record a claimed job's PDF, or its error"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job['state'] != 'running':
+                return
+            job.update(state='failed' if error else 'done', result=pdf_content, error=error, finished=time.time())
+            self.finished.append(job_id)
+            if len(self.finished) > MAX_FINISHED_JOBS:
+                self.jobs.pop(self.finished.popleft(), None)
+
+    def status(self, job_id):
+        """Status dict of a job, or None for an unknown id"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return job_status(job_id, job['state'], job['payload'], job['attempts'], job['worker'],
+                              job['error'], job['created'], job['finished'])
+
+    def result(self, job_id):
+        """PDF of a finished job, or None"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            return job['result'] if job is not None else None
+
+    def counts(self):
+        """Number of jobs in each state"""
+        with self.condition:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['state']] = counts.get(job['state'], 0) + 1
+            return counts
+
+
+class SqliteQueue:
+    """Queue in a SQLite file, shared by every process that opens the same file"""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            lease_until REAL,
+            error TEXT,
+            result BLOB,
+            created REAL NOT NULL,
+            finished REAL
+        )''')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, created)')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_by_finished ON jobs (finished)')
+
+    def connection(self):
+        """This thread's connection (sqlite3 connections are not shared between threads)"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        return db
+
+    def submit(self, job_id, payload):
+        """Queue a job unless it is already queued, running or done; return its state"""
+        db = self.connection()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM jobs WHERE finished < ?', (now - JOB_RETENTION,))
+            row = db.execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is not None and row[0] != 'failed':
+                db.execute('COMMIT')
+                metrics.increment('queue.deduplicated')
+                return row[0]
+            db.execute(
+                'INSERT OR REPLACE INTO jobs (id, state, payload, created) VALUES (?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(payload), now)
+            )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        metrics.increment('queue.submitted')
+        return 'queued'
+
+    def claim(self, worker_id, wait=0):
+        """Take the oldest queued (or lease-expired) job, polling up to wait seconds; None when there is none"""
+        deadline = time.monotonic() + wait
+        while True:
+            job = self.claim_once(worker_id)
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(POLL_INTERVAL, max(0, deadline - time.monotonic())))
+
+    def claim_once(self, worker_id):
+        db = self.connection()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            while True:
+                row = db.execute(
+                    "SELECT id, payload, attempts FROM jobs"
+                    " WHERE state = 'queued' OR (state = 'running' AND lease_until < ?)"
+                    " ORDER BY created LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    db.execute('COMMIT')
+                    return None
+                job_id, payload, attempts = row
+                if attempts >= MAX_ATTEMPTS:
+                    # Every worker that took it so far died; stop handing it out
+                    metrics.increment('queue.abandoned')
+                    db.execute(
+                        "UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ?",
+                        (f'No worker finished the job in {attempts} attempts', now, job_id)
+                    )
+                    continue
+                if attempts:
+                    metrics.increment('queue.lease_expired')
+                db.execute(
+                    "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = ? WHERE id = ?",
+                    (worker_id, now + LEASE_SECONDS, attempts + 1, job_id)
+                )
+                db.execute('COMMIT')
+                return Job(job_id, json.loads(payload), attempts + 1)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def finish(self, job_id, pdf_content=None, error=None):
+        """Record a claimed job's PDF, or its error"""
+        self.connection().execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, finished = ?, lease_until = NULL"
+            " WHERE id = ? AND state = 'running'",
+            ('failed' if error else 'done', pdf_content, error, time.time(), job_id)
+        )
+
+    def status(self, job_id):
+        """Status dict of a job, or None for an unknown id"""
+        row = self.connection().execute(
+            'SELECT state, payload, attempts, worker, error, created, finished FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        state, payload, attempts, worker, error, created, finished = row
+        return job_status(job_id, state, json.loads(payload), attempts, worker, error, created, finished)
+
+    def result(self, job_id):
+        """PDF of a finished job, or None"""
+        row = self.connection().execute(
+            "SELECT result FROM jobs WHERE id = ? AND state = 'done'", (job_id,)
+        ).fetchone()
+        return bytes(row[0]) if row is not None and row[0] is not None else None
+
+    def counts(self):
+        """Number of jobs in each state"""
+        return dict(self.connection().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+
+def open_queue(url):
+    """Queue backend for a RENDER_QUEUE value"""
+    if url == 'memory':
+        return MemoryQueue()
+    if url.startswith('sqlite:///'):
+        return SqliteQueue(url[len('sqlite:///'):])
+    raise ValueError(f'Unknown render queue {url!r}; use memory or sqlite:///path')
+
+
+def get_queue():
+    """Return the queue named by RENDER_QUEUE, opening it on first use"""
+    global configured_queue
+    with queue_lock:
+        if configured_queue is None:
+            configured_queue = open_queue(RENDER_QUEUE)
+    return configured_queue
+
+
+def worker_name():
+    """Id a worker reports while it holds a job: host, process and thread"""
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+
+
+def run_worker(queue, handler, max_jobs=None, stop=None):
+    """Claim and run jobs until stop is set (or max_jobs ran).
+
+    handler(job_id, payload) returns (pdf, error); an exception it raises
+    fails the job with its message.
+    """
+    worker_id = worker_name()
+    done = 0
+    while (stop is None or not stop.is_set()) and (max_jobs is None or done < max_jobs):
+        job = queue.claim(worker_id, wait=POLL_INTERVAL)
+        if job is None:
+            continue
+        start = time.perf_counter()
+        try:
+            pdf_content, error = handler(job.id, job.payload)
+        except Exception as e:
+            pdf_content, error = None, f'{type(e).__name__}: {e}'
+        queue.finish(job.id, pdf_content, error)
+        metrics.record_time('queue.job', time.perf_counter() - start)
+        metrics.increment('queue.failed' if error else 'queue.done')
+        done += 1
+
+
+def start_workers(queue, handler, count):
+    """Start count daemon threads working the queue in this process (once per process)"""
+    with queue_lock:
+        if local_workers:
+            return
+        for index in range(count):
+            thread = threading.Thread(target=run_worker, args=(queue, handler), name=f'render-queue-{index}',
+                                      daemon=True)
+            thread.start()
+            local_workers.append(thread)
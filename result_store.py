@@ -0,0 +1,216 @@
+"""Content-addressed PDF store on disk, shared by every converter process on a host.
+
+Results are filed under their result key, which hashes the converter, its
+settings (engine and backend included) and the markdown, so a PDF one
+process rendered is found by all its siblings. The in-memory cache in
+results.py sits in front of it.
+
+Files are written to a temporary name and renamed into place, so readers
+only ever see complete PDFs. A lock per key (striped over LOCK_STRIPES
+lock files) lets one process render a key while the others wait and then
+read its file. Hits are served straight from the file, which lets the
+WSGI server use sendfile; the file is opened by the lookup itself, so an
+eviction that follows cannot pull it out from under the response. The
+store is kept under RESULT_STORE_MAX_MB by evicting the least recently
+used files; a hit refreshes the file's mtime, at most once per
+TOUCH_INTERVAL.
+
+RESULT_STORE_DIR= (empty) turns the store off.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # no cross-process locks (Windows); atomic renames still keep files whole
+    fcntl = None
+
+RESULT_STORE_DIR = os.environ.get(
+    'RESULT_STORE_DIR', os.path.join(tempfile.gettempdir(), 'markdown2pdf-results')
+)
+RESULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_MB', 1024)) * 1024 * 1024
+GC_LOW_WATER = 0.9                 # eviction stops at this fraction of the limit
+GC_EVERY_BYTES_FRACTION = 0.05     # collect after writing this fraction of the limit
+TOUCH_INTERVAL = 60
+STALE_TEMP_SECONDS = 60 * 60
+LOCK_STRIPES = 256
+KEY_PATTERN = re.compile(r'[0-9a-f]{16,128}')   # result keys are hex digests, never paths
+
+StoredResult = namedtuple('StoredResult', ['file', 'filename', 'size'])
+
+bytes_since_gc = None   # None until this process's first collection
+gc_lock = threading.Lock()
+
+
+def enabled(key=None):
+    """Whether the store is configured (and, given a key, whether the key can be stored)"""
+    return bool(RESULT_STORE_DIR) and (key is None or KEY_PATTERN.fullmatch(key) is not None)
+
+
+def entry_paths(key):
+    """(PDF path, metadata path) of a key, fanned out over 256 directories"""
+    directory = os.path.join(RESULT_STORE_DIR, key[:2])
+    return os.path.join(directory, f'{key}.pdf'), os.path.join(directory, f'{key}.json')
+
+
+def write_atomic(path, data):
+    """Write data to path through a temporary file in the same directory and a rename"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def key_lock(key):
+    """Hold the cross-process lock of a key (shared with the other keys of its stripe)"""
+    if not enabled(key) or fcntl is None:
+        yield
+        return
+    directory = os.path.join(RESULT_STORE_DIR, 'locks')
+    os.makedirs(directory, exist_ok=True)
+    stripe = zlib.crc32(key.encode('ascii')) % LOCK_STRIPES
+    with open(os.path.join(directory, f'{stripe:03d}.lock'), 'a') as lock_file:
+        start = time.perf_counter()
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        metrics.record_time('store.lock_wait', time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def lookup(key):
+    """The stored PDF of a key, opened for reading, as a StoredResult (the caller closes it), or None"""
+    if not enabled(key):
+        return None
+    pdf_path, meta_path = entry_paths(key)
+    try:
+        # An open file outlives its unlink by another process's collection
+        pdf_file = open(pdf_path, 'rb')
+    except OSError:
+        metrics.increment('store.miss')
+        return None
+    stat = os.fstat(pdf_file.fileno())
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            filename = json.load(f).get('filename') or 'document.pdf'
+    except (OSError, ValueError):
+        filename = 'document.pdf'
+    # Mark the entry recently used for eviction
+    now = time.time()
+    if now - stat.st_mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(pdf_path, (now, now))
+        except OSError:
+            pass
+    metrics.increment('store.hit')
+    return StoredResult(pdf_file, filename, stat.st_size)
+
+
+def load(key):
+    """(PDF bytes, filename) of a stored key, or None"""
+    stored = lookup(key)
+    if stored is None:
+        return None
+    with stored.file:
+        return stored.file.read(), stored.filename
+
+
+def save(key, pdf_content, filename):
+    """Store a PDF under its key (a no-op when it is already stored)"""
+    global bytes_since_gc
+    if not enabled(key):
+        return
+    pdf_path, meta_path = entry_paths(key)
+    if os.path.exists(pdf_path):
+        return
+    with metrics.timed('store.write'):
+        # The metadata goes first: a visible PDF always has its filename
+        write_atomic(meta_path, json.dumps({'filename': filename, 'saved': time.time()}).encode('utf-8'))
+        write_atomic(pdf_path, pdf_content)
+    metrics.increment('store.saved_bytes', len(pdf_content))
+
+    with gc_lock:
+        due = bytes_since_gc is None or bytes_since_gc >= RESULT_STORE_MAX_BYTES * GC_EVERY_BYTES_FRACTION
+        bytes_since_gc = 0 if due else bytes_since_gc + len(pdf_content)
+    if due:
+        collect_garbage()
+
+
+def collect_garbage(max_bytes=None):
+    """Evict least recently used entries until the store is under its limit; return bytes freed"""
+    max_bytes = RESULT_STORE_MAX_BYTES if max_bytes is None else max_bytes
+    if not enabled() or not os.path.isdir(RESULT_STORE_DIR):
+        return 0
+    lock_file = None
+    if fcntl is not None:
+        lock_file = open(os.path.join(RESULT_STORE_DIR, 'gc.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # another process is collecting
+            lock_file.close()
+            return 0
+
+    try:
+        with metrics.timed('store.gc'):
+            now = time.time()
+            entries = []
+            total = 0
+            for directory in os.scandir(RESULT_STORE_DIR):
+                if not directory.is_dir() or directory.name == 'locks':
+                    continue
+                for entry in os.scandir(directory.path):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if entry.name.endswith('.pdf'):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+                    elif entry.name.endswith('.tmp') and now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        # Left behind by a writer that died
+                        remove_quietly(entry.path)
+
+            freed = 0
+            if total > max_bytes:
+                entries.sort()
+                target = max_bytes * GC_LOW_WATER
+                for _, size, path in entries:
+                    if total - freed <= target:
+                        break
+                    remove_quietly(path)
+                    remove_quietly(path[:-len('.pdf')] + '.json')
+                    freed += size
+                    metrics.increment('store.evicted')
+            metrics.increment('store.evicted_bytes', freed)
+            return freed
+    finally:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+def remove_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
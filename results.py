@@ -0,0 +1,130 @@
+"""Rendered PDFs kept by result key, with page thumbnails made on demand.
+
+A result key hashes the converter, its settings and the markdown, so the
+same request always maps to the same key. Both converters store every PDF
+they render here and return the key in the X-Result-Key header; the
+/thumbnail route renders single pages of a stored PDF to PNG with
+pypdfium2 the first time they are asked for and keeps them next to it.
+
+The in-memory cache is backed by result_store, the on-disk store every
+process on the host shares: saving writes through to it, and a key
+missing here is looked up there.
+"""
+import hashlib
+import json
+import threading
+from io import BytesIO
+
+import metrics
+import result_store
+
+try:
+    import pypdfium2
+except ImportError:  # thumbnails are optional
+    pypdfium2 = None
+
+MAX_CACHED_RESULTS = 16
+MAX_CACHED_RESULT_SIZE = 32 * 1024 * 1024   # larger PDFs are sent but not kept
+RESULT_MAX_AGE = 24 * 60 * 60   # seconds shared caches may reuse a PDF without revalidating
+MAX_THUMBNAIL_PAGES = 4
+DEFAULT_THUMBNAIL_DPI = 48
+MIN_THUMBNAIL_DPI = 24
+MAX_THUMBNAIL_DPI = 96
+
+stored_results = {}   # key -> {'pdf', 'filename', 'pages', 'thumbnails'}
+results_lock = threading.Lock()
+pdfium_lock = threading.Lock()   # PDFium is not thread-safe
+
+
+def result_key(converter, settings, markdown_hash):
+    """Key of one rendering: converter name, its settings and the markdown's hash"""
+    parts = json.dumps([converter, settings, markdown_hash], sort_keys=True, default=str)
+    return hashlib.sha256(parts.encode('utf-8')).hexdigest()
+
+
+def get_result(key):
+    """The stored result for a key, from memory or else the on-disk store, or None"""
+    with results_lock:
+        result = stored_results.get(key)
+    if result is None:
+        stored = result_store.load(key)
+        if stored is not None:
+            metrics.increment('results.disk_hit')
+            return remember_result(key, *stored)
+    metrics.increment('results.hit' if result is not None else 'results.miss')
+    return result
+
+
+def save_result(key, pdf_content, filename):
+    """Store a rendered PDF, in memory and on disk, and return its result (kept in memory or not)"""
+    result_store.save(key, pdf_content, filename)
+    return remember_result(key, pdf_content, filename)
+
+
+def remember_result(key, pdf_content, filename):
+    """Keep a result in the in-memory cache and return it"""
+    result = {'pdf': pdf_content, 'filename': filename, 'pages': None, 'thumbnails': {}}
+    if len(pdf_content) <= MAX_CACHED_RESULT_SIZE:
+        with results_lock:
+            if key not in stored_results and len(stored_results) >= MAX_CACHED_RESULTS:
+                stored_results.pop(next(iter(stored_results)))
+            stored_results[key] = result
+    return result
+
+
+def result_summary(key, result):
+    """JSON description of a result: size, page count and thumbnail/download URLs"""
+    pages = page_count(result)
+    return {
+        'key': key,
+        'filename': result['filename'],
+        'size': len(result['pdf']),
+        'pages': pages,
+        'download': f'/result/{key}.pdf',
+        'thumbnails': [f'/thumbnail/{key}/{page}.png' for page in range(1, min(pages or 0, MAX_THUMBNAIL_PAGES) + 1)],
+    }
+
+
+def page_count(result):
+    """Number of pages of a stored result (None without pypdfium2)"""
+    if pypdfium2 is None:
+        return None
+    if result['pages'] is None:
+        with pdfium_lock:
+            document = pypdfium2.PdfDocument(result['pdf'])
+            try:
+                result['pages'] = len(document)
+            finally:
+                document.close()
+    return result['pages']
+
+
+def clamp_dpi(dpi):
+    """Thumbnail resolution kept within the supported range"""
+    return max(MIN_THUMBNAIL_DPI, min(MAX_THUMBNAIL_DPI, dpi))
+
+
+def get_thumbnail(result, page, dpi=DEFAULT_THUMBNAIL_DPI):
+    """PNG bytes of one page (1-based) of a stored result, or None when there is no such page"""
+    if pypdfium2 is None or not 1 <= page <= MAX_THUMBNAIL_PAGES:
+        return None
+    dpi = clamp_dpi(dpi)
+    thumbnail = result['thumbnails'].get((page, dpi))
+    if thumbnail is not None:
+        metrics.increment('results.thumbnail_hit')
+        return thumbnail
+
+    with metrics.timed('results.thumbnail'), pdfium_lock:
+        document = pypdfium2.PdfDocument(result['pdf'])
+        try:
+            result['pages'] = len(document)
+            if page > result['pages']:
+                return None
+            image = document[page - 1].render(scale=dpi / 72).to_pil()
+        finally:
+            document.close()
+
+    png = BytesIO()
+    image.save(png, format='PNG')
+    thumbnail = result['thumbnails'][(page, dpi)] = png.getvalue()
+    return thumbnail
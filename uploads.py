@@ -0,0 +1,171 @@
+"""Read markdown input from a form field, a file upload or the raw request body.
+
+Uploads are streamed in chunks into a spooled temporary file (optionally
+decompressing gzip or zstd on the way), so nothing is decoded into one big
+string before the size limits have been checked.
+"""
+import gzip
+import hashlib
+import io
+import re
+import tempfile
+import zlib
+
+from docmodel import FENCE_OPEN_PATTERN
+
+try:
+    import zstandard
+except ImportError:  # zstd uploads are optional
+    zstandard = None
+
+MAX_CONTENT_LENGTH = 64 * 1024 * 1024      # request body, as sent (possibly compressed)
+MAX_MARKDOWN_SIZE = 256 * 1024 * 1024      # markdown after decompression
+SPOOL_MAX_SIZE = 4 * 1024 * 1024           # kept in memory below this, on disk above
+CHUNK_SIZE = 64 * 1024
+
+RAW_BODY_TYPES = {
+    'text/markdown', 'text/x-markdown', 'text/plain',
+    'application/octet-stream', 'application/gzip', 'application/zstd',
+}
+HEADER_LINE_PATTERN = re.compile(r'#{1,6}\s+\S')
+
+DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+
+def detect_compression(content_encoding, content_type, filename):
+    """Return 'gzip', 'zstd' or None for an upload"""
+    content_encoding = (content_encoding or '').lower()
+    content_type = (content_type or '').lower()
+    filename = (filename or '').lower()
+    if 'zstd' in content_encoding or content_type == 'application/zstd' or filename.endswith('.zst'):
+        return 'zstd'
+    if 'gzip' in content_encoding or content_type == 'application/gzip' or filename.endswith('.gz'):
+        return 'gzip'
+    return None
+
+
+def open_decompressed(stream, compression):
+    """Wrap a binary stream so that reading it yields the decompressed bytes"""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def spool_stream(stream, compression=None):
+    """Copy a (possibly compressed) stream into a spooled temp file.
+
+    Returns (file, error) where error is a (message, status) tuple.
+    """
+    if compression == 'zstd' and zstandard is None:
+        return None, ("zstd uploads need the 'zstandard' package", 415)
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    size = 0
+    try:
+        source = open_decompressed(stream, compression)
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_MARKDOWN_SIZE:
+                spool.close()
+                return None, (f"Markdown exceeds the {MAX_MARKDOWN_SIZE // (1024 * 1024)} MB limit", 413)
+            spool.write(chunk)
+    except DECOMPRESSION_ERRORS as e:
+        spool.close()
+        return None, (f"Could not decompress upload: {e}", 400)
+
+    spool.seek(0)
+    return spool, None
+
+
+def open_markdown_input(request):
+    """Return (file, error) for the markdown carried by this request.
+
+    Looks at, in order: a raw body sent as markdown, plain text, gzip, zstd
+    or octet-stream, a 'markdown_file' multipart upload, and the 'markdown'
+    form field. The
+    file is binary UTF-8 positioned at its start; error is a (message,
+    status) tuple suitable for returning from a view.
+    """
+    if request.mimetype in RAW_BODY_TYPES:
+        compression = detect_compression(
+            request.headers.get('Content-Encoding'), request.mimetype, None
+        )
+        md_file, error = spool_stream(request.stream, compression)
+    else:
+        upload = request.files.get('markdown_file')
+        if upload and upload.filename:
+            compression = detect_compression(None, upload.mimetype, upload.filename)
+            md_file, error = spool_stream(upload.stream, compression)
+        else:
+            md_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+            md_file.write(request.form.get('markdown', '').encode('utf-8'))
+            md_file.seek(0)
+            error = None
+
+    if error:
+        return None, error
+    if input_size(md_file) == 0:
+        md_file.close()
+        return None, ("No markdown content provided", 400)
+    return md_file, None
+
+
+def input_size(md_file):
+    """Size in bytes of a spooled markdown file"""
+    position = md_file.tell()
+    md_file.seek(0, io.SEEK_END)
+    size = md_file.tell()
+    md_file.seek(position)
+    return size
+
+
+def input_hash(md_file):
+    """SHA-256 hex digest of a spooled markdown file, read in chunks"""
+    digest = hashlib.sha256()
+    md_file.seek(0)
+    for chunk in iter(lambda: md_file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    md_file.seek(0)
+    return digest.hexdigest()
+
+
+def text_lines(md_file):
+    """Iterate over a spooled markdown file as decoded text lines"""
+    md_file.seek(0)
+    return io.TextIOWrapper(md_file, encoding='utf-8', errors='replace', newline='')
+
+
+def read_markdown_text(md_file):
+    """Decode the whole spooled markdown file into a string"""
+    md_file.seek(0)
+    return md_file.read().decode('utf-8', errors='replace')
+
+
+def read_first_header_line(md_file):
+    """Return the first markdown header line outside code fences, reading only up to it"""
+    md_file.seek(0)
+    header = ''
+    fence = None
+    for raw_line in md_file:
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        if fence:
+            # Same closing rule as the document model
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+            continue
+        fence_match = FENCE_OPEN_PATTERN.match(line)
+        if fence_match:
+            fence = fence_match.group(1)
+        elif HEADER_LINE_PATTERN.match(line):
+            header = line
+            break
+    md_file.seek(0)
+    return header
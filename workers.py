@@ -0,0 +1,250 @@
+"""Recyclable worker processes for the artifact converter's pisa conversions.
+
+A long-running process calling pisa.CreatePDF keeps growing: reportlab and
+html5lib hold module-level caches and the heap fragments. Conversions run
+in worker processes instead, and a worker is replaced after
+MAX_JOBS_PER_WORKER jobs or once its resident set passes MAX_WORKER_RSS_MB.
+Workers are only replaced between jobs, and a job whose worker dies is
+retried on a fresh one, so recycling never loses a job in flight.
+
+Each worker is driven over a pipe by its own thread in the parent, which
+takes jobs from a shared queue. Lifecycle counters (started, recycled,
+crashed) and job timings land in metrics under workers.<pool name>.
+"""
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+from multiprocessing import Pipe, Process
+
+import metrics
+
+# PISA_WORKERS=0 converts in the request's own process
+PISA_WORKERS = int(os.environ.get('PISA_WORKERS', os.cpu_count() or 1))
+MAX_JOBS_PER_WORKER = int(os.environ.get('PISA_WORKER_MAX_JOBS', 200))
+MAX_WORKER_RSS_MB = int(os.environ.get('PISA_WORKER_MAX_RSS_MB', 512))
+MAX_JOB_ATTEMPTS = 2
+WORKER_STOP_TIMEOUT = 10
+COPY_CHUNK_SIZE = 64 * 1024
+
+pisa_pool = None
+pisa_pool_lock = threading.Lock()
+
+
+class WorkerCrashed(RuntimeError):
+    """A worker process died before it returned a job's result"""
+
+
+def current_rss():
+    """Resident set size of this process in bytes (0 where it cannot be read)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current size, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if peak > 1 << 32 else peak * 1024
+
+
+def worker_main(conn):
+    """Worker process loop: run (func, args) jobs until told to stop"""
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        func, args = job
+        try:
+            reply = (True, func(*args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            conn.send(reply + (current_rss(),))
+        except Exception as e:  # an unpicklable result or exception
+            conn.send((False, RuntimeError(f'Worker could not return the result: {e!r}'), current_rss()))
+    conn.close()
+
+
+class RecyclingWorkerPool:
+    """Worker processes replaced after max_jobs jobs or once their RSS passes max_rss_mb"""
+
+    def __init__(self, workers, max_jobs=MAX_JOBS_PER_WORKER, max_rss_mb=MAX_WORKER_RSS_MB, name='pool'):
+        self.name = name
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.jobs = queue.Queue()
+        self.slots = [{'pid': None, 'jobs': 0, 'rss': 0} for _ in range(workers)]
+        self.threads = [
+            threading.Thread(target=self.run_slot, args=(slot,), name=f'{name}-slot-{index}', daemon=True)
+            for index, slot in enumerate(self.slots)
+        ]
+        self.closed = False
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, func, *args):
+        """Queue func(*args) for a worker; func and args must pickle"""
+        if self.closed:
+            raise RuntimeError(f'Worker pool {self.name} is shut down')
+        future = Future()
+        self.jobs.put((future, func, args))
+        return future
+
+    def shutdown(self):
+        """Finish the queued jobs, then stop every worker"""
+        self.closed = True
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        """Live state of every worker slot"""
+        return {
+            'workers': [dict(slot) for slot in self.slots],
+            'max_jobs': self.max_jobs,
+            'max_rss_mb': self.max_rss // (1024 * 1024),
+            'queued': self.jobs.qsize(),
+        }
+
+    def start_worker(self, slot):
+        parent_conn, child_conn = Pipe()
+        process = Process(target=worker_main, args=(child_conn,), daemon=True)
+        with metrics.timed(f'workers.{self.name}.start'):
+            process.start()
+        child_conn.close()
+        slot.update(pid=process.pid, jobs=0, rss=0)
+        metrics.increment(f'workers.{self.name}.started')
+        return process, parent_conn
+
+    def stop_worker(self, slot, process, conn):
+        try:
+            conn.send(None)
+        except OSError:
+            pass
+        process.join(WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+        slot.update(pid=None, jobs=0, rss=0)
+
+    def run_slot(self, slot):
+        """Feed queued jobs to one worker process, replacing it when due"""
+        process = conn = None
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, func, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            start = time.perf_counter()
+            for attempt in range(MAX_JOB_ATTEMPTS):
+                if process is None:
+                    process, conn = self.start_worker(slot)
+                try:
+                    conn.send((func, args))
+                    ok, value, rss = conn.recv()
+                except (EOFError, OSError):
+                    # The worker died mid-job (killed for memory, a crash in C code)
+                    metrics.increment(f'workers.{self.name}.crashed')
+                    self.stop_worker(slot, process, conn)
+                    process = conn = None
+                    value = WorkerCrashed(f'Worker of pool {self.name} died during a job')
+                    continue
+                except Exception as e:  # func or args do not pickle
+                    ok, value, rss = False, e, slot['rss']
+                slot['jobs'] += 1
+                slot['rss'] = rss
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+                break
+            else:
+                future.set_exception(value)
+            metrics.record_time(f'workers.{self.name}.job', time.perf_counter() - start)
+
+            # Recycle between jobs, once the result is already delivered
+            if process is not None:
+                reason = None
+                if slot['jobs'] >= self.max_jobs:
+                    reason = 'jobs'
+                elif self.max_rss and slot['rss'] > self.max_rss:
+                    reason = 'rss'
+                if reason:
+                    metrics.increment(f'workers.{self.name}.recycled_{reason}')
+                    self.stop_worker(slot, process, conn)
+                    process = conn = None
+
+        if process is not None:
+            self.stop_worker(slot, process, conn)
+
+
+def pisa_to_pdf(html_source, default_css):
+    """Convert an HTML document with pisa; return the PDF, or None when pisa reports errors"""
+    from reportlab import rl_config
+    from xhtml2pdf import pisa
+    from css_cache import install_css_parse_cache
+    from fonts import register_fonts
+
+    # Spawned workers never ran the converter script's setup
+    rl_config.invariant = 1
+    register_fonts()
+    install_css_parse_cache()
+    pdf_file = BytesIO()
+    status = pisa.CreatePDF(html_source, dest=pdf_file, encoding='utf-8', path='', default_css=default_css)
+    return None if status.err else pdf_file.getvalue()
+
+
+def pisa_file_to_pdf(html_path, default_css):
+    """pisa_to_pdf on an HTML file, read by the worker itself"""
+    with open(html_path, 'rb') as html_file:
+        return pisa_to_pdf(html_file, default_css)
+
+
+def get_pisa_pool():
+    """Return the pisa worker pool shared by every request, or None with PISA_WORKERS=0"""
+    global pisa_pool
+    if PISA_WORKERS < 1:
+        return None
+    with pisa_pool_lock:
+        if pisa_pool is None:
+            pisa_pool = RecyclingWorkerPool(PISA_WORKERS, name='pisa')
+    return pisa_pool
+
+
+def convert_html(html_source, default_css):
+    """Run pisa_to_pdf on a worker (in this process with PISA_WORKERS=0)"""
+    pool = get_pisa_pool()
+    if pool is None:
+        return pisa_to_pdf(html_source, default_css)
+    if not hasattr(html_source, 'read'):
+        return pool.submit(pisa_to_pdf, html_source, default_css).result()
+
+    # A streamed document goes over as a file on disk, so neither process
+    # holds a second copy of the HTML just to pickle it through the pipe
+    with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as html_file:
+        shutil.copyfileobj(html_source, html_file, COPY_CHUNK_SIZE)
+    try:
+        return pool.submit(pisa_file_to_pdf, html_file.name, default_css).result()
+    finally:
+        os.unlink(html_file.name)
+
+
+def pool_stats():
+    """Worker state of every pool started in this process"""
+    return {'pisa': pisa_pool.stats()} if pisa_pool is not None else {}